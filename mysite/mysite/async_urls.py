@@ -0,0 +1,10 @@
+"""
+URL configuration serving the polls app from its async views.
+
+Used as ROOT_URLCONF when POLLS_VIEW_MODE is "async"; otherwise identical
+to mysite/urls.py.
+"""
+
+from .urls import build_urlpatterns
+
+urlpatterns = build_urlpatterns("polls.async_urls")
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,32 +42,69 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "polls.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "polls.query_budget.QueryBudgetMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
-ROOT_URLCONF = "mysite.urls"
+# "async" serves the polls pages from the async views in polls/async_views.py
+# (see mysite/async_urls.py). asgi.py defaults this to "async".
+POLLS_VIEW_MODE = os.environ.get("POLLS_VIEW_MODE", "sync")
+
+ROOT_URLCONF = "mysite.async_urls" if POLLS_VIEW_MODE == "async" else "mysite.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        # DjangoTemplates, timing each render for polls.metrics.
+        "BACKEND": "polls.metrics.DjangoTemplates",
         "DIRS": [BASE_DIR / "templates"],
-        "APP_DIRS": True,
         "OPTIONS": {
             "context_processors": [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
             ],
+            # Parse each template once per process. Django's default loaders
+            # do this too, but spelling them out keeps the production setup
+            # from depending on it; under DEBUG the cache is still cleared
+            # when a template file changes.
+            "loaders": [
+                (
+                    "django.template.loaders.cached.Loader",
+                    [
+                        "django.template.loaders.filesystem.Loader",
+                        "django.template.loaders.app_directories.Loader",
+                    ],
+                ),
+            ],
         },
     },
 ]
 
+# "jinja2" renders the polls pages from polls/jinja2/ with Jinja2, which has
+# to be installed (see polls/jinja_env.py). Other pages still use Django.
+POLLS_TEMPLATE_ENGINE = os.environ.get("POLLS_TEMPLATE_ENGINE", "django")
+
+if POLLS_TEMPLATE_ENGINE == "jinja2":
+    TEMPLATES.insert(
+        0,
+        {
+            "BACKEND": "polls.jinja_env.Jinja2",
+            "DIRS": [],
+            "APP_DIRS": True,
+            "OPTIONS": {
+                "environment": "polls.jinja_env.environment",
+                "context_processors": TEMPLATES[0]["OPTIONS"]["context_processors"],
+            },
+        },
+    )
+
 WSGI_APPLICATION = "mysite.wsgi.application"
 
 
@@ -77,7 +115,57 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {
+            # Take the write lock up front; upgrading a read lock mid
+            # transaction fails immediately when another writer holds it.
+            "transaction_mode": "IMMEDIATE",
+        },
+    },
+    # The same file opened read-only. Add it to POLLS_READ_REPLICAS to serve
+    # the polls read paths from connections that can't write.
+    "read": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": f"file:{BASE_DIR / 'db.sqlite3'}?mode=ro",
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
+        "TEST": {"MIRROR": "default"},
+    },
+}
+
+# Local stand-ins for read replicas: POLLS_SQLITE_REPLICAS=2 adds "replica1"
+# and "replica2", read-only copies of db.sqlite3 refreshed by
+# `manage.py sync_replicas`.
+for i in range(1, int(os.environ.get("POLLS_SQLITE_REPLICAS", "0")) + 1):
+    DATABASES[f"replica{i}"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": f"file:{BASE_DIR / f'db.replica{i}.sqlite3'}?mode=ro",
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
+        "TEST": {"MIRROR": "default"},
     }
+
+DATABASE_ROUTERS = ["polls.db_tuning.ReadDatabaseRouter"]
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Per-question results tallies (polls/results_cache.py). LocMemCache
+    # evicts the least recently used entries past MAX_ENTRIES and is the
+    # only backend whose tallies are updated in place as votes commit; on a
+    # cache shared between processes each vote drops the tally instead.
+    "polls_results": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "polls-results",
+        "TIMEOUT": 300,
+        "OPTIONS": {"MAX_ENTRIES": 10000, "CULL_FREQUENCY": 10},
+    },
 }
 
 
@@ -128,15 +216,24 @@ LOGOUT_REDIRECT_URL = "home"
 # Flaw 5: Security Logging A09:
 # Missing logging configuration
 
-# Fix 5: Add logging configuration:
+# Fix 5: Add logging configuration. The security handler queues records and
+# writes them from a background thread in JSON batches, so request threads
+# don't wait on the disk (see polls/security_log.py):
 # LOGGING = {
 #     "version": 1,
 #     "disable_existing_loggers": False,
 #     "handlers": {
 #         "file": {
 #             "level": "WARNING",
-#             "class": "logging.FileHandler",
+#             "class": "polls.security_log.SecurityQueueHandler",
 #             "filename": BASE_DIR / "logs/security.log",
+#             "queue_size": 10000,
+#             "policy": "sample",
+#             "batch_size": 100,
+#             "flush_interval": 1.0,
+#             "max_bytes": 10 * 1024 * 1024,
+#             "rotate_seconds": 24 * 60 * 60,
+#             "backup_count": 7,
 #         },
 #     },
 #     "loggers": {
@@ -147,3 +244,161 @@ LOGOUT_REDIRECT_URL = "home"
 #         },
 #     },
 # }
+
+# Polls vote counting
+# Number of counter rows each Choice's votes are spread over. 0 or 1 applies
+# votes directly to Choice.votes; higher values need `manage.py compact_votes`
+# to run periodically.
+POLLS_VOTE_SHARDS = 0
+
+# "sync" writes every vote straight to the database; "buffered" queues votes
+# in-process and flushes them in batches (see polls/vote_buffer.py).
+POLLS_VOTE_MODE = "sync"
+
+# Each process journals its buffered votes to JOURNAL suffixed with its pid.
+POLLS_VOTE_BUFFER = {
+    "FLUSH_INTERVAL_MS": 50,
+    "FLUSH_SIZE": 500,
+    "JOURNAL": BASE_DIR / "logs/votes.journal",
+    "JOURNAL_FSYNC": False,
+}
+
+# Question search backend: "auto", "fts" (SQLite FTS5), "trigram" (PostgreSQL
+# pg_trgm) or "like". See polls/search.py.
+POLLS_SEARCH_BACKEND = "auto"
+
+# Allow `?stream=1` on the search page to stream every match instead of a
+# single keyset page.
+POLLS_SEARCH_STREAMING = False
+
+# Cache alias holding precomputed results pages.
+POLLS_RESULTS_CACHE = "polls_results"
+
+# Raise instead of logging when a GET to a polls view runs more queries
+# than its declared query_budget (see polls/query_budget.py).
+POLLS_QUERY_BUDGET_STRICT = DEBUG
+
+# Cache alias and maximum lifetime (seconds) of the rendered index question
+# list. Entries expire earlier when a question is scheduled to be published.
+POLLS_INDEX_CACHE = "default"
+POLLS_INDEX_CACHE_TIMEOUT = 300
+
+# Pragmas run on every new SQLite connection (see polls/db_tuning.py).
+POLLS_SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    # Negative sizes are KiB: 64 MiB of page cache and 256 MiB mapped.
+    "cache_size": -65536,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+}
+
+# Replicas the index, detail, results and search views read from, as
+# {alias: weight}; empty to read from "default". A failed replica is skipped
+# for POLLS_REPLICA_RETRY_SECONDS, and a browser that voted reads from
+# "default" for POLLS_READ_YOUR_WRITES_SECONDS (see polls/db_tuning.py).
+POLLS_READ_REPLICAS = {alias: 1 for alias in DATABASES if alias.startswith("replica")}
+POLLS_REPLICA_RETRY_SECONDS = 30
+POLLS_READ_YOUR_WRITES_SECONDS = 5
+
+# Request metrics served at /metrics and /metrics/profiles to ALLOWED_IPS
+# (see polls/metrics.py). MULTIPROCESS_DIR adds up the metrics of every
+# worker process through mmap'd files; SLOW_REQUEST_MS samples the stacks of
+# requests that take longer, or None to turn that off.
+POLLS_METRICS = {
+    "ALLOWED_IPS": ["127.0.0.1", "::1"],
+    "MULTIPROCESS_DIR": os.environ.get("POLLS_METRICS_DIR"),
+    "PUBLISH_INTERVAL": 1.0,
+    "SLOW_REQUEST_MS": 500,
+    "SAMPLE_INTERVAL_MS": 5,
+    "MAX_PROFILES": 50,
+}
+
+# Where unlocked private polls are remembered ("cookie" or "session"), and
+# the cache and limits for access code checks (see polls/unlocks.py).
+POLLS_ACCESS = {
+    "STORE": "cookie",
+    "CACHE_SIZE": 10000,
+    "CACHE_TTL": 300,
+    "MAX_FAILURES": 10,
+    "FAILURE_WINDOW": 60,
+}
+
+# Cache lifetimes for results pages, in seconds (see polls/http_cache.py):
+# MAX_AGE for browsers, SHARED_MAX_AGE for a reverse proxy, which is purged
+# by surrogate key when a vote commits. Pages always carry an ETag, so
+# revalidating them is cheap.
+POLLS_HTTP_CACHE = {"MAX_AGE": 0, "SHARED_MAX_AGE": 300}
+
+# Token-bucket limits for the vote, search and access code views, as
+# (key, rate, burst) with key "ip", "user" or "question" (see
+# polls/ratelimit.py). Buckets are kept in this process by default; use
+# {"BACKEND": "file", "PATH": ..., "SLOTS": 65536} to share them between the
+# processes on a host, or {"BACKEND": "cache", "ALIAS": "default"} between
+# hosts.
+POLLS_RATE_LIMITS = {
+    "vote": [("ip", "30/m", 10), ("user", "30/m", 10), ("question", "1200/m", 200)],
+    "search": [("ip", "60/m", 20)],
+    "access": [("ip", "20/m", 5), ("question", "120/m", 20)],
+}
+POLLS_RATE_LIMIT_STORE = {"BACKEND": "local", "MAX_KEYS": 100000}
+
+# Rate-limited requests allowed to run at once per process; any more are
+# turned away with a 503 rather than queueing for the database. None for no
+# limit.
+POLLS_MAX_IN_FLIGHT = 64
+
+# Live results over Server-Sent Events (see polls/live.py). Set BROKER to the
+# Unix socket of `manage.py live_broker` when running several processes.
+POLLS_LIVE = {
+    "MAX_UPDATES_PER_SEC": 4,
+    "QUEUE_SIZE": 32,
+    "HEARTBEAT": 15,
+    "RETRY_MS": 5000,
+    "BROKER": None,
+}
+
+# The question admin counts lists exactly up to this many rows. Past it,
+# unfiltered lists show the database's estimate of the table size and
+# filtered ones stop paging (see polls/estimates.py).
+POLLS_ADMIN_COUNT_LIMIT = 10000
+
+# Vote history behind /polls/<id>/trend/ (see polls/vote_history.py). Votes
+# are appended to an event table in batches; `manage.py rollup_votes
+# --interval 60` counts them into minute, hour and day buckets and deletes
+# raw events and finer buckets past the given number of days.
+POLLS_VOTE_HISTORY = {
+    "ENABLED": True,
+    "FLUSH_INTERVAL_MS": 1000,
+    "FLUSH_SIZE": 1000,
+    "RAW_DAYS": 2,
+    "MINUTE_DAYS": 14,
+    "HOUR_DAYS": 180,
+}
+
+# Duplicate vote detection (see polls/vote_dedup.py). Each question's voters
+# are kept in Bloom filters sized for FALSE_POSITIVE_RATE; only the votes
+# they can't rule out as repeats are checked against the receipts table.
+# Set SNAPSHOT_DIR to save the filters for the next process to start from.
+# IDENTITY "user_or_ip" or "ip" also keys anonymous voters by REMOTE_ADDR,
+# which behind NAT or a reverse proxy is shared by many voters.
+POLLS_VOTE_DEDUP = {
+    "ENABLED": True,
+    "IDENTITY": "user",
+    "FALSE_POSITIVE_RATE": 0.001,
+    "INITIAL_CAPACITY": 1000,
+    "FLUSH_INTERVAL_MS": 500,
+    "SYNC_INTERVAL": 5,
+    "SNAPSHOT_DIR": None,
+    "SNAPSHOT_INTERVAL": 60,
+}
+
+# Scheduled publication (see polls/publishing.py). `manage.py
+# publish_questions` publishes questions as their pub_date comes, keeping the
+# ones due within LOOKAHEAD seconds in memory and checking for newly
+# scheduled ones every RELOAD_INTERVAL seconds.
+POLLS_PUBLISHING = {
+    "LOOKAHEAD": 3600,
+    "RELOAD_INTERVAL": 5,
+}
@@ -19,9 +19,18 @@ from django.contrib import admin
 from django.urls import include, path
 from django.views.generic import TemplateView
 
-urlpatterns = [
-    path("", TemplateView.as_view(template_name="home.html"), name="home"),
-    path("polls/", include("polls.urls")),
-    path("admin/", admin.site.urls),
-    path("accounts/", include("django.contrib.auth.urls")),
-]
+from polls import metrics
+
+
+def build_urlpatterns(polls_urls):
+    return [
+        path("", TemplateView.as_view(template_name="home.html"), name="home"),
+        path("polls/", include(polls_urls)),
+        path("admin/", admin.site.urls),
+        path("accounts/", include("django.contrib.auth.urls")),
+        path("metrics", metrics.metrics_view, name="metrics"),
+        path("metrics/profiles", metrics.profiles_view, name="metrics-profiles"),
+    ]
+
+
+urlpatterns = build_urlpatterns("polls.urls")
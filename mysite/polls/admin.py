@@ -1,6 +1,21 @@
+import datetime
+
 from django.contrib import admin
+from django.db.models import (
+    BooleanField,
+    ExpressionWrapper,
+    IntegerField,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+)
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
-from .models import Choice, Question
+from .estimates import EstimatedCountPaginator
+from .models import Choice, ChoiceVoteShard, Question
+from .search import get_search_backend
 
 
 class ChoiceInline(admin.TabularInline):
@@ -8,15 +23,107 @@ class ChoiceInline(admin.TabularInline):
     extra = 3
 
 
+class PubDateBucketFilter(admin.SimpleListFilter):
+    """
+    Filter on fixed ranges of pub_date, each a range scan of the pub_date
+    index. date_hierarchy would need the distinct dates of the whole table
+    to draw its links.
+    """
+
+    title = "date published"
+    parameter_name = "published"
+
+    def lookups(self, request, model_admin):
+        return [
+            ("today", "Today"),
+            ("week", "Past 7 days"),
+            ("month", "Past 30 days"),
+            ("year", "Past year"),
+            ("older", "More than a year ago"),
+            ("scheduled", "Not yet published"),
+        ]
+
+    def queryset(self, request, queryset):
+        now = timezone.now()
+        today = timezone.localtime(now).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        days_back = {"today": 0, "week": 6, "month": 29, "year": 364}
+        if self.value() in days_back:
+            start = today - datetime.timedelta(days=days_back[self.value()])
+            return queryset.filter(pub_date__gte=start, pub_date__lte=now)
+        if self.value() == "older":
+            return queryset.filter(pub_date__lt=today - datetime.timedelta(days=364))
+        if self.value() == "scheduled":
+            return queryset.filter(pub_date__gt=now)
+        return queryset
+
+
+def vote_totals():
+    """
+    Return an expression for each question's votes, counting shards not
+    yet compacted, summed by the database through the choice indexes.
+    """
+    votes = (
+        Choice.objects.filter(question=OuterRef("pk"))
+        .values("question")
+        .annotate(total=Sum("votes"))
+        .values("total")
+    )
+    pending = (
+        ChoiceVoteShard.objects.filter(choice__question=OuterRef("pk"))
+        .values("choice__question")
+        .annotate(total=Sum("count"))
+        .values("total")
+    )
+    return Coalesce(Subquery(votes), 0) + Coalesce(
+        Subquery(pending, output_field=IntegerField()), 0
+    )
+
+
 class QuestionAdmin(admin.ModelAdmin):
     fieldsets = [
         (None, {"fields": ["question_text", "owner", "access_code"]}),
         ("Date information", {"fields": ["pub_date"], "classes": ["collapse"]}),
     ]
     inlines = [ChoiceInline]
-    list_display = ("question_text", "pub_date", "was_published_recently")
-    list_filter = ["pub_date"]
+    list_display = ("question_text", "pub_date", "published_recently", "vote_total")
+    list_filter = [PubDateBucketFilter]
+    # get_search_results() searches through polls.search instead.
     search_fields = ["question_text"]
+    # A question table can be millions of rows long: estimate its size
+    # rather than counting it, twice, on every page (see polls/estimates.py).
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+
+    def get_queryset(self, request):
+        now = timezone.now()
+        return (
+            super()
+            .get_queryset(request)
+            .annotate(
+                published_recently=ExpressionWrapper(
+                    Q(
+                        pub_date__gte=now - datetime.timedelta(days=1),
+                        pub_date__lte=now,
+                    ),
+                    output_field=BooleanField(),
+                ),
+                vote_total=vote_totals(),
+            )
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        return get_search_backend().filter(queryset, search_term), False
+
+    @admin.display(boolean=True, ordering="pub_date", description="Published recently?")
+    def published_recently(self, question):
+        return question.published_recently
+
+    @admin.display(description="Votes")
+    def vote_total(self, question):
+        return question.vote_total
 
 
 admin.site.register(Question, QuestionAdmin)
@@ -0,0 +1,227 @@
+"""
+Async versions of the polls read and vote paths, for ASGI deployments.
+
+Under ASGI every sync view is run in a worker thread. These views run on
+the event loop instead and use the async ORM, cache and session APIs, so a
+request only leaves the loop for the database calls themselves. They keep
+the same templates, URL names and query budgets as the views in views.py;
+polls/async_urls.py routes to them, and ``POLLS_VIEW_MODE = "async"`` selects
+that URLconf. ``live_results`` is routed in both URLconfs.
+
+``request.user`` is loaded lazily, which would hit the database from the
+event loop, so views whose templates show the user resolve it with
+``auser()`` before rendering.
+"""
+
+import asyncio
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import aprefetch_related_objects
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.shortcuts import aget_object_or_404, render
+from django.template.loader import get_template, render_to_string
+from django.urls import reverse
+from django.utils.html import escape
+
+from . import http_cache, views, vote_dedup, vote_history
+from .index_cache import aget_fragment
+from .live import RESYNC, get_hub, get_live_settings, sse_event
+from .models import Choice, Question
+from .query_budget import query_budget
+from .ratelimit import rate_limit
+from .results_cache import aget_results
+from .search import aget_search_backend
+from .templatetags.polls_urls import url_template
+from .transfer import aexport_lines
+from .unlocks import aget_unlocked
+from .voting import asubmit_vote
+
+# Not hot paths; Django runs these sync views in a thread under ASGI.
+access_code_poll = views.access_code_poll
+delete_question = views.delete_question
+
+
+async def resolve_user(request):
+    request.user = await request.auser()
+    return request.user
+
+
+class IndexView(views.IndexView):
+    async def get(self, request, *args, **kwargs):
+        user = await resolve_user(request)
+
+        async def render_list():
+            questions = [question async for question in self.get_queryset()]
+            context = {self.context_object_name: questions}
+            return render_to_string("polls/index_questions.html", context, request)
+
+        html = await aget_fragment(user, render_list)
+        return render(request, self.template_name, {"question_list_html": html})
+
+
+class DetailView(views.DetailView):
+    async def get(self, request, *args, **kwargs):
+        version = await http_cache.aget_version(kwargs["pk"])
+        unlocked = await aget_unlocked(request)
+        response = http_cache.detail_not_modified(request, version, unlocked)
+        if response is not None:
+            return response
+        question = await aget_object_or_404(self.get_queryset(), pk=kwargs["pk"])
+        if question.access_code and question.pk not in unlocked:
+            return HttpResponseRedirect(reverse("polls:access", args=(question.pk,)))
+        response = render(request, self.template_name, {"question": question})
+        return http_cache.patch_detail(request, response, version, unlocked)
+
+
+class ResultsView(views.ResultsView):
+    async def get(self, request, *args, **kwargs):
+        version = await http_cache.aget_version(kwargs["pk"])
+        response = http_cache.results_not_modified(request, kwargs["pk"], version)
+        if response is not None:
+            return response
+        question = await aget_object_or_404(self.get_queryset(), pk=kwargs["pk"])
+        context = {"question": question, "results": await aget_results(question.pk)}
+        response = render(request, self.template_name, context)
+        return http_cache.patch_results(request, response, question.pk, version)
+
+
+async def render_vote_error(request, question, message, status=200):
+    """
+    Render the detail page with message, loading the choices it lists
+    first.
+    """
+    await aprefetch_related_objects([question], "choice_set")
+    context = {"question": question, "error_message": message}
+    return render(request, "polls/detail.html", context, status=status)
+
+
+# Two more than the view needs: one for the session the per-user limit
+# reads, one for a duplicate check the filters can't settle.
+@query_budget(6)
+@rate_limit("vote")
+async def vote(request, question_id):
+    question = await aget_object_or_404(Question, pk=question_id, is_published=True)
+    try:
+        choice_id = request.GET.get("choice") or request.POST.get("choice")
+        selected_choice = await question.choice_set.aget(pk=choice_id)
+    except (KeyError, Choice.DoesNotExist):
+        return await render_vote_error(request, question, "You didn't select a choice.")
+    else:
+        if not await vote_dedup.aadmit(request, question.pk):
+            return await render_vote_error(
+                request, question, "You have already voted in this poll.", 409
+            )
+        try:
+            await asubmit_vote(selected_choice)
+        except Exception:
+            # The vote wasn't counted, so it mustn't lock the voter out.
+            await vote_dedup.arelease(request, question.pk)
+            raise
+        return HttpResponseRedirect(reverse("polls:results", args=(question.id,)))
+
+
+@query_budget(2)
+@rate_limit("search")
+async def search_questions(request):
+    search_query = request.GET.get("q", "")
+    backend = await aget_search_backend()
+    if request.GET.get("stream") == "1" and getattr(
+        settings, "POLLS_SEARCH_STREAMING", False
+    ):
+        return StreamingHttpResponse(
+            stream_search_results(request, backend, search_query)
+        )
+
+    page = await backend.asearch_after(search_query, cursor=request.GET.get("cursor"))
+    return render(
+        request,
+        "polls/search_results.html",
+        {"questions": page.results, "page": page, "search_query": search_query},
+    )
+
+
+async def stream_search_results(request, backend, search_query):
+    context = {"search_query": search_query}
+    yield render_to_string("polls/search_form.html", context, request)
+    if not search_query:
+        return
+    yield f"<h2>Search Results for: &quot;{escape(search_query)}&quot;</h2>\n<ul>\n"
+    row = get_template("polls/search_row.html")
+    detail_url = url_template("polls:detail")
+    async for question in backend.aiter_matches(search_query):
+        yield row.render({"question": question, "detail_url": detail_url})
+    yield "</ul>\n"
+
+
+@query_budget(1)
+async def question_trend(request, question_id):
+    try:
+        args = vote_history.trend_args(request.GET)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return JsonResponse(await vote_history.atrend(question_id, *args))
+
+
+@staff_member_required
+async def export_polls(request):
+    """
+    views.export_polls(), streaming from the event loop; a sync iterator
+    would be read in full before the first byte under ASGI.
+    """
+    format = request.GET.get("format", "ndjson")
+    if format not in views.EXPORT_CONTENT_TYPES:
+        return HttpResponseBadRequest("format must be ndjson or csv.")
+    return views.export_response(aexport_lines(format), format)
+
+
+@query_budget(2)
+async def live_results(request, question_id):
+    """
+    Stream a question's results as Server-Sent Events (see live.py).
+    """
+    question = await aget_object_or_404(Question.objects.only("id"), pk=question_id)
+    config = get_live_settings()
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker can't be held open per viewer. Send the current tally
+        # and let the browser reconnect after RETRY_MS, which polls instead.
+        return HttpResponse(
+            f"retry: {config['RETRY_MS']}\n\n"
+            + sse_event("tally", await aget_results(question.pk)),
+            content_type="text/event-stream",
+        )
+    response = StreamingHttpResponse(
+        stream_live_results(question.pk, config), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+async def stream_live_results(question_id, config):
+    hub = get_hub()
+    # Subscribe before reading the tally so no vote falls in between; a vote
+    # committing during the read may be counted twice until the next resync.
+    subscriber = hub.subscribe(question_id)
+    try:
+        yield f"retry: {config['RETRY_MS']}\n\n" + sse_event(
+            "tally", await aget_results(question_id)
+        )
+        while True:
+            try:
+                event = await subscriber.get(config["HEARTBEAT"])
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if event is RESYNC:
+                event = sse_event("tally", await aget_results(question_id))
+            yield event
+    finally:
+        hub.unsubscribe(subscriber)
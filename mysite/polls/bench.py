@@ -0,0 +1,341 @@
+"""
+Helpers shared by the polls benchmark commands.
+
+``summarize()`` turns latency samples into the percentiles every benchmark
+reports, and ``compare()`` checks a run against a stored JSON baseline so a
+change to the polls views can be gated on performance.
+
+For benchmarks that go over the network, ``serve_wsgi()`` and
+``serve_asgi()`` run the project on a free localhost port in a background
+thread, and HTTPClient is a minimal cookie- and CSRF-aware client for them.
+``http_request()`` is a bare asyncio client for opening many connections at
+once, and ``wsgi_request()``/``asgi_request()`` call a handler directly, so
+WSGI and ASGI can be compared without a server in between. Commands run
+under ``unthrottled()`` so rate limits don't skew their numbers.
+"""
+
+import asyncio
+import http.client
+import io
+import json
+import re
+import socket
+import statistics
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import connections
+from django.test.utils import override_settings
+
+# Relative increase over the baseline that counts as a regression.
+DEFAULT_THRESHOLD = 0.10
+
+
+def percentile(samples, pct):
+    """
+    Return the pct-th percentile of samples using the nearest-rank method.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(samples_ms, elapsed, **extra):
+    return {
+        "requests": len(samples_ms),
+        "p50_ms": round(percentile(samples_ms, 50), 3),
+        "p95_ms": round(percentile(samples_ms, 95), 3),
+        "p99_ms": round(percentile(samples_ms, 99), 3),
+        "mean_ms": round(statistics.fmean(samples_ms), 3) if samples_ms else 0.0,
+        "throughput_rps": round(len(samples_ms) / elapsed, 1) if elapsed else 0.0,
+        **extra,
+    }
+
+
+# Metrics where a bigger number is worse, with the relative change allowed.
+# Query and error counts are exact, so any increase is a regression.
+GATED_METRICS = {
+    "p50_ms": None,
+    "p95_ms": None,
+    "p99_ms": None,
+    "queries_per_request": 0.0,
+    "errors": 0.0,
+    "alloc_kib_per_request": None,
+    "alloc_kib_per_render": None,
+}
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Return a list of human readable regressions of current against baseline.
+    Both are {"results": {endpoint: summary}} dicts as written by
+    write_report().
+    """
+    regressions = []
+    for endpoint, before in baseline.get("results", {}).items():
+        after = current.get("results", {}).get(endpoint)
+        if after is None:
+            continue
+        for metric, allowed in GATED_METRICS.items():
+            if metric not in before or metric not in after:
+                continue
+            allowed = threshold if allowed is None else allowed
+            old, new = before[metric], after[metric]
+            if new > old * (1 + allowed) and new - old > 1e-9:
+                regressions.append(
+                    f"{endpoint}: {metric} {old} -> {new} "
+                    f"(+{(new - old) / old * 100 if old else float('inf'):.0f}%)"
+                )
+    return regressions
+
+
+def write_report(path, meta, results):
+    with open(path, "w") as report:
+        json.dump({"meta": meta, "results": results}, report, indent=2, default=str)
+
+
+def read_report(path):
+    with open(path) as report:
+        return json.load(report)
+
+
+class QueryCounter:
+    """
+    Counts queries on every connection while installed, from any thread.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+def counting_wsgi_app(app, counter):
+    def wrapped(environ, start_response):
+        for connection in connections.all():
+            if counter not in connection.execute_wrappers:
+                connection.execute_wrappers.append(counter)
+        return app(environ, start_response)
+
+    return wrapped
+
+
+def allowed_host():
+    """
+    Return a Host header Django will accept. With DEBUG on and no
+    ALLOWED_HOSTS, only localhost names are allowed.
+    """
+    for host in settings.ALLOWED_HOSTS:
+        if host != "*" and not host.startswith("."):
+            return host
+    return "localhost"
+
+
+def unthrottled():
+    """
+    Turn off rate limits, load shedding and duplicate vote detection, which
+    would otherwise answer most of a benchmark's requests with a 429, 503 or
+    409.
+    """
+    return override_settings(
+        POLLS_RATE_LIMITS={},
+        POLLS_MAX_IN_FLIGHT=None,
+        POLLS_VOTE_DEDUP={"ENABLED": False},
+    )
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class BenchWSGIServer(ThreadedWSGIServer):
+    # The default listen backlog of 10 drops connections from large client
+    # counts before the server gets to accept them.
+    request_queue_size = 1024
+
+
+@contextmanager
+def serve_wsgi(app):
+    """
+    Serve a WSGI app from a threaded server on localhost; yields the port.
+    """
+    server = BenchWSGIServer(("127.0.0.1", 0), QuietRequestHandler)
+    server.set_app(app)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def serve_asgi(app):
+    """
+    Serve an ASGI app with uvicorn on localhost; yields the port.
+    """
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield port
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+class HTTPClient:
+    """
+    Just enough of a browser for benchmarks: keeps cookies and sends the
+    CSRF token with POST requests.
+    """
+
+    csrf_input_re = re.compile(rb'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+    def __init__(self, port):
+        self.port = port
+        self.cookies = SimpleCookie()
+        self.csrf_token = ""
+
+    def request(self, method, path, data=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        headers = {}
+        body = None
+        if self.cookies:
+            headers["Cookie"] = "; ".join(
+                f"{key}={morsel.value}" for key, morsel in self.cookies.items()
+            )
+        if method == "POST":
+            body = urlencode(data or {})
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            headers["X-CSRFToken"] = self.csrf_token
+        elif data:
+            path = f"{path}?{urlencode(data)}"
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+        finally:
+            connection.close()
+        for header in response.headers.get_all("Set-Cookie") or []:
+            self.cookies.load(header)
+        match = self.csrf_input_re.search(content)
+        if match:
+            self.csrf_token = match.group(1).decode()
+        return response.status, content
+
+
+async def http_request(port, method, path, host="localhost"):
+    """
+    Make one HTTP/1.1 request on a new connection and return the status.
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+            "Connection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+    finally:
+        writer.close()
+    return int(status_line.split()[1])
+
+
+def wsgi_request(app, method, path, host="localhost"):
+    """
+    Call a WSGI app with a bodyless request and return the status.
+    """
+    path, _, query = path.partition("?")
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": host,
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": host,
+        "REMOTE_ADDR": "127.0.0.1",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.url_scheme": "http",
+        "wsgi.version": (1, 0),
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    status = []
+    body = app(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        for _ in body:
+            pass
+    finally:
+        body.close()
+    return int(status[0].split()[0])
+
+
+async def asgi_request(app, method, path, host="localhost"):
+    """
+    Call an ASGI app with a bodyless request and return the status.
+    """
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"host", host.encode())],
+        "client": ("127.0.0.1", 0),
+        "server": (host, 80),
+    }
+    received = False
+    status = None
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # Never disconnect; the app cancels this wait when it is done.
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
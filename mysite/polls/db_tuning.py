@@ -0,0 +1,248 @@
+"""
+SQLite tuning and read/write routing.
+
+Every new SQLite connection gets the pragmas in ``POLLS_SQLITE_PRAGMAS``
+(see the connection_created receiver in signals.py). The defaults switch the
+database to WAL, so readers keep reading while a vote is being written, and
+trade some durability (``synchronous = NORMAL``) and memory for speed.
+Connections opened read-only (``mode=ro`` in the NAME URI) skip
+``journal_mode``, which they can't change, and get ``query_only`` instead.
+
+Connection reuse is Django's own ``CONN_MAX_AGE`` and ``CONN_HEALTH_CHECKS``,
+set in ``DATABASES``.
+
+ReadDatabaseRouter sends the reads of views wrapped with
+``read_database_view()`` to one of the replicas in ``POLLS_READ_REPLICAS``
+({alias: weight}), picked per request in proportion to its weight.
+Everything else, and every write, goes to ``default``. With no replicas
+nothing is rerouted.
+
+* A replica that raises a DatabaseError is left out for
+  ``POLLS_REPLICA_RETRY_SECONDS``, and the view is run again against
+  ``default``. The read views don't write, so running them twice is safe.
+* Views wrapped with ``read_your_writes()`` set a cookie when they write
+  to the database or change the session. For
+  ``POLLS_READ_YOUR_WRITES_SECONDS`` afterwards that browser reads from
+  ``default``, so it sees its own vote before the replicas catch up.
+"""
+
+import contextlib
+import functools
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError
+
+logger = logging.getLogger("polls.db")
+
+PRIMARY_COOKIE = "polls_primary_until"
+
+# The replica the current request reads from, if any.
+_read_alias = ContextVar("polls_read_alias", default=None)
+# A list the router appends to on every write, while a read_your_writes()
+# view runs.
+_writes = ContextVar("polls_writes", default=None)
+
+
+def get_pragmas(connection):
+    pragmas = dict(getattr(settings, "POLLS_SQLITE_PRAGMAS", {}))
+    if "mode=ro" in str(connection.settings_dict["NAME"]):
+        pragmas.pop("journal_mode", None)
+        pragmas["query_only"] = "ON"
+    return pragmas
+
+
+def configure_connection(connection):
+    if connection.vendor != "sqlite":
+        return
+    pragmas = get_pragmas(connection)
+    if not pragmas:
+        return
+    # The raw connection, so opening a connection mid-request doesn't count
+    # against the request's query budget.
+    cursor = connection.connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
+
+def get_replicas():
+    return dict(getattr(settings, "POLLS_READ_REPLICAS", {}))
+
+
+def sqlite_path(name):
+    """
+    Return the file path of a SQLite NAME, which may be a file: URI.
+    """
+    name = str(name)
+    if name.startswith("file:"):
+        name = name[len("file:") :].split("?", 1)[0]
+    return name
+
+
+class ReplicaHealth:
+    """
+    Weighted choice between the replicas that haven't failed recently.
+    """
+
+    def __init__(self):
+        self.down_until = {}
+        self.lock = threading.Lock()
+
+    def is_up(self, alias):
+        return self.down_until.get(alias, 0) <= time.monotonic()
+
+    def mark_down(self, alias, seconds):
+        with self.lock:
+            self.down_until[alias] = time.monotonic() + seconds
+
+    def reset(self):
+        with self.lock:
+            self.down_until.clear()
+
+    def choose(self, replicas, rng=random):
+        candidates = [
+            (alias, weight)
+            for alias, weight in replicas.items()
+            if weight > 0 and self.is_up(alias)
+        ]
+        if not candidates:
+            return None
+        aliases, weights = zip(*candidates)
+        return rng.choices(aliases, weights)[0]
+
+
+health = ReplicaHealth()
+
+
+def is_pinned_to_primary(request):
+    try:
+        return float(request.COOKIES.get(PRIMARY_COOKIE, 0)) > time.time()
+    except (AttributeError, ValueError):
+        return False
+
+
+def choose_replica(request):
+    """
+    Return the replica alias request should read from, or None for default.
+    """
+    if is_pinned_to_primary(request):
+        return None
+    return health.choose(get_replicas())
+
+
+def replica_failed(alias, exc):
+    seconds = getattr(settings, "POLLS_REPLICA_RETRY_SECONDS", 30)
+    logger.warning("Read replica %s failed, retrying in %ss: %s", alias, seconds, exc)
+    health.mark_down(alias, seconds)
+
+
+@contextlib.contextmanager
+def use_read_database(alias):
+    token = _read_alias.set(alias)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def read_database_view(view):
+    """
+    Run view with its reads routed to a replica, falling back to default if
+    the replica fails.
+    """
+    if iscoroutinefunction(view):
+
+        async def wrapped(request, *args, **kwargs):
+            alias = choose_replica(request)
+            if alias is not None:
+                try:
+                    with use_read_database(alias):
+                        return await view(request, *args, **kwargs)
+                except DatabaseError as exc:
+                    replica_failed(alias, exc)
+            return await view(request, *args, **kwargs)
+
+    else:
+
+        def wrapped(request, *args, **kwargs):
+            alias = choose_replica(request)
+            if alias is not None:
+                try:
+                    with use_read_database(alias):
+                        return view(request, *args, **kwargs)
+                except DatabaseError as exc:
+                    replica_failed(alias, exc)
+            return view(request, *args, **kwargs)
+
+    return functools.wraps(view)(wrapped)
+
+
+def pin_to_primary(request, response, writes):
+    session = getattr(request, "session", None)
+    if writes or getattr(session, "modified", False):
+        seconds = getattr(settings, "POLLS_READ_YOUR_WRITES_SECONDS", 5)
+        response.set_cookie(
+            PRIMARY_COOKIE,
+            str(int(time.time() + seconds)),
+            max_age=seconds,
+            httponly=True,
+            samesite="Lax",
+        )
+    return response
+
+
+def read_your_writes(view):
+    """
+    Send the browser's reads to default for a while after view writes.
+    """
+    if iscoroutinefunction(view):
+
+        async def wrapped(request, *args, **kwargs):
+            writes = []
+            token = _writes.set(writes)
+            try:
+                response = await view(request, *args, **kwargs)
+            finally:
+                _writes.reset(token)
+            return pin_to_primary(request, response, writes)
+
+    else:
+
+        def wrapped(request, *args, **kwargs):
+            writes = []
+            token = _writes.set(writes)
+            try:
+                response = view(request, *args, **kwargs)
+            finally:
+                _writes.reset(token)
+            return pin_to_primary(request, response, writes)
+
+    return functools.wraps(view)(wrapped)
+
+
+class ReadDatabaseRouter:
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        writes = _writes.get()
+        if writes is not None:
+            writes.append(model)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of default, not migrated on their own.
+        if db in get_replicas():
+            return False
+        return None
@@ -0,0 +1,238 @@
+"""
+Conditional requests and shared caching for the detail and results pages.
+
+Each question has a version: the time in nanoseconds it last changed, kept
+in the ``POLLS_RESULTS_CACHE`` cache next to its tally and set again when
+votes commit or the question or one of its choices is saved or deleted.
+Pages carry an ETag built from it, and a request whose If-None-Match (or,
+for results, If-Modified-Since) still matches gets a 304 before the view
+loads anything from the database or renders a template.
+
+* Results pages are the same for everyone. Anonymous visitors get
+  ``public`` with ``s-maxage`` set to ``SHARED_MAX_AGE``, so a reverse proxy
+  may keep them, and a Last-Modified. Requests with a session cookie get
+  ``private, no-cache``, as the response may refresh that cookie.
+* Detail pages hold a CSRF token and depend on which private polls the
+  visitor has unlocked, so they are always ``private, no-cache`` with
+  ``Vary: Cookie``, and their ETag also covers both.
+
+Cacheable responses name their question in a ``Surrogate-Key`` header, and a
+new version sends ``purge`` with that key so proxies drop their copies.
+ProxyCache is a small caching WSGI middleware that honours both, standing in
+for the real proxy; connect a receiver to ``purge`` to purge a CDN.
+
+Versions are only as shared as the cache holding them: with a per-process
+cache, a process may answer 304 for up to the cache TIMEOUT after a vote
+handled by another one, which is as stale as its tally can be anyway.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
+from django.utils.crypto import salted_hmac
+from django.utils.http import http_date
+
+from .results_cache import get_cache
+from .unlocks import encode_ids
+
+# Sent with a list of surrogate keys whose cached pages are out of date.
+purge = Signal()
+
+SURROGATE_KEY_HEADER = "Surrogate-Key"
+
+
+def get_http_settings():
+    return {
+        "MAX_AGE": 0,
+        "SHARED_MAX_AGE": 300,
+        **getattr(settings, "POLLS_HTTP_CACHE", {}),
+    }
+
+
+def version_key(question_id):
+    return f"polls:version:{question_id}"
+
+
+def surrogate_key(question_id):
+    return f"polls-question-{question_id}"
+
+
+def get_version(question_id):
+    """
+    Return question_id's version, starting a new one if the cache has none.
+    """
+    cache = get_cache()
+    key = version_key(question_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns())
+        version = cache.get(key)
+    return version
+
+
+async def aget_version(question_id):
+    cache = get_cache()
+    key = version_key(question_id)
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(key, time.time_ns())
+        version = await cache.aget(key)
+    return version
+
+
+def bump(question_id):
+    get_cache().set(version_key(question_id), time.time_ns())
+    purge.send(sender=None, keys=[surrogate_key(question_id)])
+
+
+def results_etag(version):
+    return f'"{version:x}"'
+
+
+def detail_etag(request, version, unlocked):
+    variant = salted_hmac(
+        "polls.http_cache",
+        f"{request.META.get('CSRF_COOKIE', '')}\0{encode_ids(unlocked)}",
+    ).hexdigest()[:16]
+    return f'"{version:x}-{variant}"'
+
+
+def has_session(request):
+    return settings.SESSION_COOKIE_NAME in request.COOKIES
+
+
+def patch_results(request, response, question_id, version):
+    config = get_http_settings()
+    response.headers.setdefault("ETag", results_etag(version))
+    response.headers.setdefault("Last-Modified", http_date(version // 10**9))
+    if has_session(request):
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ("Cookie",))
+    else:
+        patch_cache_control(
+            response,
+            public=True,
+            max_age=config["MAX_AGE"],
+            s_maxage=config["SHARED_MAX_AGE"],
+        )
+        response[SURROGATE_KEY_HEADER] = f"polls {surrogate_key(question_id)}"
+    return response
+
+
+def patch_detail(request, response, version, unlocked):
+    response.headers.setdefault("ETag", detail_etag(request, version, unlocked))
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ("Cookie",))
+    return response
+
+
+def results_not_modified(request, question_id, version):
+    response = get_conditional_response(
+        request, etag=results_etag(version), last_modified=version // 10**9
+    )
+    if response is not None:
+        patch_results(request, response, question_id, version)
+    return response
+
+
+def detail_not_modified(request, version, unlocked):
+    response = get_conditional_response(
+        request, etag=detail_etag(request, version, unlocked)
+    )
+    if response is not None:
+        patch_detail(request, response, version, unlocked)
+    return response
+
+
+def shared_max_age(headers):
+    """
+    Return how long a shared cache may keep a response with these headers,
+    or None if it mustn't.
+    """
+    headers = {name.lower(): value for name, value in headers}
+    vary = {v.strip().lower() for v in headers.get("vary", "").split(",")}
+    if "set-cookie" in headers or vary & {"cookie", "*"}:
+        return None
+    directives = {}
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value
+    if "public" not in directives or directives.keys() & {"private", "no-store"}:
+        return None
+    try:
+        return int(directives.get("s-maxage", "")) or None
+    except ValueError:
+        return None
+
+
+class ProxyCache:
+    """
+    Cache an app's public GET responses for their s-maxage, the way a
+    reverse proxy in front of it would, dropping them when ``purge`` names
+    one of their surrogate keys. Responses say whether they were served from
+    the cache in X-Cache.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        purge.connect(self.purge_keys)
+
+    def __call__(self, environ, start_response):
+        if environ["REQUEST_METHOD"] != "GET":
+            return self.app(environ, start_response)
+        url = f"{environ.get('PATH_INFO', '')}?{environ.get('QUERY_STRING', '')}"
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self.entries[url]
+                entry = None
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is not None:
+            _, _, status, headers, body = entry
+            start_response(status, headers + [("X-Cache", "HIT")])
+            return [body]
+
+        captured = []
+        result = self.app(environ, lambda *args: captured.extend(args[:2]))
+        status, headers = captured
+        ttl = shared_max_age(headers) if status.startswith("200") else None
+        if ttl is None:
+            start_response(status, headers + [("X-Cache", "MISS")])
+            return result
+        try:
+            body = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        keys = set()
+        kept = []
+        for name, value in headers:
+            if name.lower() == SURROGATE_KEY_HEADER.lower():
+                keys.update(value.split())
+            else:
+                kept.append((name, value))
+        with self.lock:
+            self.entries[url] = (time.monotonic() + ttl, keys, status, kept, body)
+        start_response(status, kept + [("X-Cache", "MISS")])
+        return [body]
+
+    def purge_keys(self, sender, keys, **kwargs):
+        keys = set(keys)
+        with self.lock:
+            for url, entry in list(self.entries.items()):
+                if entry[1] & keys:
+                    del self.entries[url]
@@ -0,0 +1,130 @@
+"""
+Cached rendering of the index page's question list.
+
+The latest-questions list only changes when a question is published, edited
+or deleted, so its rendered HTML is cached and reused. Fragments are keyed
+by a version number that the Question save/delete signals bump, and by the
+viewer: anonymous visitors all share one entry, while logged-in users get
+their own because the delete links carry their user id. The login header is
+rendered outside the fragment, so it never makes a fragment user-specific.
+
+``aget_fragment()`` is the same for the async views, using the async cache
+and ORM APIs.
+
+A fragment never outlives the next scheduled ``pub_date``: its timeout is
+cut short so questions published ahead of time appear on schedule. Once a
+question's pub_date has passed it no longer caps the timeout: the publishing
+worker (see polls/publishing.py) invalidates the fragments when it puts the
+question up, so fragments don't expire every second while the worker isn't
+running.
+"""
+
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .metrics import CacheStats
+from .models import Question
+
+VERSION_KEY = "polls:index:version"
+
+stats = CacheStats("index")
+
+
+def get_cache():
+    return caches[getattr(settings, "POLLS_INDEX_CACHE", "default")]
+
+
+def get_version(cache):
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Start from the clock rather than 1 so fragments cached under an
+        # evicted version can never be picked up again.
+        cache.add(VERSION_KEY, time.time_ns(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+async def aget_version(cache):
+    version = await cache.aget(VERSION_KEY)
+    if version is None:
+        await cache.aadd(VERSION_KEY, time.time_ns(), None)
+        version = await cache.aget(VERSION_KEY)
+    return version
+
+
+def invalidate():
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, time.time_ns(), None)
+
+
+def viewer_key(user):
+    return f"user:{user.pk}" if user.is_authenticated else "anon"
+
+
+def get_timeout(now=None):
+    """
+    Return how long a fragment rendered now may be cached: the configured
+    timeout, or less if a future question is due to be published sooner.
+    """
+    now = now or timezone.now()
+    return capped_timeout(now, next_pub_dates(now).first())
+
+
+async def aget_timeout(now=None):
+    now = now or timezone.now()
+    return capped_timeout(now, await next_pub_dates(now).afirst())
+
+
+def next_pub_dates(now):
+    return (
+        Question.objects.filter(is_published=False, pub_date__gt=now)
+        .order_by("pub_date")
+        .values_list("pub_date", flat=True)
+    )
+
+
+def capped_timeout(now, next_pub_date):
+    timeout = getattr(settings, "POLLS_INDEX_CACHE_TIMEOUT", 300)
+    if next_pub_date is not None:
+        timeout = min(timeout, math.ceil((next_pub_date - now).total_seconds()))
+    return max(timeout, 1)
+
+
+def get_fragment(user, render):
+    """
+    Return the cached question list for this viewer, calling render() to
+    build it on a miss.
+    """
+    cache = get_cache()
+    key = f"polls:index:{get_version(cache)}:{viewer_key(user)}"
+    html = cache.get(key)
+    if html is not None:
+        stats.incr("hits")
+        return html
+    stats.incr("misses")
+    html = render()
+    cache.set(key, html, get_timeout())
+    return html
+
+
+async def aget_fragment(user, render):
+    """
+    Async get_fragment(); render is a coroutine function.
+    """
+    cache = get_cache()
+    key = f"polls:index:{await aget_version(cache)}:{viewer_key(user)}"
+    html = await cache.aget(key)
+    if html is not None:
+        stats.incr("hits")
+        return html
+    stats.incr("misses")
+    html = await render()
+    await cache.aset(key, html, await aget_timeout())
+    return html
@@ -0,0 +1,48 @@
+"""
+Jinja2 rendering for the polls pages.
+
+With ``POLLS_TEMPLATE_ENGINE = "jinja2"`` the Jinja2 backend below is put
+ahead of the Django one, so the templates under polls/jinja2/ replace their
+Django counterparts; anything without a Jinja2 version, such as the admin
+and login pages, still renders with Django. Jinja2 compiles templates to
+Python functions, which makes long loops noticeably cheaper. It needs the
+jinja2 package, which isn't a requirement otherwise.
+
+The environment provides what the Django templates get from tags and
+filters: ``url()``, ``url_template()``, ``static()``, ``pluralize`` and
+``json_script``. Context processors are configured as for Django, and the
+backend adds ``request``, ``csrf_input`` and ``csrf_token``.
+"""
+
+from django.template.backends import jinja2 as jinja2_backend
+from django.template.defaultfilters import pluralize
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.html import json_script
+from jinja2 import Environment
+
+from .metrics import Template
+from .templatetags.polls_urls import url_template
+
+
+def url(viewname, *args):
+    return reverse(viewname, args=args)
+
+
+def environment(**options):
+    env = Environment(**options)
+    env.globals.update(url=url, url_template=url_template, static=static)
+    env.filters.update(pluralize=pluralize, json_script=json_script)
+    return env
+
+
+class Jinja2(jinja2_backend.Jinja2):
+    """
+    Jinja2, timing each render for polls.metrics.
+    """
+
+    def from_string(self, template_code):
+        return Template(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return Template(super().get_template(template_name))
@@ -0,0 +1,416 @@
+"""
+Live results pushed to browsers with Server-Sent Events.
+
+The ``polls:live`` stream sends a question's full tally when a client
+connects, then a ``delta`` event with the added votes per choice whenever
+votes for it commit. Updates go through a process-wide Hub:
+
+* ``publish()`` may be called from any thread. Increments are merged per
+  question and sent at most ``MAX_UPDATES_PER_SEC`` times a second, so a
+  burst of votes costs subscribers one event instead of one per vote.
+* Each event is encoded once and handed to every subscriber of the
+  question, so fan-out costs one queue put per subscriber.
+* Every subscriber has a queue of ``QUEUE_SIZE`` events. A client that falls
+  that far behind has its backlog dropped and is sent a fresh tally
+  instead, so a slow connection never holds up the others or grows
+  without bound.
+
+``announce()`` sends other events, such as ``published`` when the publishing
+worker puts a scheduled question up (see publishing.py), to a question's
+subscribers as they happen.
+
+The hub runs on the event loop of the first subscriber, which under ASGI
+is the server's loop. With several processes, set ``BROKER`` to the path of
+a Unix socket served by ``manage.py live_broker``: every process then sends
+its votes and events to the broker, which relays them to all processes.
+Sends go through a BrokerSender thread, so a slow broker never holds up the
+request that committed the votes; votes waiting for it are merged per
+question, so a backlog costs one line per question rather than one per vote.
+"""
+
+import asyncio
+import atexit
+import json
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+logger = logging.getLogger("polls.live")
+
+DEFAULTS = {
+    "MAX_UPDATES_PER_SEC": 4,
+    "QUEUE_SIZE": 32,
+    "HEARTBEAT": 15,
+    "RETRY_MS": 5000,
+    "BROKER": None,
+}
+
+# Queued in place of the events a slow subscriber missed.
+RESYNC = object()
+
+# Sent by a process that wants the broker to relay votes to it.
+SUBSCRIBE = b"SUBSCRIBE\n"
+
+# Bytes a broker connection may have waiting to be sent before the broker
+# gives up on it.
+BROKER_WRITE_LIMIT = 1 << 20
+
+
+def get_live_settings():
+    return {**DEFAULTS, **getattr(settings, "POLLS_LIVE", {})}
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def encode_votes(question_id, counts):
+    return json.dumps({"q": question_id, "v": counts}).encode() + b"\n"
+
+
+def encode_event(question_id, event, data):
+    return json.dumps({"q": question_id, "e": event, "d": data}).encode() + b"\n"
+
+
+def decode_votes(line):
+    message = json.loads(line)
+    return message["q"], {int(pk): n for pk, n in message["v"].items()}
+
+
+class Subscriber:
+    def __init__(self, question_id, queue_size):
+        self.question_id = question_id
+        self.queue = asyncio.Queue(queue_size)
+        self.resyncs = 0
+
+    def offer(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            self.resyncs += 1
+
+    async def get(self, timeout=None):
+        """
+        Return the next event, RESYNC, or raise asyncio.TimeoutError.
+        """
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class BrokerSender:
+    """
+    Send votes and events to the live broker from a background thread.
+    Whatever can't be sent is handed to fallback(votes, events), where votes
+    is {question_id: {choice_id: votes}} and events a list of
+    (question_id, event, data).
+    """
+
+    def __init__(self, path, fallback=None):
+        self.path = path
+        self.fallback = fallback
+        self.votes = {}
+        self.events = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._socket = None
+
+    def put_votes(self, question_id, counts):
+        with self._lock:
+            pending = self.votes.setdefault(question_id, {})
+            for pk, n in counts.items():
+                pending[pk] = pending.get(pk, 0) + n
+        self.start()
+        self._wakeup.set()
+
+    def put_event(self, question_id, event, data):
+        with self._lock:
+            self.events.append((question_id, event, data))
+        self.start()
+        self._wakeup.set()
+
+    def flush(self):
+        """
+        Send everything waiting, and return how many lines were sent.
+        """
+        with self._lock:
+            votes, self.votes = self.votes, {}
+            events, self.events = self.events, []
+        lines = [encode_event(*event) for event in events]
+        lines += [encode_votes(question_id, c) for question_id, c in votes.items()]
+        if not lines:
+            return 0
+        try:
+            self.send(b"".join(lines))
+        except OSError as exc:
+            logger.warning("Live broker unavailable: %s", exc)
+            if self.fallback is not None:
+                self.fallback(votes, events)
+            return 0
+        return len(lines)
+
+    def send(self, data):
+        if self._socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(1)
+            try:
+                sock.connect(str(self.path))
+            except OSError:
+                sock.close()
+                raise
+            self._socket = sock
+        try:
+            self._socket.sendall(data)
+        except OSError:
+            self._socket.close()
+            self._socket = None
+            raise
+
+    def start(self):
+        if self._thread is None and not self._stopped.is_set():
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="live-broker-sender", daemon=True
+                    )
+                    self._thread.start()
+                    atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.flush()
+
+
+class Hub:
+    def __init__(self, max_updates_per_sec=4, queue_size=32, broker=None):
+        self.interval = 1 / max_updates_per_sec
+        self.queue_size = queue_size
+        self.broker = broker
+        self.loop = None
+        self.subscribers = defaultdict(set)
+        self.pending = {}
+        self.timers = {}
+        self.last_sent = {}
+        self.listener = None
+        self.sender = None
+        if broker:
+            self.sender = BrokerSender(broker, fallback=self.broker_failed)
+        self._broker_retry_at = 0
+
+    def subscribe(self, question_id):
+        """
+        Register a subscriber for question_id. Must be called from the
+        event loop that will serve it.
+        """
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            if self.loop is not None and not self.loop.is_closed():
+                if any(self.subscribers.values()):
+                    raise RuntimeError("Hub is in use by another event loop.")
+            self.bind(loop)
+        subscriber = Subscriber(question_id, self.queue_size)
+        self.subscribers[question_id].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscribers = self.subscribers.get(subscriber.question_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[subscriber.question_id]
+
+    def bind(self, loop):
+        if self.listener is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.listener.cancel)
+        self.loop = loop
+        self.subscribers.clear()
+        self.pending.clear()
+        self.timers.clear()
+        self.last_sent.clear()
+        self.listener = None
+        if self.broker:
+            self.listener = loop.create_task(self.listen())
+
+    def publish(self, question_id, counts):
+        """
+        Announce committed {choice_id: votes} increments. Safe to call from
+        any thread.
+        """
+        if self.sender and time.monotonic() >= self._broker_retry_at:
+            self.sender.put_votes(question_id, counts)
+        else:
+            self.deliver(question_id, counts)
+
+    def announce(self, question_id, event, data):
+        """
+        Send event to the question's subscribers straight away, rather than
+        merged with votes. Safe to call from any thread.
+        """
+        if self.sender and time.monotonic() >= self._broker_retry_at:
+            self.sender.put_event(question_id, event, data)
+        else:
+            self.call_soon(self.send, question_id, sse_event(event, data))
+
+    def broker_failed(self, votes, events):
+        """
+        Deliver what the broker couldn't take to this process's subscribers,
+        and keep doing so for a second before trying the broker again.
+        """
+        self._broker_retry_at = time.monotonic() + 1
+        for question_id, event, data in events:
+            self.call_soon(self.send, question_id, sse_event(event, data))
+        for question_id, counts in votes.items():
+            self.deliver(question_id, counts)
+
+    def deliver(self, question_id, counts):
+        self.call_soon(self.add, question_id, counts)
+
+    def call_soon(self, callback, *args):
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The loop closed since it was checked.
+            pass
+
+    def send(self, question_id, event):
+        for subscriber in self.subscribers.get(question_id, ()):
+            subscriber.offer(event)
+
+    def receive(self, line):
+        """
+        Handle a line relayed by the broker: votes or an announced event.
+        """
+        message = json.loads(line)
+        if "e" in message:
+            self.send(message["q"], sse_event(message["e"], message["d"]))
+        else:
+            self.add(*decode_votes(line))
+
+    def add(self, question_id, counts):
+        if question_id not in self.subscribers:
+            return
+        pending = self.pending.setdefault(question_id, {})
+        for pk, n in counts.items():
+            pending[pk] = pending.get(pk, 0) + n
+        if question_id in self.timers:
+            return
+        last = self.last_sent.get(question_id)
+        delay = 0 if last is None else last + self.interval - self.loop.time()
+        self.timers[question_id] = self.loop.call_later(
+            max(delay, 0), self.flush, question_id
+        )
+
+    def flush(self, question_id):
+        self.timers.pop(question_id, None)
+        counts = self.pending.pop(question_id, None)
+        subscribers = self.subscribers.get(question_id)
+        if not counts or not subscribers:
+            return
+        self.last_sent[question_id] = self.loop.time()
+        event = sse_event("delta", {"votes": counts})
+        for subscriber in subscribers:
+            subscriber.offer(event)
+
+    async def listen(self):
+        """
+        Feed votes relayed by the broker into this process's subscribers,
+        reconnecting if the broker goes away.
+        """
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(str(self.broker))
+            except OSError as exc:
+                logger.warning("Can't connect to live broker: %s", exc)
+                await asyncio.sleep(1)
+                continue
+            try:
+                writer.write(SUBSCRIBE)
+                while line := await reader.readline():
+                    try:
+                        self.receive(line)
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning("Bad message from live broker: %r", line)
+            finally:
+                writer.close()
+            await asyncio.sleep(1)
+
+
+async def serve_broker(path, ready=None):
+    """
+    Relay every line received on the Unix socket at path to the connections
+    that subscribed by sending SUBSCRIBE first. Subscribers that stop
+    reading are dropped.
+    """
+    subscribers = set()
+
+    async def handle(reader, writer):
+        try:
+            while line := await reader.readline():
+                if line == SUBSCRIBE:
+                    subscribers.add(writer)
+                    continue
+                for subscriber in list(subscribers):
+                    buffered = subscriber.transport.get_write_buffer_size()
+                    if buffered > BROKER_WRITE_LIMIT:
+                        subscribers.discard(subscriber)
+                        subscriber.close()
+                    else:
+                        subscriber.write(line)
+        finally:
+            subscribers.discard(writer)
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle, path=str(path))
+    if ready is not None:
+        ready.set()
+    async with server:
+        await server.serve_forever()
+
+
+_hub = None
+_hub_lock = threading.Lock()
+
+
+def get_hub():
+    global _hub
+    if _hub is None:
+        with _hub_lock:
+            if _hub is None:
+                config = get_live_settings()
+                _hub = Hub(
+                    max_updates_per_sec=config["MAX_UPDATES_PER_SEC"],
+                    queue_size=config["QUEUE_SIZE"],
+                    broker=config["BROKER"],
+                )
+    return _hub
+
+
+def publish(question_id, counts):
+    get_hub().publish(question_id, counts)
+
+
+def announce(question_id, event, data):
+    get_hub().announce(question_id, event, data)
@@ -0,0 +1,210 @@
+import asyncio
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.asgi import get_asgi_application
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from polls import bench
+from polls.models import Question
+from polls.seeding import SeedConfig, seed_polls
+
+MARKER = "[bench_concurrency]"
+ENDPOINTS = ["index", "detail", "results", "search"]
+# "asgi-sync" serves the sync views over ASGI, to show what the async views
+# save over Django running each sync view in a thread.
+URLCONFS = {
+    "wsgi": "mysite.urls",
+    "asgi": "mysite.async_urls",
+    "asgi-sync": "mysite.urls",
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare WSGI worker threads running the sync polls views with the "
+        "ASGI event loop running the async ones, under many concurrent "
+        "clients. Each client makes --requests requests one after another."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=1000)
+        parser.add_argument(
+            "--requests", type=int, default=3, help="Requests per client."
+        )
+        parser.add_argument(
+            "--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS[:3]
+        )
+        parser.add_argument(
+            "--modes", nargs="+", choices=list(URLCONFS), default=["wsgi", "asgi"]
+        )
+        parser.add_argument(
+            "--transport",
+            choices=["inprocess", "server"],
+            default="inprocess",
+            help="Call the handlers directly, or serve them on localhost "
+            "(the asgi server needs uvicorn).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=32,
+            help="WSGI worker threads for the in-process transport.",
+        )
+        parser.add_argument("--questions", type=int, default=1000)
+        parser.add_argument("--output", help="Write results to this JSON file.")
+        parser.add_argument(
+            "--compare", metavar="BASELINE", help="Fail on regressions against it."
+        )
+        parser.add_argument("--threshold", type=float, default=bench.DEFAULT_THRESHOLD)
+
+    @bench.unthrottled()
+    def handle(self, *args, **options):
+        asgi = any(mode.startswith("asgi") for mode in options["modes"])
+        if options["transport"] == "server" and asgi:
+            try:
+                import uvicorn  # noqa: F401
+            except ImportError:
+                raise CommandError("--transport server needs uvicorn for asgi.")
+
+        seed_polls(
+            SeedConfig(
+                questions=options["questions"],
+                text_prefix=f"{MARKER} ",
+                seed=options["questions"],
+            )
+        )
+        question_ids = list(
+            Question.objects.filter(
+                question_text__startswith=MARKER, is_published=True
+            ).values_list("id", flat=True)
+        )
+        # Handlers run on other threads with their own connections; release
+        # this one so SQLite doesn't see it holding the seeded data open.
+        connections.close_all()
+        try:
+            results = {}
+            for mode in options["modes"]:
+                with override_settings(ROOT_URLCONF=URLCONFS[mode]):
+                    for endpoint in options["endpoints"]:
+                        paths = self.paths(endpoint, question_ids)
+                        results[f"{mode}:{endpoint}"] = self.run_mode(
+                            mode, paths, options
+                        )
+        finally:
+            Question.objects.filter(question_text__startswith=MARKER).delete()
+
+        self.print_table(results)
+        meta = {
+            "transport": options["transport"],
+            "clients": options["clients"],
+            "requests": options["requests"],
+            "workers": options["workers"],
+            "questions": options["questions"],
+            "database": connections["default"].vendor,
+            "timestamp": timezone.now().isoformat(),
+            "pid": os.getpid(),
+        }
+        if options["output"]:
+            bench.write_report(options["output"], meta, results)
+            self.stdout.write(f"Wrote {options['output']}")
+        if options["compare"]:
+            regressions = bench.compare(
+                bench.read_report(options["compare"]),
+                {"results": results},
+                options["threshold"],
+            )
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            if regressions:
+                raise CommandError(f"{len(regressions)} performance regression(s).")
+            self.stdout.write(self.style.SUCCESS("No regressions against baseline."))
+
+    def paths(self, endpoint, question_ids):
+        if endpoint == "index":
+            return itertools.repeat(reverse("polls:index"))
+        if endpoint == "search":
+            return itertools.repeat(reverse("polls:search") + "?q=coffee")
+        name = f"polls:{endpoint}"
+        return itertools.cycle([reverse(name, args=(pk,)) for pk in question_ids])
+
+    def run_mode(self, mode, paths, options):
+        host = bench.allowed_host()
+        if options["transport"] == "server":
+            if mode == "wsgi":
+                server = bench.serve_wsgi(WSGIHandler())
+            else:
+                server = bench.serve_asgi(get_asgi_application())
+            with server as port:
+                return asyncio.run(
+                    self.run_clients(
+                        lambda path: bench.http_request(port, "GET", path, host),
+                        paths,
+                        options,
+                    )
+                )
+
+        if mode != "wsgi":
+            app = get_asgi_application()
+            return asyncio.run(
+                self.run_clients(
+                    lambda path: bench.asgi_request(app, "GET", path, host),
+                    paths,
+                    options,
+                )
+            )
+
+        app = WSGIHandler()
+        with ThreadPoolExecutor(options["workers"]) as pool:
+
+            def send(path):
+                loop = asyncio.get_running_loop()
+                return loop.run_in_executor(
+                    pool, bench.wsgi_request, app, "GET", path, host
+                )
+
+            return asyncio.run(self.run_clients(send, paths, options))
+
+    async def run_clients(self, send, paths, options):
+        """
+        Start every client at once and time each request, including any
+        time spent waiting for a worker.
+        """
+        samples = []
+        errors = []
+
+        async def client():
+            for _ in range(options["requests"]):
+                path = next(paths)
+                start = time.perf_counter()
+                try:
+                    status = await send(path)
+                except OSError as exc:
+                    errors.append(type(exc).__name__)
+                    continue
+                samples.append((time.perf_counter() - start) * 1000)
+                if status >= 400:
+                    errors.append(status)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(options["clients"])))
+        elapsed = time.perf_counter() - start
+        if errors:
+            self.stderr.write(
+                f"{len(errors)} failed request(s): {sorted(set(map(str, errors)))}"
+            )
+        return bench.summarize(samples, elapsed, errors=len(errors))
+
+    def print_table(self, results):
+        columns = ["p50_ms", "p95_ms", "p99_ms", "throughput_rps", "errors"]
+        self.stdout.write(f"{'run':<16}" + "".join(f"{c:>16}" for c in columns))
+        for run, summary in results.items():
+            cells = "".join(f"{str(summary.get(c, '-')):>16}" for c in columns)
+            self.stdout.write(f"{run:<16}{cells}")
@@ -0,0 +1,288 @@
+import itertools
+import os
+import threading
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from polls import bench
+from polls.models import Choice, Question
+from polls.seeding import SeedConfig, seed_polls
+
+MARKER = "[bench_http]"
+BENCH_USER = "bench_http_user"
+ENDPOINTS = ["index", "detail", "results", "vote", "search", "access", "delete"]
+
+
+class Fixtures:
+    def __init__(self, questions, iterations):
+        seed_polls(
+            SeedConfig(questions=questions, text_prefix=f"{MARKER} ", seed=questions)
+        )
+        self.user, _ = User.objects.get_or_create(username=BENCH_USER)
+        self.question_ids = list(
+            Question.objects.filter(question_text__startswith=MARKER)
+            .order_by("-pub_date")
+            .values_list("id", flat=True)
+        )
+        self.choice_ids = dict(
+            Choice.objects.filter(question_id__in=self.question_ids)
+            .order_by("question_id", "id")
+            .values_list("question_id", "id")
+        )
+        self.private = Question.objects.create(
+            question_text=f"{MARKER} private",
+            pub_date=timezone.now(),
+            access_code="1234",
+        )
+        self.doomed = Question.objects.bulk_create(
+            Question(
+                question_text=f"{MARKER} delete me",
+                pub_date=timezone.now(),
+                owner=self.user,
+            )
+            for _ in range(iterations * 2)
+        )
+        self.doomed_ids = iter(q.pk for q in self.doomed)
+        self.cycle = itertools.cycle(self.question_ids)
+
+    def request(self, endpoint):
+        """
+        Return (method, path, data) for the next request to endpoint.
+        """
+        pk = next(self.cycle)
+        if endpoint == "index":
+            return "GET", reverse("polls:index"), None
+        if endpoint == "detail":
+            return "GET", reverse("polls:detail", args=(pk,)), None
+        if endpoint == "results":
+            return "GET", reverse("polls:results", args=(pk,)), None
+        if endpoint == "vote":
+            data = {"choice": self.choice_ids[pk]}
+            return "POST", reverse("polls:vote", args=(pk,)), data
+        if endpoint == "search":
+            return "GET", reverse("polls:search"), {"q": "coffee"}
+        if endpoint == "access":
+            data = {"access_code": "1234"}
+            return "POST", reverse("polls:access", args=(self.private.pk,)), data
+        if endpoint == "delete":
+            data = {"user_id": self.user.pk}
+            return "POST", reverse("polls:delete", args=(next(self.doomed_ids),)), data
+        raise ValueError(endpoint)
+
+    def cleanup(self):
+        Question.objects.filter(question_text__startswith=MARKER).delete()
+        self.user.delete()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark every polls endpoint through the test client or a real "
+        "localhost WSGI/ASGI server and report latency percentiles, "
+        "throughput, queries and allocations per request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--transport", choices=["client", "wsgi", "asgi"], default="client"
+        )
+        parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS)
+        parser.add_argument("--iterations", type=int, default=200)
+        parser.add_argument("--warmup", type=int, default=10)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=1,
+            help="Client threads for the wsgi and asgi transports.",
+        )
+        parser.add_argument(
+            "--questions", type=int, default=1000, help="Questions to seed."
+        )
+        parser.add_argument(
+            "--alloc-samples",
+            type=int,
+            default=20,
+            help="Requests per endpoint traced with tracemalloc (0 to skip).",
+        )
+        parser.add_argument("--output", help="Write results to this JSON file.")
+        parser.add_argument(
+            "--compare", metavar="BASELINE", help="Fail on regressions against it."
+        )
+        parser.add_argument("--threshold", type=float, default=bench.DEFAULT_THRESHOLD)
+
+    @bench.unthrottled()
+    def handle(self, *args, **options):
+        if options["transport"] == "asgi":
+            try:
+                import uvicorn  # noqa: F401
+            except ImportError:
+                raise CommandError("--transport asgi needs uvicorn installed.")
+        endpoints = options["endpoints"] or ENDPOINTS
+        total = (options["iterations"] + options["warmup"]) * options["concurrency"]
+        fixtures = Fixtures(options["questions"], total + options["alloc_samples"])
+        try:
+            results = self.run(fixtures, endpoints, options)
+        finally:
+            fixtures.cleanup()
+
+        self.print_table(results)
+        meta = {
+            "transport": options["transport"],
+            "iterations": options["iterations"],
+            "concurrency": options["concurrency"],
+            "questions": options["questions"],
+            "database": connections["default"].vendor,
+            "timestamp": timezone.now().isoformat(),
+            "pid": os.getpid(),
+        }
+        if options["output"]:
+            bench.write_report(options["output"], meta, results)
+            self.stdout.write(f"Wrote {options['output']}")
+        if options["compare"]:
+            regressions = bench.compare(
+                bench.read_report(options["compare"]),
+                {"results": results},
+                options["threshold"],
+            )
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            if regressions:
+                raise CommandError(f"{len(regressions)} performance regression(s).")
+            self.stdout.write(self.style.SUCCESS("No regressions against baseline."))
+
+    def run(self, fixtures, endpoints, options):
+        results = {}
+        if options["transport"] == "client":
+            client = Client(HTTP_HOST=bench.allowed_host())
+            for endpoint in endpoints:
+                results[endpoint] = self.bench_client(
+                    client, fixtures, endpoint, options
+                )
+            return results
+
+        counter = bench.QueryCounter()
+        if options["transport"] == "wsgi":
+            server = bench.serve_wsgi(bench.counting_wsgi_app(WSGIHandler(), counter))
+        else:
+            from django.core.asgi import get_asgi_application
+
+            server = bench.serve_asgi(get_asgi_application())
+        with server as port:
+            for endpoint in endpoints:
+                results[endpoint] = self.bench_server(
+                    port, fixtures, endpoint, options, counter
+                )
+        return results
+
+    def bench_client(self, client, fixtures, endpoint, options):
+        def send():
+            method, path, data = fixtures.request(endpoint)
+            response = getattr(client, method.lower())(path, data)
+            if response.status_code >= 400:
+                raise CommandError(f"{endpoint}: HTTP {response.status_code}")
+
+        for _ in range(options["warmup"]):
+            send()
+        samples = []
+        with CaptureQueriesContext(connections["default"]) as queries:
+            start = time.perf_counter()
+            for _ in range(options["iterations"]):
+                t0 = time.perf_counter()
+                send()
+                samples.append((time.perf_counter() - t0) * 1000)
+            elapsed = time.perf_counter() - start
+        return bench.summarize(
+            samples,
+            elapsed,
+            queries_per_request=round(len(queries) / options["iterations"], 2),
+            alloc_kib_per_request=self.measure_allocations(send, options),
+        )
+
+    def bench_server(self, port, fixtures, endpoint, options, counter):
+        lock = threading.Lock()
+        samples = []
+        errors = []
+
+        def worker(count):
+            client = bench.HTTPClient(port)
+            client.request("GET", reverse("login"))  # pick up a CSRF token
+            for i in range(count):
+                with lock:
+                    method, path, data = fixtures.request(endpoint)
+                t0 = time.perf_counter()
+                status, _ = client.request(method, path, data)
+                took = (time.perf_counter() - t0) * 1000
+                if status >= 400:
+                    errors.append(status)
+                if i >= options["warmup"]:
+                    with lock:
+                        samples.append(took)
+
+        queries_before = counter.count
+        threads = [
+            threading.Thread(
+                target=worker, args=(options["iterations"] + options["warmup"],)
+            )
+            for _ in range(options["concurrency"])
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if errors:
+            self.stderr.write(
+                f"{endpoint}: {len(errors)} failed request(s), statuses "
+                f"{sorted(set(errors))}"
+            )
+        requests = len(threads) * (options["iterations"] + options["warmup"] + 1)
+        # Concurrent writers can fail on SQLite ("database is locked"), so
+        # failures are reported and gated rather than aborting the run.
+        extra = {"errors": len(errors)}
+        if options["transport"] == "wsgi":
+            extra["queries_per_request"] = round(
+                (counter.count - queries_before) / requests, 2
+            )
+        # Warm-up requests overlap the timed ones across threads, so the
+        # throughput counts the whole run.
+        return bench.summarize(samples, elapsed * len(samples) / requests, **extra)
+
+    def measure_allocations(self, send, options):
+        runs = options["alloc_samples"]
+        if not runs:
+            return None
+        tracemalloc.start()
+        try:
+            peaks = []
+            for _ in range(runs):
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                send()
+                peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        finally:
+            tracemalloc.stop()
+        return round(sum(peaks) / runs / 1024, 1)
+
+    def print_table(self, results):
+        columns = [
+            "p50_ms",
+            "p95_ms",
+            "p99_ms",
+            "throughput_rps",
+            "errors",
+            "queries_per_request",
+            "alloc_kib_per_request",
+        ]
+        self.stdout.write(f"{'endpoint':<10}" + "".join(f"{c:>22}" for c in columns))
+        for endpoint, summary in results.items():
+            cells = "".join(f"{str(summary.get(c, '-')):>22}" for c in columns)
+            self.stdout.write(f"{endpoint:<10}{cells}")
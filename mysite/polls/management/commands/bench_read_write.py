@@ -0,0 +1,258 @@
+import itertools
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connections, transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls import bench, index_cache, results_cache
+from polls.models import Choice, Question
+from polls.seeding import SeedConfig, seed_polls
+from polls.voting import record_vote
+
+MARKER = "[bench_read_write]"
+ENDPOINTS = ["index", "detail", "results", "search"]
+
+# Each configuration sets the journal mode, the other pragmas, connection
+# reuse, transaction mode and read routing; "stock" is Django's defaults.
+CONFIGS = {
+    "stock": {
+        "journal_mode": "DELETE",
+        "pragmas": {},
+        "conn_max_age": 0,
+        "transaction_mode": None,
+        "read_replicas": {},
+    },
+    "tuned": {
+        "journal_mode": "WAL",
+        "pragmas": None,
+        "conn_max_age": 60,
+        "transaction_mode": "IMMEDIATE",
+        "read_replicas": {},
+    },
+    "routed": {
+        "journal_mode": "WAL",
+        "pragmas": None,
+        "conn_max_age": 60,
+        "transaction_mode": "IMMEDIATE",
+        "read_replicas": {"read": 1},
+    },
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure read throughput and latency of the polls pages while writer "
+        "threads vote as fast as they can, for stock SQLite settings and "
+        "the tuned ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--configs", nargs="+", choices=list(CONFIGS), default=list(CONFIGS)
+        )
+        parser.add_argument(
+            "--endpoints", nargs="+", choices=ENDPOINTS, default=["detail", "search"]
+        )
+        parser.add_argument("--readers", type=int, default=4)
+        parser.add_argument("--writers", type=int, default=4)
+        parser.add_argument(
+            "--duration", type=float, default=5, help="Seconds per configuration."
+        )
+        parser.add_argument("--questions", type=int, default=2000)
+        parser.add_argument("--output", help="Write results to this JSON file.")
+        parser.add_argument(
+            "--compare", metavar="BASELINE", help="Fail on regressions against it."
+        )
+        parser.add_argument("--threshold", type=float, default=bench.DEFAULT_THRESHOLD)
+
+    @bench.unthrottled()
+    def handle(self, *args, **options):
+        if connections["default"].vendor != "sqlite":
+            raise CommandError("This benchmark is for SQLite.")
+        seed_polls(
+            SeedConfig(
+                questions=options["questions"],
+                text_prefix=f"{MARKER} ",
+                seed=options["questions"],
+            )
+        )
+        questions = Question.objects.filter(
+            question_text__startswith=MARKER,
+            is_published=True,
+            access_code=None,
+        )
+        question_ids = list(questions.values_list("id", flat=True))
+        choice_ids = list(
+            Choice.objects.filter(question__in=questions).values_list("id", flat=True)
+        )
+        saved = {
+            alias: {
+                "CONN_MAX_AGE": connections.settings[alias]["CONN_MAX_AGE"],
+                "OPTIONS": dict(connections.settings[alias]["OPTIONS"]),
+            }
+            for alias in connections.settings
+        }
+        results = {}
+        try:
+            for name in options["configs"]:
+                with self.configured(CONFIGS[name]):
+                    results[name] = self.run(question_ids, choice_ids, options)
+        finally:
+            connections.close_all()
+            for alias, values in saved.items():
+                connections.settings[alias].update(values)
+            Question.objects.filter(question_text__startswith=MARKER).delete()
+
+        self.print_table(results)
+        meta = {
+            "readers": options["readers"],
+            "writers": options["writers"],
+            "duration": options["duration"],
+            "endpoints": options["endpoints"],
+            "questions": options["questions"],
+            "timestamp": timezone.now().isoformat(),
+            "pid": os.getpid(),
+        }
+        if options["output"]:
+            bench.write_report(options["output"], meta, results)
+            self.stdout.write(f"Wrote {options['output']}")
+        if options["compare"]:
+            regressions = bench.compare(
+                bench.read_report(options["compare"]),
+                {"results": results},
+                options["threshold"],
+            )
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            if regressions:
+                raise CommandError(f"{len(regressions)} performance regression(s).")
+            self.stdout.write(self.style.SUCCESS("No regressions against baseline."))
+
+    def configured(self, config):
+        """
+        Apply a configuration to connections opened from now on.
+        """
+        connections.close_all()
+        for alias in connections.settings:
+            db = connections.settings[alias]
+            db["CONN_MAX_AGE"] = config["conn_max_age"]
+            db["OPTIONS"].pop("transaction_mode", None)
+            if config["transaction_mode"] and "mode=ro" not in str(db["NAME"]):
+                db["OPTIONS"]["transaction_mode"] = config["transaction_mode"]
+        # The journal mode is stored in the database file. Switching it needs
+        # the database to itself, so it's done here rather than by every
+        # connection the benchmark opens.
+        with connections["default"].cursor() as cursor:
+            cursor.execute(f"PRAGMA journal_mode = {config['journal_mode']}")
+        connections.close_all()
+        pragmas = config["pragmas"]
+        if pragmas is None:
+            pragmas = dict(settings.POLLS_SQLITE_PRAGMAS)
+            pragmas.pop("journal_mode", None)
+        return override_settings(
+            POLLS_SQLITE_PRAGMAS=pragmas, POLLS_READ_REPLICAS=config["read_replicas"]
+        )
+
+    def paths(self, endpoints, question_ids):
+        paths = []
+        for endpoint, pk in zip(itertools.cycle(endpoints), question_ids):
+            if endpoint == "index":
+                paths.append(reverse("polls:index"))
+            elif endpoint == "search":
+                paths.append(reverse("polls:search") + "?q=coffee")
+            else:
+                paths.append(reverse(f"polls:{endpoint}", args=(pk,)))
+        return paths
+
+    def run(self, question_ids, choice_ids, options):
+        index_cache.get_cache().clear()
+        results_cache.get_cache().clear()
+        stop = threading.Event()
+        lock = threading.Lock()
+        samples = []
+        counts = {"writes": 0, "write_errors": 0, "read_errors": 0}
+        paths = self.paths(options["endpoints"], question_ids)
+
+        def count(name):
+            with lock:
+                counts[name] += 1
+
+        def writer(seed):
+            rng = random.Random(seed)
+            try:
+                while not stop.is_set():
+                    try:
+                        with transaction.atomic():
+                            record_vote(rng.choice(choice_ids))
+                        count("writes")
+                    except OperationalError:
+                        count("write_errors")
+            finally:
+                connections.close_all()
+
+        def reader(seed):
+            client = Client(HTTP_HOST=bench.allowed_host())
+            rng = random.Random(seed)
+            try:
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    try:
+                        status = client.get(rng.choice(paths)).status_code
+                    except OperationalError:
+                        count("read_errors")
+                        continue
+                    took = (time.perf_counter() - start) * 1000
+                    if status >= 400:
+                        count("read_errors")
+                    else:
+                        with lock:
+                            samples.append(took)
+            finally:
+                connections.close_all()
+
+        threads = [
+            threading.Thread(target=writer, args=(i,))
+            for i in range(options["writers"])
+        ] + [
+            threading.Thread(target=reader, args=(1000 + i,))
+            for i in range(options["readers"])
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(options["duration"])
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return bench.summarize(
+            samples,
+            elapsed,
+            errors=counts["read_errors"],
+            writes_per_sec=round(counts["writes"] / elapsed, 1),
+            write_errors=counts["write_errors"],
+        )
+
+    def print_table(self, results):
+        columns = [
+            "p50_ms",
+            "p95_ms",
+            "p99_ms",
+            "throughput_rps",
+            "errors",
+            "writes_per_sec",
+            "write_errors",
+        ]
+        self.stdout.write(f"{'config':<8}" + "".join(f"{c:>16}" for c in columns))
+        for name, summary in results.items():
+            cells = "".join(f"{str(summary.get(c, '-')):>16}" for c in columns)
+            self.stdout.write(f"{name:<8}{cells}")
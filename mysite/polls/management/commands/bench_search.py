@@ -0,0 +1,62 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from polls.models import Question
+from polls.search import get_search_backend
+from polls.seeding import SeedConfig, seed_polls
+
+MARKER = "[bench_search]"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare LIKE and indexed search latency as the question table grows. "
+        "Benchmark rows are removed afterwards unless --keep is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+        )
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--backend", default="auto")
+        parser.add_argument("--keep", action="store_true")
+
+    def handle(self, *args, **options):
+        like = get_search_backend("like")
+        indexed = get_search_backend(options["backend"])
+        queries = ["coffee", "python django", "wint", "keyboard laptop phone"]
+
+        self.stdout.write(
+            f"{'rows':>10} {'query':>24} {'like ms':>10} {indexed.name + ' ms':>10}"
+        )
+        inserted = 0
+        try:
+            for size in sorted(options["sizes"]):
+                config = SeedConfig(
+                    questions=size - inserted,
+                    choices_min=1,
+                    choices_max=1,
+                    text_prefix=f"{MARKER} ",
+                    seed=size,
+                )
+                inserted += seed_polls(config)["questions"]
+                for query in queries:
+                    like_ms = self.time(like, query, options["repeat"])
+                    indexed_ms = self.time(indexed, query, options["repeat"])
+                    self.stdout.write(
+                        f"{size:>10} {query:>24} {like_ms:>10.2f} {indexed_ms:>10.2f}"
+                    )
+        finally:
+            if not options["keep"]:
+                Question.objects.filter(question_text__startswith=MARKER).delete()
+
+    def time(self, backend, query, repeat):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            backend.search(query)
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
@@ -0,0 +1,205 @@
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import quote
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.urls import reverse
+from django.utils import timezone
+
+from polls import bench
+from polls.models import Question
+from polls.security_log import SecurityQueueHandler
+from polls.seeding import SeedConfig, seed_polls
+
+MARKER = "[bench_security_log]"
+MODES = ["none", "sync", "async", "async-sample"]
+INJECTION = "' OR '1'='1"
+
+
+class FsyncFileHandler(logging.FileHandler):
+    def flush(self):
+        super().flush()
+        if self.stream is not None:
+            os.fsync(self.stream.fileno())
+
+
+def logging_app(app, logger, events):
+    """
+    Log events security records per request before handing it to app, as
+    the search and delete views do with security logging enabled.
+    """
+
+    def wrapped(environ, start_response):
+        for _ in range(events):
+            logger.warning(
+                "Potential SQL injection attempt: %s",
+                INJECTION,
+                extra={"ip": environ.get("REMOTE_ADDR")},
+            )
+        return app(environ, start_response)
+
+    return wrapped
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure request latency while every request logs security events, "
+        "with no handler, a plain FileHandler, and the queued security "
+        "handler (see polls/security_log.py)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+        parser.add_argument("--requests", type=int, default=3000)
+        parser.add_argument("--workers", type=int, default=16)
+        parser.add_argument(
+            "--events", type=int, default=5, help="Security events per request."
+        )
+        parser.add_argument(
+            "--fsync",
+            action="store_true",
+            help="fsync after each write, as a durable audit log would.",
+        )
+        parser.add_argument("--queue-size", type=int, default=10000)
+        parser.add_argument("--output", help="Write results to this JSON file.")
+        parser.add_argument(
+            "--compare", metavar="BASELINE", help="Fail on regressions against it."
+        )
+        parser.add_argument("--threshold", type=float, default=bench.DEFAULT_THRESHOLD)
+
+    @bench.unthrottled()
+    def handle(self, *args, **options):
+        seed_polls(SeedConfig(questions=50, text_prefix=f"{MARKER} ", seed=50))
+        question_ids = list(
+            Question.objects.filter(question_text__startswith=MARKER).values_list(
+                "id", flat=True
+            )
+        )
+        connections.close_all()
+        search = reverse("polls:search") + "?q=" + quote(INJECTION)
+        paths = [search] + [
+            reverse("polls:delete", args=(pk,)) + "?user_id=0" for pk in question_ids
+        ]
+        logger = logging.getLogger("polls.bench.security")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        results = {}
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                for mode in options["modes"]:
+                    path = Path(tmp) / f"{mode}.log"
+                    handler = self.make_handler(mode, path, options)
+                    logger.addHandler(handler)
+                    try:
+                        results[mode] = self.run(
+                            logging_app(WSGIHandler(), logger, options["events"]),
+                            itertools.cycle(paths),
+                            options,
+                        )
+                    finally:
+                        logger.removeHandler(handler)
+                        handler.close()
+                    lines, events = self.count_events(path)
+                    results[mode]["lines_written"] = lines
+                    results[mode]["events_written"] = events
+                    results[mode]["dropped"] = getattr(handler, "dropped", 0)
+        finally:
+            Question.objects.filter(question_text__startswith=MARKER).delete()
+
+        self.print_table(results)
+        meta = {
+            "requests": options["requests"],
+            "workers": options["workers"],
+            "events": options["events"],
+            "fsync": options["fsync"],
+            "timestamp": timezone.now().isoformat(),
+            "pid": os.getpid(),
+        }
+        if options["output"]:
+            bench.write_report(options["output"], meta, results)
+            self.stdout.write(f"Wrote {options['output']}")
+        if options["compare"]:
+            regressions = bench.compare(
+                bench.read_report(options["compare"]),
+                {"results": results},
+                options["threshold"],
+            )
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            if regressions:
+                raise CommandError(f"{len(regressions)} performance regression(s).")
+            self.stdout.write(self.style.SUCCESS("No regressions against baseline."))
+
+    def make_handler(self, mode, path, options):
+        if mode == "none":
+            return logging.NullHandler()
+        if mode == "sync":
+            handler_class = (
+                FsyncFileHandler if options["fsync"] else logging.FileHandler
+            )
+            return handler_class(path)
+        return SecurityQueueHandler(
+            path,
+            queue_size=options["queue_size"],
+            policy="sample" if mode == "async-sample" else "drop",
+            fsync=options["fsync"],
+        )
+
+    def count_events(self, path):
+        """
+        Return the lines in the log at path, and the events they stand for
+        once deduplicated counts are added up.
+        """
+        if not path.exists():
+            return 0, 0
+        lines = events = 0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    events += json.loads(line).get("count", 1)
+                except ValueError:
+                    events += 1
+        return lines, events
+
+    def run(self, app, paths, options):
+        host = bench.allowed_host()
+
+        def request(path):
+            start = time.perf_counter()
+            status = bench.wsgi_request(app, "GET", path, host)
+            return (time.perf_counter() - start) * 1000, status
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options["workers"]) as pool:
+            outcomes = list(
+                pool.map(request, itertools.islice(paths, options["requests"]))
+            )
+        elapsed = time.perf_counter() - start
+        samples = [took for took, _ in outcomes]
+        errors = sum(1 for _, status in outcomes if status >= 400)
+        return bench.summarize(samples, elapsed, errors=errors)
+
+    def print_table(self, results):
+        columns = [
+            "p50_ms",
+            "p95_ms",
+            "p99_ms",
+            "throughput_rps",
+            "errors",
+            "lines_written",
+            "events_written",
+            "dropped",
+        ]
+        self.stdout.write(f"{'mode':<14}" + "".join(f"{c:>15}" for c in columns))
+        for mode, summary in results.items():
+            cells = "".join(f"{str(summary.get(c, '-')):>15}" for c in columns)
+            self.stdout.write(f"{mode:<14}{cells}")
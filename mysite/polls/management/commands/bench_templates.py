@@ -0,0 +1,234 @@
+import os
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+from django.template import TemplateDoesNotExist, engines
+from django.template.backends.django import DjangoTemplates
+from django.test import RequestFactory
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from polls import bench
+from polls.models import Choice, Question
+from polls.results_cache import summarize
+
+TEMPLATES = [
+    "polls/index.html",
+    "polls/index_questions.html",
+    "polls/detail.html",
+    "polls/results.html",
+    "polls/search_form.html",
+    "polls/search_results.html",
+    "polls/access.html",
+    "polls/delete_confirm.html",
+]
+ENGINES = ["django", "django-uncached", "jinja2"]
+
+
+def build_contexts(size):
+    """
+    Return {template name: context} for pages listing size questions or
+    choices. Nothing is saved, so rendering never touches the database.
+    """
+    now = timezone.now()
+    owner = User(pk=1, username="owner")
+    questions = [
+        Question(
+            pk=pk,
+            question_text=f"Question {pk}: what's your favourite?",
+            pub_date=now,
+            owner=owner,
+        )
+        for pk in range(1, size + 1)
+    ]
+    question = questions[0]
+    choices = [
+        Choice(pk=pk, question=question, choice_text=f"Choice {pk}", votes=pk)
+        for pk in range(1, size + 1)
+    ]
+    # What prefetch_related("choice_set") leaves behind.
+    choice_set = Choice.objects.all()
+    choice_set._result_cache = choices
+    choice_set._prefetch_done = True
+    question._prefetched_objects_cache = {"choice_set": choice_set}
+    results = summarize([(c.pk, c.choice_text, c.votes) for c in choices])
+    return {
+        "polls/index.html": {"question_list_html": mark_safe("<ul></ul>")},
+        "polls/index_questions.html": {"latest_question_list": questions},
+        "polls/detail.html": {"question": question},
+        "polls/results.html": {"question": question, "results": results},
+        "polls/search_form.html": {"search_query": "favourite"},
+        "polls/search_results.html": {
+            "search_query": "favourite",
+            "questions": questions,
+            "page": SimpleNamespace(has_next=True, next_cursor="abc"),
+        },
+        "polls/access.html": {"question": question},
+        "polls/delete_confirm.html": {"question": question, "user_id": 1},
+    }
+
+
+def django_engine():
+    for engine in engines.all():
+        if isinstance(engine, DjangoTemplates):
+            return engine
+    raise CommandError("No DjangoTemplates engine is configured.")
+
+
+def make_engine(name):
+    if name == "django":
+        return django_engine()
+    if name == "django-uncached":
+        configured = django_engine()
+        return DjangoTemplates(
+            {
+                "NAME": "bench-uncached",
+                "DIRS": configured.dirs,
+                "APP_DIRS": False,
+                "OPTIONS": {
+                    "context_processors": configured.engine.context_processors,
+                    "loaders": [
+                        "django.template.loaders.filesystem.Loader",
+                        "django.template.loaders.app_directories.Loader",
+                    ],
+                },
+            }
+        )
+    try:
+        from polls.jinja_env import Jinja2
+    except ImportError:
+        raise CommandError("The jinja2 engine needs jinja2 installed.")
+    return Jinja2(
+        {
+            "NAME": "bench-jinja2",
+            "DIRS": [],
+            "APP_DIRS": True,
+            "OPTIONS": {
+                "environment": "polls.jinja_env.environment",
+                "context_processors": django_engine().engine.context_processors,
+            },
+        }
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Render every polls template with 5, 500 and 5,000 questions or choices "
+        "through each template engine, and report render time and allocations. "
+        "Each render looks the template up first, as a view does."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--engines", nargs="+", choices=ENGINES)
+        parser.add_argument("--templates", nargs="+", choices=TEMPLATES)
+        parser.add_argument("--sizes", type=int, nargs="+", default=[5, 500, 5000])
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--warmup", type=int, default=2)
+        parser.add_argument(
+            "--alloc-samples",
+            type=int,
+            default=3,
+            help="Renders per case traced with tracemalloc (0 to skip).",
+        )
+        parser.add_argument("--output", help="Write results to this JSON file.")
+        parser.add_argument(
+            "--compare", metavar="BASELINE", help="Fail on regressions against it."
+        )
+        parser.add_argument("--threshold", type=float, default=bench.DEFAULT_THRESHOLD)
+
+    def handle(self, *args, **options):
+        names = options["engines"]
+        if names is None:
+            names = ENGINES[:2]
+            try:
+                import jinja2  # noqa: F401
+            except ImportError:
+                self.stderr.write("jinja2 isn't installed; skipping that engine.")
+            else:
+                names.append("jinja2")
+        request = RequestFactory().get("/polls/", HTTP_HOST=bench.allowed_host())
+        request.user = AnonymousUser()
+        results = {}
+        for size in options["sizes"]:
+            contexts = build_contexts(size)
+            for name in names:
+                engine = make_engine(name)
+                for template_name in options["templates"] or TEMPLATES:
+                    try:
+                        engine.get_template(template_name)
+                    except TemplateDoesNotExist:
+                        continue
+
+                    def render():
+                        template = engine.get_template(template_name)
+                        return template.render(dict(contexts[template_name]), request)
+
+                    key = f"{name}:{template_name.removeprefix('polls/')}:{size}"
+                    results[key] = self.measure(render, options)
+
+        self.print_table(results)
+        meta = {
+            "sizes": options["sizes"],
+            "iterations": options["iterations"],
+            "debug": settings.DEBUG,
+            "timestamp": timezone.now().isoformat(),
+            "pid": os.getpid(),
+        }
+        if options["output"]:
+            bench.write_report(options["output"], meta, results)
+            self.stdout.write(f"Wrote {options['output']}")
+        if options["compare"]:
+            regressions = bench.compare(
+                bench.read_report(options["compare"]),
+                {"results": results},
+                options["threshold"],
+            )
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            if regressions:
+                raise CommandError(f"{len(regressions)} performance regression(s).")
+            self.stdout.write(self.style.SUCCESS("No regressions against baseline."))
+
+    def measure(self, render, options):
+        for _ in range(options["warmup"]):
+            render()
+        samples = []
+        start = time.perf_counter()
+        for _ in range(options["iterations"]):
+            t0 = time.perf_counter()
+            html = render()
+            samples.append((time.perf_counter() - t0) * 1000)
+        elapsed = time.perf_counter() - start
+        return bench.summarize(
+            samples,
+            elapsed,
+            html_kib=round(len(html) / 1024, 1),
+            alloc_kib_per_render=self.measure_allocations(render, options),
+        )
+
+    def measure_allocations(self, render, options):
+        runs = options["alloc_samples"]
+        if not runs:
+            return None
+        tracemalloc.start()
+        try:
+            peaks = []
+            for _ in range(runs):
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                render()
+                peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        finally:
+            tracemalloc.stop()
+        return round(sum(peaks) / runs / 1024, 1)
+
+    def print_table(self, results):
+        columns = ["p50_ms", "p95_ms", "mean_ms", "html_kib", "alloc_kib_per_render"]
+        self.stdout.write(f"{'case':<42}" + "".join(f"{c:>22}" for c in columns))
+        for case, summary in results.items():
+            cells = "".join(f"{str(summary.get(c, '-')):>22}" for c in columns)
+            self.stdout.write(f"{case:<42}{cells}")
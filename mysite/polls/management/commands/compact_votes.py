@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from polls.voting import compact_votes
+
+
+class Command(BaseCommand):
+    help = "Fold sharded vote counters back into Choice.votes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Keep running and compact every INTERVAL seconds.",
+        )
+
+    def handle(self, *args, **options):
+        interval = options["interval"]
+        while True:
+            folded = compact_votes()
+            self.stdout.write(f"Compacted {folded} vote(s).")
+            if interval <= 0:
+                break
+            time.sleep(interval)
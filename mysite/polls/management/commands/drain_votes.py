@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from polls.vote_buffer import get_buffer_settings, replay_orphaned_journals
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply votes left in the write-behind vote journals of processes that "
+        "are no longer running to the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--journal",
+            help="Journal file to drain (defaults to POLLS_VOTE_BUFFER['JOURNAL']).",
+        )
+
+    def handle(self, *args, **options):
+        journal = options["journal"] or get_buffer_settings()["JOURNAL"]
+        if not journal:
+            self.stdout.write("No vote journal is configured.")
+            return
+        drained = replay_orphaned_journals(journal)
+        self.stdout.write(f"Drained {drained} vote(s) from {journal}.")
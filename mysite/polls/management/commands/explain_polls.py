@@ -0,0 +1,118 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models.query import RawQuerySet
+from django.utils import timezone
+
+from polls.index_cache import next_pub_dates
+from polls.models import Choice, Question
+from polls.search import get_search_backend
+from polls.views import DetailView, IndexView, ResultsView
+
+
+def polls_queries():
+    """
+    Return (label, queryset) pairs for the queries each polls view runs,
+    using the newest question as the example row.
+    """
+    question = Question.objects.order_by("-pub_date", "-id").first()
+    pk = question.pk if question else 0
+    owner_id = question.owner_id if question and question.owner_id else 0
+    search = get_search_backend()
+    return [
+        ("index: latest questions", IndexView().get_queryset()),
+        (
+            "index: next scheduled question",
+            next_pub_dates(timezone.now())[:1],
+        ),
+        (
+            "publish_questions: due within the lookahead",
+            Question.objects.filter(is_published=False, pub_date__lte=timezone.now())
+            .order_by("pub_date", "pk")
+            .values_list("pub_date", "pk"),
+        ),
+        ("detail: question", DetailView().get_queryset().filter(pk=pk)),
+        (
+            "detail: choices",
+            Choice.objects.filter(question_id__in=[pk]).only(
+                "question_id", "choice_text"
+            ),
+        ),
+        ("results: question", ResultsView().get_queryset().filter(pk=pk)),
+        ("results: tally", Choice.objects.filter(question_id=pk).order_by("id")),
+        ("vote: choice", Choice.objects.filter(question_id=pk, pk=1)),
+        ("delete: owner's questions", Question.objects.filter(owner_id=owner_id)),
+        (
+            f"search ({search.name}): keyset page",
+            search.fetch_after("poll", 21, None, True),
+        ),
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the query plan of every query the polls views run and flag "
+        "full table scans and temporary sorts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--benchmark",
+            type=int,
+            default=0,
+            metavar="N",
+            help="Also time each query over N runs.",
+        )
+
+    def handle(self, *args, **options):
+        flagged = 0
+        for label, query in polls_queries():
+            plan = self.explain(query)
+            problems = [line for line in plan if self.is_problem(line)]
+            flagged += bool(problems)
+            style = self.style.WARNING if problems else self.style.SUCCESS
+            self.stdout.write(style(f"{label}: {'SCAN' if problems else 'ok'}"))
+            for line in plan:
+                self.stdout.write(f"    {line}")
+            if options["benchmark"]:
+                self.stdout.write(
+                    f"    median {self.time(query, options['benchmark']):.3f} ms"
+                )
+        if flagged:
+            self.stdout.write(
+                self.style.WARNING(f"{flagged} query plan(s) scan a table.")
+            )
+
+    def explain(self, query):
+        if isinstance(query, RawQuerySet):
+            prefix = (
+                "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + query.raw_query, query.params)
+                return [str(row[-1]) for row in cursor.fetchall()]
+        return query.explain().splitlines()
+
+    def is_problem(self, line):
+        line = line.upper()
+        if connection.vendor == "sqlite":
+            # "SCAN t" reads the whole table; "SCAN t USING INDEX" walks an
+            # index in order and stops at the LIMIT.
+            scan = (
+                "SCAN " in line and "USING" not in line and "VIRTUAL TABLE" not in line
+            )
+            return scan or "USE TEMP B-TREE" in line
+        return "SEQ SCAN" in line
+
+    def time(self, query, runs):
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            if isinstance(query, RawQuerySet):
+                list(query.iterator())
+            else:
+                list(query.iterator(chunk_size=100))
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from polls.transfer import DEFAULT_CHUNK_SIZE, FORMATS, export_lines
+
+
+class Command(BaseCommand):
+    help = (
+        "Export every question with its choices and vote totals as NDJSON or "
+        "CSV, reading the tables in chunks. See polls/transfer.py for the formats."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=FORMATS, default="ndjson")
+        parser.add_argument(
+            "--output", help="Write to this file instead of standard output."
+        )
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        lines = export_lines(options["format"], options["chunk_size"])
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8", newline="") as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending="")
@@ -0,0 +1,76 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.transfer import (
+    DEFAULT_CHUNK_SIZE,
+    FORMATS,
+    READERS,
+    InvalidRecord,
+    import_records,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Import questions with their choices and vote totals from NDJSON or "
+        "CSV written by export_polls. Rows with IDs are upserted, so an import "
+        "can safely be run again. See polls/transfer.py."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import, or - for standard input.")
+        parser.add_argument(
+            "--format",
+            choices=FORMATS,
+            help="Defaults to csv for .csv files and ndjson otherwise.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help="Questions per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or ("csv" if path.endswith(".csv") else "ndjson")
+        start = time.perf_counter()
+
+        def progress(totals):
+            rate = totals["questions"] / (time.perf_counter() - start)
+            self.stdout.write(
+                f"{totals['questions']:>12,} questions "
+                f"{totals['choices']:>12,} choices ({rate:,.0f} questions/sec)"
+            )
+
+        f = sys.stdin if path == "-" else open(path, encoding="utf-8", newline="")
+        try:
+            totals = import_records(
+                READERS[format](f),
+                options["batch_size"],
+                progress if options["verbosity"] > 1 else None,
+            )
+        except InvalidRecord as e:
+            raise CommandError(
+                f"{e} Batches before it were imported; fix the file and run "
+                "the import again."
+            )
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {totals['questions']:,} questions and "
+                f"{totals['choices']:,} choices in {elapsed:.1f}s."
+            )
+        )
+        if totals["unknown_owners"]:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"{totals['unknown_owners']:,} owner(s) didn't match a "
+                    "username; their questions were imported without an owner."
+                )
+            )
@@ -0,0 +1,31 @@
+import asyncio
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.live import get_live_settings, serve_broker
+
+
+class Command(BaseCommand):
+    help = "Relay live results updates between the processes serving polls."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--socket",
+            help="Unix socket to listen on (defaults to POLLS_LIVE['BROKER']).",
+        )
+
+    def handle(self, *args, **options):
+        path = options["socket"] or get_live_settings()["BROKER"]
+        if not path:
+            raise CommandError("No broker socket given or configured.")
+        if os.path.exists(path):
+            os.unlink(path)
+        self.stdout.write(f"Relaying live results on {path}.")
+        try:
+            asyncio.run(serve_broker(path))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
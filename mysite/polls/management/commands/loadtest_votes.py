@@ -0,0 +1,80 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from polls.models import Choice, Question
+from polls.voting import compact_votes, record_vote
+
+
+def legacy_vote(choice_id):
+    choice = Choice.objects.get(pk=choice_id)
+    choice.votes += 1
+    choice.save()
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer a single choice from several threads and report lost votes "
+        "and votes/sec for each vote counting strategy."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--votes", type=int, default=250, help="Votes per thread.")
+        parser.add_argument("--shards", type=int, default=8)
+        parser.add_argument("--keep", action="store_true", help="Keep the test poll.")
+
+    def handle(self, *args, **options):
+        question = Question.objects.create(
+            question_text="Vote load test", pub_date=timezone.now()
+        )
+        choice = Choice.objects.create(question=question, choice_text="Hot choice")
+        strategies = [
+            ("read-modify-write", legacy_vote, 0),
+            ("atomic F()", record_vote, 0),
+            (f"sharded x{options['shards']}", record_vote, options["shards"]),
+        ]
+        try:
+            for label, func, shards in strategies:
+                Choice.objects.filter(pk=choice.pk).update(votes=0)
+                with override_settings(POLLS_VOTE_SHARDS=shards):
+                    self.run_strategy(label, func, choice.pk, options)
+        finally:
+            if not options["keep"]:
+                question.delete()
+
+    def run_strategy(self, label, func, choice_id, options):
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(options["votes"]):
+                    try:
+                        func(choice_id)
+                    except OperationalError as exc:
+                        errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options["threads"])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        compact_votes([choice_id])
+        expected = options["threads"] * options["votes"] - len(errors)
+        counted = Choice.objects.filter(pk=choice_id).values_list("votes", flat=True)[0]
+        lost = expected - counted
+        self.stdout.write(
+            f"{label:>20}: {counted}/{expected} counted, {lost} lost, "
+            f"{len(errors)} failed, {expected / elapsed:,.0f} votes/sec"
+        )
+        if lost:
+            self.stdout.write(self.style.WARNING(f"{label} lost {lost} vote(s)"))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from polls.publishing import get_scheduler
+
+
+class Command(BaseCommand):
+    help = (
+        "Publish questions as their pub_date comes, invalidating caches and "
+        "notifying live subscribers. See polls/publishing.py."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Publish the questions already due and exit.",
+        )
+
+    def handle(self, *args, **options):
+        scheduler = get_scheduler()
+        if options["once"]:
+            published = scheduler.tick()
+            self.stdout.write(f"Published {len(published)} question(s).")
+            return
+        scheduler.run(
+            on_publish=lambda published: self.stdout.write(
+                f"Published question(s) {', '.join(map(str, published))}."
+            )
+        )
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from polls.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the question search index from polls_question."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--backend",
+            help="Search backend to rebuild (defaults to POLLS_SEARCH_BACKEND).",
+        )
+
+    def handle(self, *args, **options):
+        backend = get_search_backend(options["backend"])
+        backend.rebuild()
+        self.stdout.write(f"Rebuilt the {backend.name!r} search index.")
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from polls.vote_history import apply_retention, roll_up
+
+
+class Command(BaseCommand):
+    help = (
+        "Count new vote events into the minute, hour and day rollups, then "
+        "delete events and buckets past their retention. See "
+        "polls/vote_history.py."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Keep running and roll up every INTERVAL seconds.",
+        )
+        parser.add_argument("--batch-size", type=int, help="Events per transaction.")
+
+    def handle(self, *args, **options):
+        interval = options["interval"]
+        while True:
+            counted = roll_up(options["batch_size"])
+            deleted = apply_retention()
+            self.stdout.write(
+                f"Rolled up {counted} event(s); deleted {deleted} expired row(s)."
+            )
+            if interval <= 0:
+                break
+            time.sleep(interval)
@@ -0,0 +1,97 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.seeding import WORDS, SeedConfig, seed_polls
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate synthetic questions, choices, owners and vote counts for "
+        "benchmarks. See polls/seeding.py for the distributions used."
+    )
+
+    def add_arguments(self, parser):
+        defaults = SeedConfig()
+        parser.add_argument("--questions", type=int, default=defaults.questions)
+        parser.add_argument("--choices-min", type=int, default=defaults.choices_min)
+        parser.add_argument("--choices-max", type=int, default=defaults.choices_max)
+        parser.add_argument(
+            "--owners",
+            type=int,
+            default=defaults.owners,
+            help="Number of generated owner accounts (0 leaves questions unowned).",
+        )
+        parser.add_argument(
+            "--access-code-ratio", type=float, default=defaults.access_code_ratio
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=defaults.days,
+            help="Spread past pub_dates over this many days.",
+        )
+        parser.add_argument(
+            "--future-ratio",
+            type=float,
+            default=defaults.future_ratio,
+            help="Fraction of questions scheduled in the future.",
+        )
+        parser.add_argument("--future-days", type=int, default=defaults.future_days)
+        parser.add_argument(
+            "--votes-mean",
+            type=float,
+            default=defaults.votes_mean,
+            help="Average votes per question (Pareto distributed).",
+        )
+        parser.add_argument(
+            "--vote-skew",
+            type=float,
+            default=defaults.vote_skew,
+            help="Zipf exponent for how votes split over a question's choices.",
+        )
+        parser.add_argument("--text-prefix", default=defaults.text_prefix)
+        parser.add_argument(
+            "--history-days",
+            type=int,
+            default=defaults.history_days,
+            help="Also write every vote as a vote event within this many days "
+            "(0 for none); run rollup_votes afterwards.",
+        )
+        parser.add_argument("--batch-size", type=int, default=defaults.batch_size)
+        parser.add_argument("--seed", type=int, default=defaults.seed)
+
+    def handle(self, *args, **options):
+        config = SeedConfig(
+            **{
+                name: options[name]
+                for name in SeedConfig.__dataclass_fields__
+                if name in options
+            }
+        )
+        if not 1 <= config.choices_min <= config.choices_max:
+            raise CommandError("Need 1 <= --choices-min <= --choices-max.")
+        if config.choices_max > len(WORDS):
+            raise CommandError(
+                f"--choices-max can't be more than {len(WORDS)}, the number of "
+                "words choice texts are drawn from."
+            )
+
+        start = time.perf_counter()
+
+        def progress(created):
+            rate = created["questions"] / (time.perf_counter() - start)
+            self.stdout.write(
+                f"{created['questions']:>12,} questions "
+                f"{created['choices']:>12,} choices ({rate:,.0f} questions/sec)"
+            )
+
+        created = seed_polls(config, progress if options["verbosity"] > 1 else None)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {created['questions']:,} questions, "
+                f"{created['choices']:,} choices, {created['votes']:,} votes and "
+                f"{created['vote_events']:,} vote events in {elapsed:.1f}s."
+            )
+        )
@@ -0,0 +1,46 @@
+import os
+import sqlite3
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from polls.db_tuning import get_replicas, sqlite_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the default SQLite database over the local replica files, "
+        "standing in for replication when running with POLLS_SQLITE_REPLICAS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "aliases", nargs="*", help="Replicas to refresh; all of them by default."
+        )
+
+    def handle(self, *args, **options):
+        if connections["default"].vendor != "sqlite":
+            raise CommandError("Only SQLite replicas can be copied locally.")
+        source = sqlite_path(connections["default"].settings_dict["NAME"])
+        aliases = options["aliases"] or list(get_replicas())
+        if not aliases:
+            raise CommandError("No replicas configured in POLLS_READ_REPLICAS.")
+        for alias in aliases:
+            if alias not in connections.settings:
+                raise CommandError(f"Unknown database alias {alias!r}.")
+            target = sqlite_path(connections.settings[alias]["NAME"])
+            if os.path.abspath(target) == os.path.abspath(source):
+                self.stdout.write(f"{alias}: same file as default, skipped")
+                continue
+            connections[alias].close()
+            src = sqlite3.connect(source)
+            dst = sqlite3.connect(target)
+            try:
+                src.backup(dst)
+                # Read-only connections can't open a WAL database whose
+                # shared-memory file doesn't exist yet.
+                dst.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                dst.close()
+                src.close()
+            self.stdout.write(f"{alias}: copied to {target}")
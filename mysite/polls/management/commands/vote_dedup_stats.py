@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from polls.vote_dedup import build_deduplicator
+
+
+class Command(BaseCommand):
+    help = (
+        "Load the duplicate vote filters from the snapshot and receipts, as a "
+        "new process would, and print each poll's voters, memory and "
+        "estimated false positive rate. See polls/vote_dedup.py."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=20,
+            help="Polls to list, largest filters first; 0 lists all.",
+        )
+
+    def handle(self, *args, **options):
+        deduplicator = build_deduplicator(flush_interval_ms=0)
+        deduplicator.start()
+        rows = deduplicator.report()
+        self.stdout.write(
+            f"{'poll':>10} {'voters':>10} {'slices':>6} {'bytes':>12} {'fp rate':>10}"
+        )
+        for row in rows[: options["limit"] or None]:
+            self.stdout.write(
+                f"{row['question_id']:>10} {row['voters']:>10} {row['slices']:>6} "
+                f"{row['bytes']:>12} {row['false_positive_rate']:>10.2e}"
+            )
+        self.stdout.write(
+            f"{len(rows)} poll(s), {sum(row['voters'] for row in rows)} voter(s), "
+            f"{sum(row['bytes'] for row in rows)} bytes of filters."
+        )
@@ -0,0 +1,575 @@
+"""
+Per-request performance metrics, served in the Prometheus text format.
+
+MetricsMiddleware records, for each request, labelled by the view's URL
+name: wall time, the number and total time of database queries, time spent
+rendering templates, response size, and the cache lookups made. Query
+counts and times come from an execute_wrapper on every connection, and
+render times from the DjangoTemplates backend subclass below, which
+``TEMPLATES`` uses.
+
+Histograms and counters keep one set of numbers per thread, so recording
+never takes a lock; the per-thread numbers are added up when scraped.
+
+``/metrics`` returns this process's numbers. With
+``POLLS_METRICS["MULTIPROCESS_DIR"]`` set, every process also publishes a
+snapshot to its own mmap'd file there, at most every ``PUBLISH_INTERVAL``
+seconds, and ``/metrics`` adds up the files of all processes. Snapshots
+are written under a sequence number, so a reader never sees one half
+written. Files are kept after their process exits, so counters never go
+backwards; clear the directory when restarting the whole server.
+
+With ``SLOW_REQUEST_MS`` set, a sampler thread records the stack of each
+request that has been running longer than that, every
+``SAMPLE_INTERVAL_MS``. The last ``MAX_PROFILES`` slow requests are served
+as collapsed stacks (the input format of flamegraph.pl) at
+``/metrics/profiles``.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import Counter as Tally
+from collections import deque
+from contextlib import ExitStack
+from contextvars import ContextVar
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends import django as django_backend
+
+DEFAULTS = {
+    "ALLOWED_IPS": ["127.0.0.1", "::1"],
+    "MULTIPROCESS_DIR": None,
+    "PUBLISH_INTERVAL": 1.0,
+    "SLOW_REQUEST_MS": None,
+    "SAMPLE_INTERVAL_MS": 5,
+    "MAX_PROFILES": 50,
+}
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES = (0, 1, 2, 3, 4, 5, 8, 10, 15, 20, 30, 50, 100)
+BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# The metrics of the request being handled, if any.
+_current = ContextVar("polls_request_metrics", default=None)
+
+
+def get_metrics_settings():
+    return {**DEFAULTS, **getattr(settings, "POLLS_METRICS", {})}
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, registry=None):
+        self.name = name
+        self.help = help
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).append(self)
+
+    def shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            # Only taken once per thread.
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def series(self):
+        """
+        Return {labels: values} summed over all threads.
+        """
+        totals = {}
+        for shard in list(self._shards):
+            for labels, values in list(shard.items()):
+                total = totals.get(labels)
+                if total is None:
+                    totals[labels] = list(values)
+                else:
+                    for i, value in enumerate(values):
+                        total[i] += value
+        return totals
+
+    def snapshot(self):
+        return {
+            "type": self.type,
+            "help": self.help,
+            "series": [
+                [list(labels), values] for labels, values in self.series().items()
+            ],
+        }
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels, amount=1):
+        shard = self.shard()
+        values = shard.get(labels)
+        if values is None:
+            shard[labels] = [amount]
+        else:
+            values[0] += amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets, registry=None):
+        super().__init__(name, help, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        shard = self.shard()
+        values = shard.get(labels)
+        if values is None:
+            # A count per bucket, one for +Inf, then the sum.
+            values = shard[labels] = [0] * (len(self.buckets) + 2)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def snapshot(self):
+        return {**super().snapshot(), "buckets": list(self.buckets)}
+
+
+REGISTRY = []
+
+REQUESTS = Counter("polls_requests_total", "Requests by view and status.")
+DURATION = Histogram(
+    "polls_request_duration_seconds", "Wall time of each request.", SECONDS
+)
+DB_QUERIES = Histogram(
+    "polls_db_queries_per_request", "Database queries run per request.", QUERIES
+)
+DB_DURATION = Histogram(
+    "polls_db_duration_seconds", "Time spent in database queries per request.", SECONDS
+)
+TEMPLATE_DURATION = Histogram(
+    "polls_template_render_seconds",
+    "Time spent rendering templates per request.",
+    SECONDS,
+)
+RESPONSE_SIZE = Histogram(
+    "polls_response_size_bytes", "Size of non-streaming response bodies.", BYTES
+)
+CACHE_EVENTS = Counter(
+    "polls_cache_events_total", "Cache hits, misses and updates by cache."
+)
+VIEW_CACHE_EVENTS = Counter(
+    "polls_view_cache_events_total", "Cache hits and misses by view and cache."
+)
+
+
+class CacheStats:
+    """
+    Hit, miss and update counts for one of the polls caches.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+        CACHE_EVENTS.inc((("cache", self.cache), ("event", name)))
+        request = _current.get()
+        if request is not None:
+            request.cache_events[(self.cache, name)] += 1
+
+    def as_dict(self):
+        return {"hits": self.hits, "misses": self.misses, "updates": self.updates}
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.thread_id = threading.get_ident()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.rendering = 0
+        self.cache_events = Tally()
+        self.samples = Tally()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_seconds += time.perf_counter() - start
+
+
+def record(request, response, metrics):
+    match = request.resolver_match
+    view = match.view_name if match else "<unresolved>"
+    labels = (("view", view),)
+    REQUESTS.inc(labels + (("status", str(response.status_code)),))
+    DURATION.observe(labels, time.perf_counter() - metrics.start)
+    DB_QUERIES.observe(labels, metrics.queries)
+    DB_DURATION.observe(labels, metrics.db_seconds)
+    TEMPLATE_DURATION.observe(labels, metrics.template_seconds)
+    if not response.streaming:
+        RESPONSE_SIZE.observe(labels, len(response.content))
+    for (cache, event), n in metrics.cache_events.items():
+        VIEW_CACHE_EVENTS.inc(labels + (("cache", cache), ("event", event)), n)
+    return view
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        sampler = get_sampler()
+        if sampler is not None:
+            sampler.start_request(metrics)
+        try:
+            with self.timing(metrics):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+            if sampler is not None:
+                sampler.finish_request(metrics, request)
+        record(request, response, metrics)
+        publish_if_due()
+        return response
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        sampler = get_sampler()
+        if sampler is not None:
+            sampler.start_request(metrics)
+        # Queries run in the request's sync thread; see QueryBudgetMiddleware.
+        timing = await sync_to_async(self.timing)(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(timing.__exit__)(None, None, None)
+            _current.reset(token)
+            if sampler is not None:
+                sampler.finish_request(metrics, request)
+        record(request, response, metrics)
+        publish_if_due()
+        return response
+
+    def timing(self, metrics):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(metrics))
+        return stack
+
+
+class Template:
+    """
+    A backend template that adds its render time to the current request's.
+    """
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return self.template.render(context, request)
+        metrics.rendering += 1
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics.rendering -= 1
+            # Templates rendered while rendering another are already timed.
+            if not metrics.rendering:
+                metrics.template_seconds += time.perf_counter() - start
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    def from_string(self, template_code):
+        return Template(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return Template(super().get_template(template_name))
+
+
+def collapse(frame, limit=64):
+    stack = []
+    while frame is not None and len(stack) < limit:
+        code = frame.f_code
+        stack.append(f"{Path(code.co_filename).name}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class SlowRequestSampler:
+    def __init__(self, threshold, interval, max_profiles=50):
+        self.threshold = threshold
+        self.interval = interval
+        self.active = {}
+        self.profiles = deque(maxlen=max_profiles)
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def start_request(self, metrics):
+        self.active[id(metrics)] = metrics
+        if self.thread is None:
+            with self._lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run, name="polls-metrics-sampler", daemon=True
+                    )
+                    self.thread.start()
+
+    def finish_request(self, metrics, request):
+        self.active.pop(id(metrics), None)
+        if metrics.samples:
+            match = request.resolver_match
+            self.profiles.append(
+                {
+                    "view": match.view_name if match else "<unresolved>",
+                    "path": request.path,
+                    "seconds": round(time.perf_counter() - metrics.start, 3),
+                    "samples": dict(metrics.samples),
+                }
+            )
+
+    def sample(self):
+        now = time.perf_counter()
+        frames = None
+        for metrics in list(self.active.values()):
+            if now - metrics.start < self.threshold:
+                continue
+            if frames is None:
+                frames = sys._current_frames()
+            frame = frames.get(metrics.thread_id)
+            if frame is not None:
+                metrics.samples[collapse(frame)] += 1
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler():
+    global _sampler
+    config = get_metrics_settings()
+    if config["SLOW_REQUEST_MS"] is None:
+        return None
+    if _sampler is None:
+        with _sampler_lock:
+            if _sampler is None:
+                _sampler = SlowRequestSampler(
+                    config["SLOW_REQUEST_MS"] / 1000,
+                    config["SAMPLE_INTERVAL_MS"] / 1000,
+                    config["MAX_PROFILES"],
+                )
+    return _sampler
+
+
+class MmapSnapshot:
+    """
+    A JSON snapshot in a memory-mapped file, written under a sequence
+    number that is odd while a write is in progress.
+    """
+
+    HEADER = struct.Struct("<QI")
+
+    def __init__(self, path, size=1 << 16):
+        self.path = Path(path)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = max(size, os.fstat(fd).st_size, self.HEADER.size)
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        sequence, _ = self.HEADER.unpack_from(self.map, 0)
+        self.sequence = sequence + sequence % 2
+
+    def write(self, payload):
+        self.sequence += 1
+        self.HEADER.pack_into(self.map, 0, self.sequence, 0)
+        needed = self.HEADER.size + len(payload)
+        if needed > len(self.map):
+            self.map.resize(max(needed, 2 * len(self.map)))
+        self.map[self.HEADER.size : needed] = payload
+        self.sequence += 1
+        self.HEADER.pack_into(self.map, 0, self.sequence, len(payload))
+
+    def close(self):
+        self.map.close()
+
+
+def read_snapshot(path, attempts=100):
+    """
+    Return the JSON snapshot in the file at path, or None if it is empty or
+    kept changing while being read.
+    """
+    with open(path, "rb") as f:
+        for _ in range(attempts):
+            try:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None
+            with view:
+                sequence, length = MmapSnapshot.HEADER.unpack_from(view, 0)
+                payload = view[MmapSnapshot.HEADER.size :][:length]
+                again, _ = MmapSnapshot.HEADER.unpack_from(view, 0)
+            if sequence % 2 == 0 and sequence == again and len(payload) == length:
+                return json.loads(payload) if length else None
+            time.sleep(0)
+    return None
+
+
+def snapshot(registry=None):
+    return {metric.name: metric.snapshot() for metric in registry or REGISTRY}
+
+
+_published = {"file": None, "path": None, "at": 0.0}
+_publish_lock = threading.Lock()
+
+
+def publish(directory):
+    path = Path(directory) / f"polls-metrics-{os.getpid()}.mmap"
+    with _publish_lock:
+        if _published["path"] != path:
+            # First publish, or a fork of a process that had published.
+            _published["file"] = MmapSnapshot(path)
+            _published["path"] = path
+        _published["file"].write(json.dumps(snapshot()).encode())
+        _published["at"] = time.monotonic()
+
+
+def publish_if_due():
+    config = get_metrics_settings()
+    directory = config["MULTIPROCESS_DIR"]
+    if directory and time.monotonic() - _published["at"] >= config["PUBLISH_INTERVAL"]:
+        publish(directory)
+
+
+def merge(snapshots):
+    merged = {}
+    for snap in snapshots:
+        for name, metric in snap.items():
+            target = merged.setdefault(name, {**metric, "series": {}})
+            for labels, values in metric["series"]:
+                key = tuple(tuple(pair) for pair in labels)
+                total = target["series"].get(key)
+                if total is None:
+                    target["series"][key] = list(values)
+                else:
+                    for i, value in enumerate(values):
+                        total[i] += value
+    return merged
+
+
+def collect():
+    """
+    Return this process's metrics, or every process's when they share a
+    MULTIPROCESS_DIR.
+    """
+    directory = get_metrics_settings()["MULTIPROCESS_DIR"]
+    if not directory:
+        return merge([snapshot()])
+    publish(directory)
+    snapshots = []
+    for path in sorted(Path(directory).glob("polls-metrics-*.mmap")):
+        snap = read_snapshot(path)
+        if snap is not None:
+            snapshots.append(snap)
+    return merge(snapshots)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+def number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(merged):
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, values in sorted(metric["series"].items()):
+            if metric["type"] == "counter":
+                lines.append(f"{name}{format_labels(labels)} {number(values[0])}")
+                continue
+            cumulative = 0
+            bounds = [*map(number, metric["buckets"]), "+Inf"]
+            for bound, count in zip(bounds, values):
+                cumulative += count
+                bucket_labels = format_labels(labels + (("le", bound),))
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {number(values[-1])}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def allowed(request):
+    return request.META.get("REMOTE_ADDR") in get_metrics_settings()["ALLOWED_IPS"]
+
+
+def metrics_view(request):
+    if not allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        render(collect()), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def profiles_view(request):
+    """
+    The stacks sampled from recent slow requests, one "stack count" line
+    each, with the view and path as the outermost frames.
+    """
+    if not allowed(request):
+        return HttpResponseForbidden()
+    sampler = get_sampler()
+    lines = []
+    for profile in list(sampler.profiles) if sampler else []:
+        prefix = f"{profile['view']};{profile['path']}"
+        for stack, count in profile["samples"].items():
+            lines.append(f"{prefix};{stack} {count}")
+    return HttpResponse("\n".join(lines) + "\n", content_type="text/plain")
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0003_question_access_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChoiceVoteShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('choice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vote_shards', to='polls.choice')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('choice', 'shard'), name='unique_choice_vote_shard')],
+            },
+        ),
+    ]
@@ -0,0 +1,81 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE polls_question_fts USING fts5(
+        question_text,
+        content='polls_question',
+        content_rowid='id',
+        prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER polls_question_fts_insert AFTER INSERT ON polls_question BEGIN
+        INSERT INTO polls_question_fts(rowid, question_text)
+        VALUES (new.id, new.question_text);
+    END
+    """,
+    """
+    CREATE TRIGGER polls_question_fts_delete AFTER DELETE ON polls_question BEGIN
+        INSERT INTO polls_question_fts(polls_question_fts, rowid, question_text)
+        VALUES ('delete', old.id, old.question_text);
+    END
+    """,
+    """
+    CREATE TRIGGER polls_question_fts_update AFTER UPDATE OF question_text
+    ON polls_question BEGIN
+        INSERT INTO polls_question_fts(polls_question_fts, rowid, question_text)
+        VALUES ('delete', old.id, old.question_text);
+        INSERT INTO polls_question_fts(rowid, question_text)
+        VALUES (new.id, new.question_text);
+    END
+    """,
+    "INSERT INTO polls_question_fts(polls_question_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS polls_question_fts_update",
+    "DROP TRIGGER IF EXISTS polls_question_fts_delete",
+    "DROP TRIGGER IF EXISTS polls_question_fts_insert",
+    "DROP TABLE IF EXISTS polls_question_fts",
+]
+
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS polls_question_text_trgm "
+    "ON polls_question USING gin (question_text gin_trgm_ops)",
+]
+
+POSTGRES_REVERSE = ["DROP INDEX IF EXISTS polls_question_text_trgm"]
+
+
+def sqlite_has_fts5(schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def run(statements_by_vendor):
+    def operation(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        if vendor == "sqlite" and not sqlite_has_fts5(schema_editor):
+            # Search falls back to the LIKE backend without the index.
+            return
+        for statement in statements_by_vendor.get(vendor, []):
+            schema_editor.execute(statement)
+
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0004_choicevoteshard'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({"sqlite": SQLITE_FORWARD, "postgresql": POSTGRES_FORWARD}),
+            run({"sqlite": SQLITE_REVERSE, "postgresql": POSTGRES_REVERSE}),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0006_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoteEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('at', models.IntegerField()),
+                ('question_id', models.IntegerField()),
+                ('choice_id', models.IntegerField()),
+                ('count', models.IntegerField(default=1)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VoteRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('question_id', models.IntegerField()),
+                ('resolution', models.IntegerField()),
+                ('bucket', models.IntegerField()),
+                ('choice_id', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['resolution', 'bucket'], name='polls_r_retention_idx')],
+                'constraints': [models.UniqueConstraint(fields=('question_id', 'resolution', 'bucket', 'choice_id'), name='unique_vote_rollup')],
+            },
+        ),
+        migrations.CreateModel(
+            name='VoteRollupCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_event_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
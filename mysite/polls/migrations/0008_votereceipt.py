@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0007_vote_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoteReceipt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('question_id', models.IntegerField()),
+                ('voter', models.BigIntegerField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('question_id', 'voter'), name='unique_vote_receipt')],
+            },
+        ),
+    ]
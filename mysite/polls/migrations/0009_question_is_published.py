@@ -0,0 +1,54 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:20
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def add_is_published(apps, schema_editor):
+    Question = apps.get_model('polls', 'Question')
+    if schema_editor.connection.vendor == 'sqlite':
+        # Django would rebuild the table to add a NOT NULL column, dropping
+        # the search triggers of 0005; SQLite can add this one in place.
+        schema_editor.execute(
+            'ALTER TABLE polls_question ADD COLUMN is_published bool DEFAULT 0 NOT NULL'
+        )
+    else:
+        schema_editor.add_field(Question, Question._meta.get_field('is_published'))
+    Question.objects.filter(pub_date__lte=timezone.now()).update(is_published=True)
+
+
+def remove_is_published(apps, schema_editor):
+    Question = apps.get_model('polls', 'Question')
+    schema_editor.remove_field(Question, Question._meta.get_field('is_published'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0008_votereceipt'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name='question',
+                    name='is_published',
+                    field=models.BooleanField(default=False),
+                ),
+            ],
+        ),
+        migrations.RunPython(add_is_published, remove_is_published),
+        migrations.RemoveIndex(
+            model_name='question',
+            name='polls_q_index_page_idx',
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(condition=models.Q(('is_published', True)), fields=['-pub_date', 'id', 'owner', 'question_text', 'is_published'], name='polls_q_published_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(condition=models.Q(('is_published', False)), fields=['pub_date'], name='polls_q_scheduled_idx'),
+        ),
+    ]
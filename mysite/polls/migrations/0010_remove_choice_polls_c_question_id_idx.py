@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0009_question_is_published'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='choice',
+            name='polls_c_question_id_idx',
+        ),
+    ]
@@ -1,6 +1,7 @@
 import datetime
 
 from django.db import models
+from django.db.models import Sum
 from django.utils import timezone
 from django.contrib.auth.models import User
 
@@ -11,6 +12,10 @@ from django.contrib.auth.models import User
 class Question(models.Model):
     question_text = models.CharField(max_length=200)
     pub_date = models.DateTimeField("date published")
+    # Whether pub_date has come, kept up to date by save() and the
+    # publish_questions worker (see polls/publishing.py) so read paths
+    # filter on a flag rather than the clock.
+    is_published = models.BooleanField(default=False)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     # Flaw 4: Cryptographic Failure A02
     # Storing sensitive information in plaintext
@@ -18,11 +23,40 @@ class Question(models.Model):
     # Fix 4: Use password hashing
     # access_code = models.CharField(max_length=120, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # Index, detail and results pages filter and sort on pub_date;
+            # search pages by (pub_date, id).
+            models.Index(fields=["-pub_date", "id"], name="polls_q_pub_date_id_idx"),
+            # Covers the columns the index page reads so the latest
+            # published questions come straight out of the index. SQLite
+            # only counts it as covering with is_published among them.
+            models.Index(
+                fields=["-pub_date", "id", "owner", "question_text", "is_published"],
+                condition=models.Q(is_published=True),
+                name="polls_q_published_idx",
+            ),
+            # Questions still to be published, in the order they're due,
+            # for the publishing worker and the index cache timeout.
+            models.Index(
+                fields=["pub_date"],
+                condition=models.Q(is_published=False),
+                name="polls_q_scheduled_idx",
+            ),
+        ]
+
     # def save(self, *args, **kwargs):
     #    if self.access_code:
     #        self.access_code = make_password(self.access_code)
     #    super().save(*args, **kwargs)
 
+    def save(self, *args, **kwargs):
+        self.is_published = self.pub_date <= timezone.now()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "pub_date" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "is_published"}
+        super().save(*args, **kwargs)
+
     def was_published_recently(self):
         now = timezone.now()
         return now - datetime.timedelta(days=1) <= self.pub_date <= now
@@ -40,5 +74,106 @@ class Choice(models.Model):
     choice_text = models.CharField(max_length=200)
     votes = models.IntegerField(default=0)
 
+    def total_votes(self):
+        """
+        Return the compacted vote count plus any votes still held in
+        sharded counters that haven't been folded back into `votes` yet.
+        """
+        pending = self.vote_shards.aggregate(total=Sum("count"))["total"]
+        return self.votes + (pending or 0)
+
     def __str__(self):
         return self.choice_text
+
+
+class ChoiceVoteShard(models.Model):
+    """
+    One of N counter rows for a Choice. Spreading increments over several
+    rows keeps concurrent votes on a hot choice from serializing on a
+    single row; the shards are summed on read and periodically compacted
+    into Choice.votes.
+    """
+
+    choice = models.ForeignKey(
+        Choice, on_delete=models.CASCADE, related_name="vote_shards"
+    )
+    shard = models.PositiveSmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["choice", "shard"], name="unique_choice_vote_shard"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.choice} [shard {self.shard}]"
+
+
+class VoteEvent(models.Model):
+    """
+    Votes for one choice within one second, appended as they commit (see
+    polls/vote_history.py). Rows are plain integers, with no foreign keys
+    or secondary indexes to maintain, and are only read in primary key
+    order by the rollup.
+    """
+
+    # Unix time, in seconds.
+    at = models.IntegerField()
+    question_id = models.IntegerField()
+    choice_id = models.IntegerField()
+    count = models.IntegerField(default=1)
+
+
+class VoteRollup(models.Model):
+    """
+    Votes for one choice in one minute, hour or day bucket.
+    """
+
+    question_id = models.IntegerField()
+    # Bucket width in seconds: 60, 3600 or 86400.
+    resolution = models.IntegerField()
+    # Unix time the bucket starts at.
+    bucket = models.IntegerField()
+    choice_id = models.IntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also the index trend queries read.
+            models.UniqueConstraint(
+                fields=["question_id", "resolution", "bucket", "choice_id"],
+                name="unique_vote_rollup",
+            )
+        ]
+        indexes = [
+            # Retention drops old buckets of a resolution.
+            models.Index(fields=["resolution", "bucket"], name="polls_r_retention_idx"),
+        ]
+
+
+class VoteRollupCursor(models.Model):
+    """
+    The last VoteEvent counted into VoteRollup; a single row.
+    """
+
+    last_event_id = models.BigIntegerField(default=0)
+
+
+class VoteReceipt(models.Model):
+    """
+    A voter who has voted on a question, by the hash polls/vote_dedup.py
+    keys its filters with.
+    """
+
+    question_id = models.IntegerField()
+    voter = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            # Also the index exact duplicate checks read.
+            models.UniqueConstraint(
+                fields=["question_id", "voter"], name="unique_vote_receipt"
+            )
+        ]
@@ -0,0 +1,177 @@
+"""
+Scheduled publication of questions.
+
+A question is shown once its pub_date has come. Rather than compare every
+pub_date with the clock on every request, Question.is_published records it,
+so the index, detail and vote pages filter on an indexed flag:
+
+* ``Question.save()`` sets the flag from pub_date, as do bulk imports and
+  seeding. A question published right away needs nothing else.
+* ``manage.py publish_questions`` runs a Scheduler for the questions
+  published ahead of time. It keeps a min-heap of (pub_date, id) for the
+  unpublished questions due within ``LOOKAHEAD`` seconds, sleeps until the
+  earliest is due and flips it with a conditional UPDATE, so a question
+  rescheduled or deleted since it was loaded is left alone. Every
+  ``RELOAD_INTERVAL`` seconds it rebuilds the heap, which picks up
+  questions scheduled since; one scheduled less than that ahead of its
+  pub_date can go live up to ``RELOAD_INTERVAL`` seconds late. The reload
+  also takes down questions whose pub_date was moved back into the future
+  by a queryset update(), which skips save().
+* Every question the worker puts up or takes down sends
+  ``publication_changed``. Its receiver invalidates the index fragments and
+  the question's HTTP cache version, and pushes a ``published`` event to
+  the live stream of a question that went live.
+
+Until the worker flips a question it isn't shown, so deployments that
+schedule questions must run it. Its cache invalidation and live events
+reach the web processes through a shared cache and the live broker;
+without a shared cache, other processes show the question once their index
+fragments expire, at most ``POLLS_INDEX_CACHE_TIMEOUT`` seconds later.
+"""
+
+import datetime
+import heapq
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Question
+from .signals import publication_changed
+
+DEFAULTS = {
+    "LOOKAHEAD": 3600,
+    "RELOAD_INTERVAL": 5,
+}
+
+
+def get_publishing_settings():
+    return {**DEFAULTS, **getattr(settings, "POLLS_PUBLISHING", {})}
+
+
+def flip(questions, published):
+    """
+    Set is_published on questions, a queryset of those to change, and
+    return their IDs in pub_date order. publication_changed is sent for
+    each, in that order, once committed.
+    """
+    with transaction.atomic():
+        ids = list(
+            questions.select_for_update()
+            .order_by("pub_date", "pk")
+            .values_list("pk", flat=True)
+        )
+        if ids:
+            Question.objects.filter(pk__in=ids).update(is_published=published)
+            for pk in ids:
+                transaction.on_commit(
+                    lambda pk=pk: publication_changed.send(
+                        sender=Question, question_id=pk, published=published
+                    )
+                )
+    return ids
+
+
+def publish(question_ids, now=None):
+    """
+    Publish those of question_ids whose pub_date has come, and return
+    their IDs.
+    """
+    now = now or timezone.now()
+    return flip(
+        Question.objects.filter(
+            pk__in=question_ids, is_published=False, pub_date__lte=now
+        ),
+        True,
+    )
+
+
+def unpublish_future(now=None):
+    """
+    Take down published questions whose pub_date is still to come, and
+    return their IDs.
+    """
+    now = now or timezone.now()
+    return flip(Question.objects.filter(is_published=True, pub_date__gt=now), False)
+
+
+class Scheduler:
+    def __init__(self, lookahead=3600, reload_interval=5):
+        self.lookahead = datetime.timedelta(seconds=lookahead)
+        self.reload_interval = reload_interval
+        self.heap = []
+        self.reloaded_at = None
+
+    def reload(self, now=None):
+        """
+        Rebuild the heap from the questions due within the lookahead, and
+        return how many there are.
+        """
+        now = now or timezone.now()
+        unpublish_future(now)
+        self.heap = [
+            (pub_date, pk)
+            for pub_date, pk in Question.objects.filter(
+                is_published=False, pub_date__lte=now + self.lookahead
+            )
+            .order_by("pub_date", "pk")
+            .values_list("pub_date", "pk")
+        ]
+        # Already sorted, which is a valid heap.
+        self.reloaded_at = now
+        return len(self.heap)
+
+    def publish_due(self, now=None):
+        """
+        Publish every question in the heap whose pub_date has come, and
+        return their IDs.
+        """
+        now = now or timezone.now()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[1])
+        return publish(due, now) if due else []
+
+    def next_wakeup(self, now=None):
+        """
+        Return the seconds until the next question is due or the heap is
+        due a reload, whichever is sooner.
+        """
+        now = now or timezone.now()
+        if self.reloaded_at is None:
+            return 0
+        wakeup = self.reloaded_at + datetime.timedelta(seconds=self.reload_interval)
+        if self.heap:
+            wakeup = min(wakeup, self.heap[0][0])
+        return max((wakeup - now).total_seconds(), 0)
+
+    def tick(self, now=None):
+        """
+        Reload if it's time, then publish what's due; return the IDs
+        published.
+        """
+        now = now or timezone.now()
+        if self.reloaded_at is None or now - self.reloaded_at >= datetime.timedelta(
+            seconds=self.reload_interval
+        ):
+            self.reload(now)
+        return self.publish_due(now)
+
+    def run(self, stopped=None, on_publish=None):
+        """
+        Publish questions as they come due until stopped is set.
+        """
+        stopped = stopped or threading.Event()
+        while not stopped.is_set():
+            published = self.tick()
+            if published and on_publish is not None:
+                on_publish(published)
+            stopped.wait(self.next_wakeup())
+
+
+def get_scheduler():
+    config = get_publishing_settings()
+    return Scheduler(
+        lookahead=config["LOOKAHEAD"], reload_interval=config["RELOAD_INTERVAL"]
+    )
@@ -0,0 +1,137 @@
+"""
+Per-view query budgets.
+
+A view declares how many database queries one request may issue, with a
+``query_budget`` attribute on class-based views or the ``@query_budget(n)``
+decorator on function views. The count covers everything from the view
+being called to the response being rendered, including lazy session and
+user loads triggered by the view or its template.
+
+QueryBudgetMiddleware counts the queries of every request to a view with a
+budget, for sync and async views alike. When ``POLLS_QUERY_BUDGET_STRICT``
+is true (the default under DEBUG) going over budget on a GET or HEAD raises
+QueryBudgetExceeded; otherwise it is logged to the ``polls.query_budget``
+logger. Requests with other methods are only logged, even in strict mode:
+the budget is checked once the view has returned, when a vote or import
+has already committed, and answering 500 would invite a retry that repeats
+it. Tests use QueryBudgetTestMixin to assert the same budgets against the
+count the middleware records on each response.
+"""
+
+import logging
+from contextlib import ExitStack
+
+from asgiref.sync import (
+    iscoroutinefunction,
+    markcoroutinefunction,
+    sync_to_async,
+)
+from django.conf import settings
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+logger = logging.getLogger("polls.query_budget")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(budget):
+    def decorator(view):
+        view.query_budget = budget
+        return view
+
+    return decorator
+
+
+def get_query_budget(view):
+    view = getattr(view, "view_class", view)
+    return getattr(view, "query_budget", None)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class QueryBudgetMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = QueryCounter()
+        with self.counting(counter):
+            response = self.get_response(request)
+            if hasattr(response, "render") and callable(response.render):
+                response.render()
+        return self.check_budget(request, response, counter)
+
+    async def __acall__(self, request):
+        counter = QueryCounter()
+        # Connections belong to a thread, and the async ORM runs queries in
+        # the request's sync thread, so the counter is installed there.
+        stack = await sync_to_async(self.counting)(counter)
+        try:
+            response = await self.get_response(request)
+            if hasattr(response, "render") and callable(response.render):
+                response = await sync_to_async(response.render)()
+        finally:
+            await sync_to_async(stack.close)()
+        return self.check_budget(request, response, counter)
+
+    def counting(self, counter):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(counter))
+        return stack
+
+    def check_budget(self, request, response, counter):
+        # Budgets are looked up from the resolved view rather than in
+        # process_view(), which Django would run in a thread under ASGI.
+        match = request.resolver_match
+        budget = get_query_budget(match.func) if match else None
+        if budget is not None:
+            response.query_budget = (counter.count, budget)
+            if counter.count > budget:
+                self.over_budget(request, counter.count, budget)
+        return response
+
+    def over_budget(self, request, used, budget):
+        view = request.resolver_match.view_name if request.resolver_match else ""
+        message = f"{view} ({request.path}) ran {used} queries, budget is {budget}"
+        strict = getattr(settings, "POLLS_QUERY_BUDGET_STRICT", settings.DEBUG)
+        if strict and request.method in ("GET", "HEAD"):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+class QueryBudgetTestMixin:
+    """
+    TestCase mixin asserting that a request stays within the budget
+    declared by the view its URL resolves to.
+    """
+
+    def assertWithinQueryBudget(self, url, method="get", data=None):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            response = getattr(self.client, method)(url, data)
+        self.assertTrue(hasattr(response, "query_budget"), f"{url} has no query budget")
+        used, budget = response.query_budget
+        self.assertLessEqual(
+            used,
+            budget,
+            f"{url} ran {used} queries, budget is {budget}:\n"
+            + "\n".join(query["sql"] for query in queries.captured_queries),
+        )
+        return response
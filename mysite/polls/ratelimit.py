@@ -0,0 +1,282 @@
+"""
+Rate limits and load shedding for the endpoints that write or search.
+
+Views decorated with ``@rate_limit(endpoint)`` are admitted in two steps,
+both before the view runs any query of its own:
+
+1. Load shedding. At most ``POLLS_MAX_IN_FLIGHT`` of these requests run at
+   once per process; any more get a 503 straight away instead of queueing
+   for the database. ``None`` turns this off.
+2. Token buckets. ``POLLS_RATE_LIMITS[endpoint]`` lists ``(key, rate,
+   burst)`` limits, key being "ip", "user" or "question" and rate "N/s",
+   "N/m" or "N/h". A request takes a token from the bucket of each in
+   turn, the per-client ip and user buckets before the question bucket
+   every client shares, and stops at the first that is empty: it gets a
+   429 with Retry-After and the buckets after it are left alone, so a
+   client over its own limit can't drain a poll's bucket for everyone
+   else. The user limit reads the user ID from the session, so it costs
+   the session query for visitors that have one, and doesn't apply to
+   anonymous visitors.
+
+Buckets live in the store set by ``POLLS_RATE_LIMIT_STORE``:
+
+* "local": an LRU of at most ``MAX_KEYS`` buckets in this process.
+* "file": a table of ``SLOTS`` buckets in a memory-mapped file at ``PATH``,
+  shared by every process on the host and updated under a file lock. A
+  key takes the slot its hash points to, replacing whatever was there.
+* "cache": the Django cache ``ALIAS``, shared by every host using it. Reads
+  and writes aren't atomic, so concurrent requests can overdraw a bucket
+  slightly.
+
+Each store keeps one fixed-size entry per active key and evicts idle ones,
+so memory doesn't grow with the number of clients.
+"""
+
+import fcntl
+import functools
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import caches
+from django.http import HttpResponse
+
+UNITS = {"s": 1, "m": 60, "h": 3600}
+
+# Limit keys whose bucket is shared by every client.
+SHARED_KEYS = {"question"}
+
+
+def parse_rate(rate):
+    """
+    Return tokens per second for a rate like "30/m".
+    """
+    count, _, unit = rate.partition("/")
+    return int(count) / UNITS[unit]
+
+
+def refill(tokens, updated, rate, burst, now):
+    return min(burst, tokens + max(now - updated, 0) * rate)
+
+
+def take_token(tokens, rate):
+    """
+    Return (allowed, tokens left, seconds until a token is available).
+    """
+    if tokens >= 1:
+        return True, tokens - 1, 0
+    return False, tokens, (1 - tokens) / rate
+
+
+class LocalMemoryStore:
+    io_bound = False
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            tokens = burst if bucket is None else refill(*bucket, rate, burst, now)
+            allowed, tokens, retry_after = take_token(tokens, rate)
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return allowed, retry_after
+
+
+class FileStore:
+    io_bound = False
+    SLOT = struct.Struct("<Qdd")
+
+    def __init__(self, path, slots=65536):
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = slots * self.SLOT.size
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+    def take(self, key, rate, burst):
+        digest = int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), "little"
+        )
+        offset = (digest % self.slots) * self.SLOT.size
+        # Wall-clock time, which every process agrees on.
+        now = time.time()
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                owner, tokens, updated = self.SLOT.unpack_from(self.map, offset)
+                if owner == digest:
+                    tokens = refill(tokens, updated, rate, burst, now)
+                else:
+                    tokens = burst
+                allowed, tokens, retry_after = take_token(tokens, rate)
+                self.SLOT.pack_into(self.map, offset, digest, tokens, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+        return allowed, retry_after
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class CacheStore:
+    io_bound = True
+
+    def __init__(self, alias="default"):
+        self.alias = alias
+
+    def take(self, key, rate, burst):
+        cache = caches[self.alias]
+        now = time.time()
+        key = f"polls:ratelimit:{key}"
+        bucket = cache.get(key)
+        tokens = burst if bucket is None else refill(*bucket, rate, burst, now)
+        allowed, tokens, retry_after = take_token(tokens, rate)
+        # Once a bucket would be full again it is the same as no bucket.
+        cache.set(key, (tokens, now), math.ceil((burst - tokens) / rate) + 1)
+        return allowed, retry_after
+
+
+STORES = {"local": LocalMemoryStore, "file": FileStore, "cache": CacheStore}
+
+_store = None
+_store_config = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store, _store_config
+    config = dict(getattr(settings, "POLLS_RATE_LIMIT_STORE", {"BACKEND": "local"}))
+    if config != _store_config:
+        with _store_lock:
+            if config != _store_config:
+                options = {k.lower(): v for k, v in config.items() if k != "BACKEND"}
+                _store = STORES[config.get("BACKEND", "local")](**options)
+                _store_config = config
+    return _store
+
+
+def reset():
+    global _store_config
+    _store_config = None
+
+
+class InFlight:
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def enter(self, limit):
+        with self.lock:
+            if limit is not None and self.count >= limit:
+                return False
+            self.count += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.count -= 1
+
+
+in_flight = InFlight()
+
+
+def limit_keys(endpoint, request, kwargs):
+    """
+    Yield (bucket key, rate, burst) for endpoint's limits, per-client ones
+    first.
+    """
+    limits = getattr(settings, "POLLS_RATE_LIMITS", {}).get(endpoint, ())
+    for kind, rate, burst in sorted(limits, key=lambda limit: limit[0] in SHARED_KEYS):
+        if kind == "ip":
+            value = request.META.get("REMOTE_ADDR", "")
+        elif kind == "user":
+            value = request.session.get(SESSION_KEY)
+        elif kind == "question":
+            value = kwargs.get("question_id")
+        else:
+            raise ValueError(f"Unknown rate limit key {kind!r}.")
+        if value is not None:
+            yield f"{endpoint}:{kind}:{value}", parse_rate(rate), burst
+
+
+def needs_thread(endpoint):
+    """
+    Whether checking endpoint's limits may block: the user limit loads the
+    session, and the cache store may go over the network.
+    """
+    limits = getattr(settings, "POLLS_RATE_LIMITS", {}).get(endpoint, ())
+    return get_store().io_bound or any(kind == "user" for kind, _, _ in limits)
+
+
+def check_limits(endpoint, request, kwargs):
+    """
+    Take a token for each of the endpoint's limits in turn, and return a
+    429 response at the first that ran out.
+    """
+    store = get_store()
+    for key, rate, burst in limit_keys(endpoint, request, kwargs):
+        allowed, retry_after = store.take(key, rate, burst)
+        if not allowed:
+            return refusal(429, "Too many requests", retry_after)
+    return None
+
+
+def refusal(status, reason, retry_after):
+    response = HttpResponse(reason, status=status, content_type="text/plain")
+    response["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def rate_limit(endpoint):
+    def decorator(view):
+        if iscoroutinefunction(view):
+
+            async def wrapped(request, *args, **kwargs):
+                if not in_flight.enter(getattr(settings, "POLLS_MAX_IN_FLIGHT", None)):
+                    return refusal(503, "Server busy", 1)
+                try:
+                    if needs_thread(endpoint):
+                        refused = await sync_to_async(check_limits)(
+                            endpoint, request, kwargs
+                        )
+                    else:
+                        refused = check_limits(endpoint, request, kwargs)
+                    if refused is not None:
+                        return refused
+                    return await view(request, *args, **kwargs)
+                finally:
+                    in_flight.leave()
+
+        else:
+
+            def wrapped(request, *args, **kwargs):
+                if not in_flight.enter(getattr(settings, "POLLS_MAX_IN_FLIGHT", None)):
+                    return refusal(503, "Server busy", 1)
+                try:
+                    refused = check_limits(endpoint, request, kwargs)
+                    if refused is not None:
+                        return refused
+                    return view(request, *args, **kwargs)
+                finally:
+                    in_flight.leave()
+
+        return functools.wraps(view)(wrapped)
+
+    return decorator
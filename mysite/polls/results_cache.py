@@ -0,0 +1,135 @@
+"""
+Precomputed results pages.
+
+Each Question's tally is kept in the ``POLLS_RESULTS_CACHE`` cache alias as a
+small dict holding the total, per-choice votes and percentages, and the
+choices in display order (most votes first). A cached tally is updated in
+place when a vote commits instead of being thrown away, so a busy results
+page is recomputed from the database only when it falls out of the cache or
+a choice is edited.
+
+The alias is an ordinary Django cache; the default LocMemCache evicts
+least-recently-used entries once ``MAX_ENTRIES`` is reached. Entries also
+carry a TIMEOUT, which bounds any drift between processes that each update
+their own copy. Patching is a read-modify-write under a process-local lock,
+so it is only done on LocMemCache: with a backend shared between processes,
+concurrent patches would overwrite each other, and committed votes drop the
+tally instead, to be recomputed on the next read.
+"""
+
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+
+from .metrics import CacheStats
+from .models import Choice
+
+_lock = threading.Lock()
+
+
+stats = CacheStats("results")
+
+
+def get_cache():
+    return caches[getattr(settings, "POLLS_RESULTS_CACHE", "default")]
+
+
+def cache_key(question_id):
+    return f"polls:results:{question_id}"
+
+
+def summarize(choices):
+    """
+    Build a results entry from (id, choice_text, votes) rows.
+    """
+    total = sum(votes for _, _, votes in choices)
+    rows = [
+        {
+            "id": pk,
+            "choice_text": text,
+            "votes": votes,
+            "percent": round(100 * votes / total, 1) if total else 0,
+        }
+        for pk, text, votes in choices
+    ]
+    rows.sort(key=lambda row: (-row["votes"], row["id"]))
+    return {"total": total, "choices": rows}
+
+
+def tally(question_id):
+    return (
+        Choice.objects.filter(question_id=question_id)
+        .annotate(pending=Coalesce(Sum("vote_shards__count"), 0))
+        .values_list("id", "choice_text", "votes", "pending")
+    )
+
+
+def compute_results(question_id):
+    return summarize(
+        [(pk, text, votes + pending) for pk, text, votes, pending in tally(question_id)]
+    )
+
+
+def get_results(question_id):
+    cache = get_cache()
+    key = cache_key(question_id)
+    results = cache.get(key)
+    if results is not None:
+        stats.incr("hits")
+        return results
+    stats.incr("misses")
+    results = compute_results(question_id)
+    cache.set(key, results)
+    return results
+
+
+async def aget_results(question_id):
+    cache = get_cache()
+    key = cache_key(question_id)
+    results = await cache.aget(key)
+    if results is not None:
+        stats.incr("hits")
+        return results
+    stats.incr("misses")
+    results = summarize(
+        [
+            (pk, text, votes + pending)
+            async for pk, text, votes, pending in tally(question_id)
+        ]
+    )
+    await cache.aset(key, results)
+    return results
+
+
+def apply_votes(question_id, counts):
+    """
+    Add committed {choice_id: votes} increments to a cached tally. Nothing is
+    cached for questions nobody has viewed; they are computed on first read.
+    """
+    cache = get_cache()
+    key = cache_key(question_id)
+    if not isinstance(cache, LocMemCache):
+        cache.delete(key)
+        return
+    with _lock:
+        results = cache.get(key)
+        if results is None:
+            return
+        choices = [
+            (row["id"], row["choice_text"], row["votes"] + counts.get(row["id"], 0))
+            for row in results["choices"]
+        ]
+        if not counts.keys() <= {row["id"] for row in results["choices"]}:
+            # A choice was added since the tally was cached.
+            cache.delete(key)
+            return
+        cache.set(key, summarize(choices))
+    stats.incr("updates")
+
+
+def invalidate(question_id):
+    get_cache().delete(cache_key(question_id))
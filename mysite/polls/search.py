@@ -0,0 +1,486 @@
+"""
+Question search backends.
+
+``get_search_backend()`` picks a backend from ``POLLS_SEARCH_BACKEND``:
+
+* ``"fts"``: SQLite FTS5 index ``polls_question_fts``, kept in sync with
+  ``polls_question`` by triggers (see migration 0005) and ranked with bm25.
+  SQLite drops the triggers whenever Django rebuilds the table for a schema
+  change, so ``restore_fts_triggers()`` recreates them and reindexes after
+  every ``migrate``, and auto-detection only picks this backend while they
+  are all in place.
+* ``"trigram"``: PostgreSQL ``pg_trgm`` GIN index on ``question_text``,
+  ranked by trigram similarity.
+* ``"like"``: a plain parameterized ``LIKE`` scan, used when neither index
+  is available.
+* ``"auto"`` (default): the indexed backend for the current database, falling
+  back to ``"like"``.
+
+All backends share one query API and return Question instances annotated
+with a backend-specific ``rank``:
+
+* ``search(query, page=1, per_page=20, prefix=True)`` returns a SearchPage of
+  results ordered by rank.
+* ``search_after(query, cursor=None, per_page=20, prefix=True)`` returns a
+  KeysetPage of results ordered newest first by ``(pub_date, id)``. Its
+  ``next_cursor`` is an opaque signed token for the following page, so deep
+  pages cost the same as the first one.
+* ``iter_matches(query)`` walks every match in keyset order from a single
+  query, reading ``chunk_size`` rows at a time from its cursor.
+* ``filter(queryset, query)`` narrows a Question QuerySet to the matches,
+  through the same index, for callers that page and order it themselves,
+  such as the admin.
+
+``asearch_after()`` and ``aiter_matches()`` are the async equivalents used by
+the async views.
+"""
+
+import datetime
+import itertools
+import logging
+import re
+from dataclasses import dataclass, field
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.db import connection
+from django.db.models import Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.query import RawQuerySet
+
+from .models import Question
+
+logger = logging.getLogger("polls.search")
+
+FTS_TABLE = "polls_question_fts"
+# The triggers of migration 0005 that keep FTS_TABLE in sync.
+FTS_TRIGGERS = {
+    f"{FTS_TABLE}_insert": f"""
+        CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON polls_question BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, question_text)
+            VALUES (new.id, new.question_text);
+        END
+    """,
+    f"{FTS_TABLE}_delete": f"""
+        CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON polls_question BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, question_text)
+            VALUES ('delete', old.id, old.question_text);
+        END
+    """,
+    f"{FTS_TABLE}_update": f"""
+        CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF question_text
+        ON polls_question BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, question_text)
+            VALUES ('delete', old.id, old.question_text);
+            INSERT INTO {FTS_TABLE}(rowid, question_text)
+            VALUES (new.id, new.question_text);
+        END
+    """,
+}
+TRIGRAM_INDEX = "polls_question_text_trgm"
+MAX_PER_PAGE = 100
+CURSOR_SALT = "polls.search.cursor"
+
+_terms_re = re.compile(r"\w+", re.UNICODE)
+
+
+def parse_terms(query):
+    return _terms_re.findall(query)
+
+
+def clamp_per_page(per_page):
+    return min(max(int(per_page), 1), MAX_PER_PAGE)
+
+
+def encode_cursor(question):
+    return signing.dumps(
+        [question.pub_date.isoformat(), question.pk], salt=CURSOR_SALT, compress=True
+    )
+
+
+def decode_cursor(token):
+    """
+    Return the (pub_date, id) position stored in a cursor token, or None if
+    the token is missing or has been tampered with.
+    """
+    if not token:
+        return None
+    try:
+        pub_date, pk = signing.loads(token, salt=CURSOR_SALT)
+        return datetime.datetime.fromisoformat(pub_date), int(pk)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+
+async def afetch_all(rows):
+    """
+    Evaluate a QuerySet or RawQuerySet from async code. RawQuerySet has no
+    async iteration, so it is read in one sync_to_async call.
+    """
+    if isinstance(rows, RawQuerySet):
+        return await sync_to_async(list)(rows.iterator())
+    return [row async for row in rows]
+
+
+def iterate(rows, chunk_size):
+    """
+    Stream a QuerySet or RawQuerySet from one query. A RawQuerySet reads
+    from its cursor as it goes, so needs no chunk_size.
+    """
+    if isinstance(rows, RawQuerySet):
+        return rows.iterator()
+    return rows.iterator(chunk_size=chunk_size)
+
+
+async def aiterate(rows, chunk_size):
+    """
+    Async iterate(): each chunk is read from the same cursor in the
+    request's sync thread, where the query runs.
+    """
+    if not isinstance(rows, RawQuerySet):
+        async for row in rows.aiterator(chunk_size=chunk_size):
+            yield row
+        return
+    iterator = rows.iterator()
+    next_chunk = sync_to_async(lambda: list(itertools.islice(iterator, chunk_size)))
+    try:
+        while chunk := await next_chunk():
+            for row in chunk:
+                yield row
+    finally:
+        await sync_to_async(iterator.close)()
+
+
+@dataclass
+class SearchPage:
+    query: str
+    number: int
+    per_page: int
+    results: list = field(default_factory=list)
+    has_next: bool = False
+
+    @property
+    def has_previous(self):
+        return self.number > 1
+
+
+@dataclass
+class KeysetPage:
+    query: str
+    per_page: int
+    cursor: str = ""
+    results: list = field(default_factory=list)
+    next_cursor: str = ""
+
+    @property
+    def has_next(self):
+        return bool(self.next_cursor)
+
+
+class BaseSearchBackend:
+    name = None
+
+    def search(self, query, page=1, per_page=20, prefix=True):
+        page = max(int(page), 1)
+        per_page = clamp_per_page(per_page)
+        result = SearchPage(query=query, number=page, per_page=per_page)
+        if not parse_terms(query):
+            return result
+
+        # Fetch one extra row to learn whether there is a next page without
+        # running a COUNT over every match.
+        rows = list(self.fetch(query, per_page + 1, (page - 1) * per_page, prefix))
+        result.results = rows[:per_page]
+        result.has_next = len(rows) > per_page
+        return result
+
+    def search_after(self, query, cursor=None, per_page=20, prefix=True):
+        per_page = clamp_per_page(per_page)
+        result = KeysetPage(query=query, per_page=per_page, cursor=cursor or "")
+        if not parse_terms(query):
+            return result
+
+        rows = list(
+            self.fetch_after(
+                query, per_page + 1, decode_cursor(cursor), prefix
+            ).iterator()
+        )
+        result.results = rows[:per_page]
+        if len(rows) > per_page:
+            result.next_cursor = encode_cursor(result.results[-1])
+        return result
+
+    def iter_matches(self, query, prefix=True, chunk_size=MAX_PER_PAGE):
+        """
+        Yield every matching question without holding more than one chunk
+        of rows in memory.
+        """
+        if not parse_terms(query):
+            return
+        yield from iterate(self.fetch_after(query, None, None, prefix), chunk_size)
+
+    async def asearch_after(self, query, cursor=None, per_page=20, prefix=True):
+        per_page = clamp_per_page(per_page)
+        result = KeysetPage(query=query, per_page=per_page, cursor=cursor or "")
+        if not parse_terms(query):
+            return result
+
+        rows = await afetch_all(
+            self.fetch_after(query, per_page + 1, decode_cursor(cursor), prefix)
+        )
+        result.results = rows[:per_page]
+        if len(rows) > per_page:
+            result.next_cursor = encode_cursor(result.results[-1])
+        return result
+
+    async def aiter_matches(self, query, prefix=True, chunk_size=MAX_PER_PAGE):
+        if not parse_terms(query):
+            return
+        rows = self.fetch_after(query, None, None, prefix)
+        async for row in aiterate(rows, chunk_size):
+            yield row
+
+    def filter(self, queryset, query, prefix=True):
+        """
+        Return queryset narrowed to questions matching query.
+        """
+        if not parse_terms(query):
+            return queryset
+        return self.filter_matches(queryset, query, prefix)
+
+    def filter_matches(self, queryset, query, prefix):
+        raise NotImplementedError
+
+    def fetch(self, query, limit, offset, prefix):
+        raise NotImplementedError
+
+    def fetch_after(self, query, limit, after, prefix):
+        """
+        Return the matches after the given (pub_date, id), newest first, at
+        most limit of them or all with limit None.
+        """
+        raise NotImplementedError
+
+    def limit_sql(self, sql, params, limit):
+        if limit is None:
+            return sql, params
+        return sql + " LIMIT %s", [*params, limit]
+
+    def keyset_sql(self, after, table="q"):
+        """
+        Return the SQL condition and parameters selecting rows strictly
+        after the given (pub_date, id) in newest-first order.
+        """
+        if after is None:
+            return "", []
+        pub_date = connection.ops.adapt_datetimefield_value(after[0])
+        return (
+            f" AND ({table}.pub_date < %s OR ({table}.pub_date = %s AND {table}.id < %s))",
+            [pub_date, pub_date, after[1]],
+        )
+
+    def rebuild(self):
+        """
+        Rebuild the backend's index from polls_question.
+        """
+
+
+class LikeSearchBackend(BaseSearchBackend):
+    name = "like"
+
+    def filter_matches(self, queryset, query, prefix):
+        for term in parse_terms(query):
+            queryset = queryset.filter(question_text__icontains=term)
+        return queryset
+
+    def matching(self, query):
+        questions = self.filter_matches(
+            Question.objects.annotate(rank=Value(0)), query, True
+        )
+        return questions.order_by("-pub_date", "-id")
+
+    def fetch(self, query, limit, offset, prefix):
+        return self.matching(query)[offset : offset + limit]
+
+    def fetch_after(self, query, limit, after, prefix):
+        questions = self.matching(query)
+        if after is not None:
+            pub_date, pk = after
+            questions = questions.filter(
+                Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, id__lt=pk)
+            )
+        return questions[:limit]
+
+
+class SQLiteFTSSearchBackend(BaseSearchBackend):
+    name = "fts"
+    select = (
+        f"SELECT q.id, q.question_text, q.pub_date, bm25({FTS_TABLE}) AS rank "
+        f"FROM {FTS_TABLE} JOIN polls_question q ON q.id = {FTS_TABLE}.rowid "
+        f"WHERE {FTS_TABLE} MATCH %s"
+    )
+
+    def match_expression(self, query, prefix):
+        # Quote every term so user input can't use FTS5 query syntax.
+        suffix = "*" if prefix else ""
+        return " ".join(f'"{term}"{suffix}' for term in parse_terms(query))
+
+    def filter_matches(self, queryset, query, prefix):
+        sql = f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+        return queryset.filter(
+            pk__in=RawSQL(sql, [self.match_expression(query, prefix)])
+        )
+
+    def fetch(self, query, limit, offset, prefix):
+        sql = self.select + " ORDER BY rank, q.id LIMIT %s OFFSET %s"
+        params = [self.match_expression(query, prefix), limit, offset]
+        return Question.objects.raw(sql, params)
+
+    def fetch_after(self, query, limit, after, prefix):
+        condition, keyset_params = self.keyset_sql(after)
+        sql = self.select + condition + " ORDER BY q.pub_date DESC, q.id DESC"
+        params = [self.match_expression(query, prefix), *keyset_params]
+        return Question.objects.raw(*self.limit_sql(sql, params, limit))
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+class PostgresTrigramSearchBackend(BaseSearchBackend):
+    name = "trigram"
+
+    def select(self, query):
+        terms = parse_terms(query)
+        where = " AND ".join(["q.question_text ILIKE %s"] * len(terms))
+        sql = (
+            "SELECT q.id, q.question_text, q.pub_date, "
+            "similarity(q.question_text, %s) AS rank "
+            f"FROM polls_question q WHERE {where}"
+        )
+        return sql, [" ".join(terms), *[f"%{term}%" for term in terms]]
+
+    def filter_matches(self, queryset, query, prefix):
+        terms = parse_terms(query)
+        where = " AND ".join(["question_text ILIKE %s"] * len(terms))
+        sql = f"SELECT id FROM polls_question WHERE {where}"
+        return queryset.filter(pk__in=RawSQL(sql, [f"%{term}%" for term in terms]))
+
+    def fetch(self, query, limit, offset, prefix):
+        sql, params = self.select(query)
+        sql += " ORDER BY rank DESC, q.id LIMIT %s OFFSET %s"
+        return Question.objects.raw(sql, [*params, limit, offset])
+
+    def fetch_after(self, query, limit, after, prefix):
+        sql, params = self.select(query)
+        condition, keyset_params = self.keyset_sql(after)
+        sql += condition + " ORDER BY q.pub_date DESC, q.id DESC"
+        params = [*params, *keyset_params]
+        return Question.objects.raw(*self.limit_sql(sql, params, limit))
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"REINDEX INDEX {TRIGRAM_INDEX}")
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in [
+        LikeSearchBackend,
+        SQLiteFTSSearchBackend,
+        PostgresTrigramSearchBackend,
+    ]
+}
+
+
+_detected = {}
+
+
+def detection_key():
+    return (connection.alias, str(connection.settings_dict["NAME"]))
+
+
+def detect_backend_name():
+    """
+    Return the best backend whose index exists in the current database. The
+    answer is remembered per database so requests don't pay for
+    introspection.
+    """
+    key = detection_key()
+    if key not in _detected:
+        name = "like"
+        if connection.vendor == "sqlite":
+            missing = missing_fts_triggers(connection)
+            if missing:
+                logger.warning(
+                    "%s is missing triggers %s; searching with LIKE until "
+                    "migrate restores them.",
+                    FTS_TABLE,
+                    ", ".join(missing),
+                )
+            elif missing is not None:
+                name = "fts"
+        elif connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT 1 FROM pg_indexes WHERE indexname = %s", [TRIGRAM_INDEX]
+                )
+                if cursor.fetchone():
+                    name = "trigram"
+        _detected[key] = name
+    return _detected[key]
+
+
+def missing_fts_triggers(connection):
+    """
+    Return the FTS triggers missing from a SQLite database, or None if it
+    has no FTS_TABLE.
+    """
+    names = [FTS_TABLE, *FTS_TRIGGERS]
+    placeholders = ", ".join(["%s"] * len(names))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT name FROM sqlite_master WHERE name IN ({placeholders})", names
+        )
+        present = {name for (name,) in cursor.fetchall()}
+    if FTS_TABLE not in present:
+        return None
+    return [name for name in FTS_TRIGGERS if name not in present]
+
+
+def restore_fts_triggers(connection):
+    """
+    Recreate the FTS triggers a table rebuild dropped and, as the index may
+    have missed changes since, rebuild it. Return the triggers restored.
+    """
+    if connection.vendor != "sqlite":
+        return []
+    missing = missing_fts_triggers(connection) or []
+    if missing:
+        with connection.cursor() as cursor:
+            for name in missing:
+                cursor.execute(FTS_TRIGGERS[name])
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    _detected.clear()
+    return missing
+
+
+def get_search_backend(name=None):
+    name = name or getattr(settings, "POLLS_SEARCH_BACKEND", "auto")
+    if name == "auto":
+        name = detect_backend_name()
+    return BACKENDS[name]()
+
+
+async def aget_search_backend(name=None):
+    """
+    get_search_backend() for async views; only the first detection per
+    database leaves the event loop.
+    """
+    name = name or getattr(settings, "POLLS_SEARCH_BACKEND", "auto")
+    if name == "auto":
+        name = (
+            _detected.get(detection_key()) or await sync_to_async(detect_backend_name)()
+        )
+    return BACKENDS[name]()
@@ -0,0 +1,273 @@
+"""
+A non-blocking handler for the ``security`` logger.
+
+SecurityQueueHandler puts records on a bounded queue and returns; a
+QueueListener thread writes them with BatchFileHandler, so a burst of
+events (say, one per request during a brute-force attempt) never has
+request threads waiting on the disk.
+
+* When the queue is full new records are dropped. With
+  ``policy="sample"`` records below ERROR are also thinned to one in
+  ``sample_every`` once the queue is half full. Dropped records are
+  counted and reported in a later record.
+* Records are written as one JSON object per line. A record logged with
+  ``extra={"request": request}`` gets the client IP, the user if the
+  request already loaded it, and the question ID from the URL; ``ip``,
+  ``user`` and ``question_id`` can also be passed in ``extra`` directly.
+* Records are written in batches of up to ``batch_size``, or every
+  ``flush_interval`` seconds. Identical records within a batch are
+  written once, with a ``count``.
+* The file is rotated when it would grow past ``max_bytes`` or is older
+  than ``rotate_seconds``, keeping ``backup_count`` old files.
+"""
+
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+
+FIELDS = ("ip", "user", "question_id", "count")
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, separators=(",", ":"), default=str)
+
+
+def dedup_key(record):
+    return (
+        record.name,
+        record.levelno,
+        record.getMessage(),
+        *(getattr(record, field, None) for field in FIELDS[:3]),
+    )
+
+
+class BatchFileHandler(logging.Handler):
+    def __init__(
+        self,
+        filename,
+        max_bytes=10 * 1024 * 1024,
+        rotate_seconds=24 * 60 * 60,
+        backup_count=7,
+        batch_size=100,
+        flush_interval=1.0,
+        fsync=False,
+    ):
+        super().__init__()
+        self.filename = os.fspath(filename)
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.buffer = OrderedDict()
+        self.stream = None
+        self.opened_at = None
+        self.timer = None
+        self.lines_written = 0
+
+    def emit(self, record):
+        key = dedup_key(record)
+        entry = self.buffer.get(key)
+        if entry is None:
+            self.buffer[key] = [record, 1]
+        else:
+            entry[1] += 1
+        if len(self.buffer) >= self.batch_size:
+            self.write_batch()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.flush_interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        self.acquire()
+        try:
+            self.write_batch()
+        finally:
+            self.release()
+
+    def write_batch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.buffer:
+            return
+        lines = []
+        for record, count in self.buffer.values():
+            if count > 1:
+                record.count = count
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+        self.buffer.clear()
+        data = "\n".join(lines) + "\n"
+        try:
+            if self.should_rotate(len(data)):
+                self.rotate()
+            if self.stream is None:
+                self.open()
+            self.stream.write(data)
+            self.stream.flush()
+            if self.fsync:
+                os.fsync(self.stream.fileno())
+        except OSError:
+            self.handleError(None)
+            return
+        self.lines_written += len(lines)
+
+    def open(self):
+        self.stream = open(self.filename, "a", encoding="utf-8")
+        try:
+            self.opened_at = os.stat(self.filename).st_mtime
+            if self.stream.tell() == 0:
+                self.opened_at = time.time()
+        except OSError:
+            self.opened_at = time.time()
+
+    def should_rotate(self, size):
+        if self.stream is None:
+            if not os.path.exists(self.filename):
+                return False
+            self.open()
+        if self.max_bytes and self.stream.tell() + size > self.max_bytes:
+            return self.stream.tell() > 0
+        if self.rotate_seconds and time.time() - self.opened_at >= self.rotate_seconds:
+            return self.stream.tell() > 0
+        return False
+
+    def rotate(self):
+        self.stream.close()
+        self.stream = None
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.filename}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.filename}.{i + 1}")
+        if self.backup_count:
+            os.replace(self.filename, f"{self.filename}.1")
+        else:
+            os.remove(self.filename)
+
+    def close(self):
+        self.acquire()
+        try:
+            self.write_batch()
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        super().close()
+
+
+class SecurityQueueHandler(QueueHandler):
+    def __init__(
+        self,
+        filename,
+        queue_size=10000,
+        policy="drop",
+        sample_every=10,
+        **writer_options,
+    ):
+        if policy not in ("drop", "sample"):
+            raise ValueError(f"Unknown policy {policy!r}.")
+        super().__init__(queue.Queue(queue_size))
+        self.policy = policy
+        self.sample_every = sample_every
+        self.seen = 0
+        self.dropped = 0
+        self.unreported = 0
+        self.writer = BatchFileHandler(filename, **writer_options)
+        self.writer.setFormatter(JSONFormatter())
+        self.listener = QueueListener(self.queue, self.writer)
+        self.listener.start()
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        request = getattr(record, "request", None)
+        if request is None:
+            return record
+        # Only what the request has already loaded: the user is looked up
+        # in the database on first access.
+        if getattr(record, "ip", None) is None:
+            record.ip = request.META.get("REMOTE_ADDR")
+        user = getattr(request, "_cached_user", None)
+        if getattr(record, "user", None) is None and user is not None:
+            record.user = user.get_username() or None
+        match = getattr(request, "resolver_match", None)
+        if getattr(record, "question_id", None) is None and match is not None:
+            kwargs = match.kwargs
+            record.question_id = kwargs.get("question_id", kwargs.get("pk"))
+        # Don't keep the request alive on the queue.
+        del record.request
+        return record
+
+    def enqueue(self, record):
+        if (
+            self.policy == "sample"
+            and record.levelno < logging.ERROR
+            and self.queue.qsize() * 2 >= self.queue.maxsize
+        ):
+            self.seen += 1
+            if self.seen % self.sample_every:
+                self.drop(1)
+                return
+        if self.unreported:
+            self.report_drops(record)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.drop(1)
+
+    def drop(self, n):
+        self.dropped += n
+        self.unreported += n
+
+    def report_drops(self, record):
+        n, self.unreported = self.unreported, 0
+        notice = logging.LogRecord(
+            record.name,
+            logging.WARNING,
+            __file__,
+            0,
+            f"{n} security log records dropped",
+            None,
+            None,
+        )
+        try:
+            self.queue.put_nowait(notice)
+        except queue.Full:
+            self.unreported += n
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+                self.writer.close()
+        finally:
+            self.release()
+        super().close()
@@ -0,0 +1,310 @@
+"""
+Synthetic data generation for benchmarks and capacity planning.
+
+``seed_polls()`` streams Questions and their Choices into the database in
+fixed-size batches, one transaction per batch, so memory use doesn't grow
+with the number of rows. Every random choice comes from one seeded
+generator, so the same SeedConfig always produces the same data.
+
+Distributions:
+
+* ``pub_date`` is uniform over the last ``days`` days; ``future_ratio`` of
+  the questions are scheduled up to ``future_days`` ahead instead.
+* Each question gets between ``choices_min`` and ``choices_max`` choices.
+* Owners are drawn from ``owners`` generated users with a Zipf-like skew,
+  so a few owners hold most of the questions.
+* ``access_code_ratio`` of the questions get a six digit access code.
+* Vote totals per question follow a Pareto distribution scaled to average
+  around ``votes_mean``. Within a question, choice ``k`` gets a share
+  proportional to ``1 / k ** vote_skew``.
+* With ``history_days``, each choice's votes are also written as VoteEvent
+  rows at times uniform over the last ``history_days`` days (or since the
+  question was published, if later), for ``manage.py rollup_votes`` and
+  the trend endpoint.
+"""
+
+import contextlib
+import datetime
+import itertools
+import random
+from collections import Counter
+from dataclasses import dataclass
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Choice, Question, VoteEvent
+
+WORDS = (
+    "favourite colour language framework editor coffee tea city season sport "
+    "movie book music pizza holiday weekend lunch breakfast database python "
+    "django release feature bug deploy team meeting office remote travel "
+    "weather summer winter autumn spring game console keyboard laptop phone"
+).split()
+
+OWNER_PREFIX = "seed_owner_"
+PARETO_ALPHA = 1.5
+INSERT_CHUNK = 500
+
+
+@dataclass
+class SeedConfig:
+    questions: int = 1000
+    choices_min: int = 2
+    choices_max: int = 5
+    owners: int = 0
+    access_code_ratio: float = 0.0
+    days: int = 365
+    future_ratio: float = 0.0
+    future_days: int = 30
+    votes_mean: float = 50
+    vote_skew: float = 1.0
+    text_prefix: str = ""
+    history_days: int = 0
+    batch_size: int = 5000
+    seed: int = 0
+
+
+@contextlib.contextmanager
+def bulk_load_pragmas():
+    """
+    Relax SQLite durability for the duration of a bulk load. A crash during
+    the load can corrupt the database, so this is only for throwaway data.
+    SQLite refuses these pragmas inside a transaction, so an enclosing
+    atomic block (as in tests) leaves them alone.
+    """
+    if connection.vendor != "sqlite" or connection.in_atomic_block:
+        yield
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA synchronous")
+        synchronous = cursor.fetchone()[0]
+        cursor.execute("PRAGMA journal_mode")
+        journal_mode = cursor.fetchone()[0]
+        cursor.execute("PRAGMA synchronous = OFF")
+        cursor.execute("PRAGMA journal_mode = MEMORY")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
+            cursor.execute(f"PRAGMA synchronous = {synchronous}")
+
+
+def ensure_owners(count):
+    """
+    Return the ids of `count` generated owner accounts, creating any that
+    are missing.
+    """
+    if count <= 0:
+        return []
+    wanted = [f"{OWNER_PREFIX}{i}" for i in range(count)]
+    existing = set(
+        User.objects.filter(username__in=wanted).values_list("username", flat=True)
+    )
+    password = make_password(None)
+    User.objects.bulk_create(
+        [
+            User(username=name, password=password)
+            for name in wanted
+            if name not in existing
+        ],
+        batch_size=1000,
+    )
+    ids = dict(User.objects.filter(username__in=wanted).values_list("username", "id"))
+    return [ids[name] for name in wanted]
+
+
+def insert_sql(model, field_names):
+    quote = connection.ops.quote_name
+    columns = ", ".join(
+        quote(model._meta.get_field(name).column) for name in field_names
+    )
+    return f"INSERT INTO {quote(model._meta.db_table)} ({columns}) VALUES"
+
+
+def zipf_cum_weights(n, skew):
+    return list(itertools.accumulate(1 / (k**skew) for k in range(1, n + 1)))
+
+
+def split_votes(total, n, skew):
+    """
+    Split `total` votes over `n` choices with a Zipf-like skew towards the
+    first choice.
+    """
+    weights = [1 / (k**skew) for k in range(1, n + 1)]
+    scale = total / sum(weights)
+    votes = [int(w * scale) for w in weights]
+    votes[0] += total - sum(votes)
+    return votes
+
+
+class Seeder:
+    def __init__(self, config):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.now = timezone.now()
+        self.owner_ids = ensure_owners(config.owners)
+        self.owner_weights = zipf_cum_weights(len(self.owner_ids), 1.1)
+        # Pareto samples average alpha / (alpha - 1) before scaling.
+        self.vote_scale = config.votes_mean * (PARETO_ALPHA - 1) / PARETO_ALPHA
+
+    def question(self):
+        config, rng = self.config, self.rng
+        if rng.random() < config.future_ratio:
+            offset = rng.uniform(0, config.future_days * 86400)
+        else:
+            offset = -rng.uniform(0, config.days * 86400)
+        owner_id = None
+        if self.owner_ids:
+            owner_id = rng.choices(self.owner_ids, cum_weights=self.owner_weights)[0]
+        access_code = None
+        if rng.random() < config.access_code_ratio:
+            access_code = f"{rng.randrange(10**6):06d}"
+        text = " ".join(rng.choices(WORDS, k=rng.randint(3, 8))).capitalize() + "?"
+        return (
+            f"{config.text_prefix}{text}",
+            self.now + datetime.timedelta(seconds=offset),
+            owner_id,
+            access_code,
+        )
+
+    def choices(self, question_id):
+        """
+        Return (question_id, choice_text, votes) rows for one question.
+        """
+        config, rng = self.config, self.rng
+        count = rng.randint(config.choices_min, config.choices_max)
+        total = int(rng.paretovariate(PARETO_ALPHA) * self.vote_scale)
+        texts = rng.sample(WORDS, count)
+        return [
+            (question_id, text.capitalize(), votes)
+            for text, votes in zip(texts, split_votes(total, count, config.vote_skew))
+        ]
+
+    def vote_events(self, question_ids, pub_dates):
+        """
+        Return (at, question_id, choice_id, count) rows spreading the votes
+        of the given questions' choices over the history window.
+        """
+        rng = self.rng
+        now = int(self.now.timestamp())
+        window_start = now - self.config.history_days * 86400
+        starts = {
+            pk: max(window_start, int(pub_date.timestamp()))
+            for pk, pub_date in zip(question_ids, pub_dates)
+        }
+        choices = (
+            Choice.objects.filter(question_id__in=question_ids)
+            .order_by("pk")
+            .values_list("question_id", "pk", "votes")
+        )
+        rows = []
+        for question_id, choice_id, votes in choices:
+            start = starts[question_id]
+            if start >= now:
+                continue
+            seconds = Counter(rng.randint(start, now) for _ in range(votes))
+            rows.extend(
+                (at, question_id, choice_id, n) for at, n in sorted(seconds.items())
+            )
+        return rows
+
+    def batches(self):
+        remaining = self.config.questions
+        while remaining > 0:
+            size = min(self.config.batch_size, remaining)
+            yield [self.question() for _ in range(size)]
+            remaining -= size
+
+    def insert_questions(self, rows):
+        """
+        Insert (question_text, pub_date, owner_id, access_code) rows and
+        return their ids in order.
+        """
+        now = timezone.now()
+        if not connection.features.can_return_rows_from_bulk_insert:
+            questions = Question.objects.bulk_create(
+                [
+                    Question(
+                        question_text=text,
+                        pub_date=pub_date,
+                        is_published=pub_date <= now,
+                        owner_id=owner_id,
+                        access_code=access_code,
+                    )
+                    for text, pub_date, owner_id, access_code in rows
+                ]
+            )
+            return [question.pk for question in questions]
+
+        ids = []
+        adapt = connection.ops.adapt_datetimefield_value
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), INSERT_CHUNK):
+                chunk = rows[start : start + INSERT_CHUNK]
+                values = ", ".join(["(%s, %s, %s, %s, %s)"] * len(chunk))
+                params = [
+                    value
+                    for text, pub_date, owner_id, access_code in chunk
+                    for value in (
+                        text,
+                        adapt(pub_date),
+                        pub_date <= now,
+                        owner_id,
+                        access_code,
+                    )
+                ]
+                cursor.execute(
+                    f"{self.insert_questions_sql} {values} RETURNING {self.pk_column}",
+                    params,
+                )
+                ids.extend(row[0] for row in cursor.fetchall())
+        return ids
+
+    def run(self, progress=None):
+        created = {"questions": 0, "choices": 0, "votes": 0, "vote_events": 0}
+        # Model instances cost more than the inserts themselves at this
+        # volume, so rows go to the database as plain tuples.
+        self.insert_questions_sql = insert_sql(
+            Question,
+            ["question_text", "pub_date", "is_published", "owner", "access_code"],
+        )
+        self.pk_column = connection.ops.quote_name(Question._meta.pk.column)
+        insert_choices = insert_sql(Choice, ["question", "choice_text", "votes"])
+        insert_choices += " (%s, %s, %s)"
+        insert_events = insert_sql(
+            VoteEvent, ["at", "question_id", "choice_id", "count"]
+        )
+        insert_events += " (%s, %s, %s, %s)"
+        with bulk_load_pragmas():
+            for batch in self.batches():
+                with transaction.atomic():
+                    question_ids = self.insert_questions(batch)
+                    choices = [c for pk in question_ids for c in self.choices(pk)]
+                    events = []
+                    with connection.cursor() as cursor:
+                        cursor.executemany(insert_choices, choices)
+                        if self.config.history_days > 0:
+                            events = self.vote_events(
+                                question_ids, [row[1] for row in batch]
+                            )
+                            cursor.executemany(insert_events, events)
+                created["questions"] += len(batch)
+                created["choices"] += len(choices)
+                created["votes"] += sum(votes for _, _, votes in choices)
+                created["vote_events"] += len(events)
+                if progress:
+                    progress(created)
+        return created
+
+
+def seed_polls(config, progress=None):
+    """
+    Generate data described by `config` and return the number of questions,
+    choices and votes created.
+    """
+    return Seeder(config).run(progress)
@@ -0,0 +1,87 @@
+from django.db import connections, transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import Signal, receiver
+
+from . import (
+    db_tuning,
+    http_cache,
+    index_cache,
+    live,
+    results_cache,
+    search,
+    vote_history,
+)
+from .models import Choice, Question
+
+# Sent with question_id and {choice_id: votes} once new votes have committed.
+votes_committed = Signal()
+
+# Sent with question_id and published once the publishing worker has put a
+# question up or taken it down.
+publication_changed = Signal()
+
+
+def bump_on_commit(question_id):
+    # Not before, or a request in between could cache the old page under
+    # the new version.
+    transaction.on_commit(lambda: http_cache.bump(question_id))
+
+
+def invalidate_index_on_commit():
+    # Likewise for the index fragments.
+    transaction.on_commit(index_cache.invalidate)
+
+
+def invalidate_results_on_commit(question_id):
+    # And for the results tally, which a read in between would re-cache.
+    transaction.on_commit(lambda: results_cache.invalidate(question_id))
+
+
+@receiver(votes_committed)
+def votes_counted(sender, question_id, counts, **kwargs):
+    results_cache.apply_votes(question_id, counts)
+    http_cache.bump(question_id)
+    live.publish(question_id, counts)
+    vote_history.record(question_id, counts)
+
+
+@receiver(publication_changed)
+def publication_flipped(sender, question_id, published, **kwargs):
+    index_cache.invalidate()
+    http_cache.bump(question_id)
+    if published:
+        live.announce(question_id, "published", {"question": question_id})
+
+
+@receiver([post_save, post_delete], sender=Choice)
+def choice_changed(sender, instance, **kwargs):
+    # Votes are counted with UPDATE queries and never reach here; this only
+    # fires when a choice is added, edited or removed.
+    invalidate_results_on_commit(instance.question_id)
+    bump_on_commit(instance.question_id)
+
+
+@receiver(post_save, sender=Question)
+def question_saved(sender, instance, **kwargs):
+    invalidate_index_on_commit()
+    bump_on_commit(instance.pk)
+
+
+@receiver(post_delete, sender=Question)
+def question_deleted(sender, instance, **kwargs):
+    invalidate_index_on_commit()
+    invalidate_results_on_commit(instance.pk)
+    bump_on_commit(instance.pk)
+
+
+@receiver(post_migrate)
+def search_triggers_restored(sender, using, **kwargs):
+    # A migration that rebuilds polls_question drops the FTS triggers.
+    if sender.name == "polls":
+        search.restore_fts_triggers(connections[using])
+
+
+@receiver(connection_created)
+def tune_connection(sender, connection, **kwargs):
+    db_tuning.configure_connection(connection)
@@ -1,10 +1,84 @@
+import asyncio
 import datetime
+import json
+import logging
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from io import StringIO
+from unittest import mock
+from pathlib import Path
 
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import OperationalError, connection, router
+from django.db.models import Min, Sum
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
-from django.urls import reverse
+from django.urls import resolve, reverse
 
-from .models import Question
+from .models import (
+    Choice,
+    ChoiceVoteShard,
+    Question,
+    VoteEvent,
+    VoteReceipt,
+    VoteRollup,
+    VoteRollupCursor,
+)
+from . import (
+    bench,
+    db_tuning,
+    estimates,
+    http_cache,
+    index_cache,
+    live,
+    metrics,
+    publishing,
+    ratelimit,
+    results_cache,
+    search,
+    security_log,
+    unlocks,
+    vote_buffer,
+    vote_dedup,
+    vote_history,
+)
+from .query_budget import QueryBudgetExceeded, QueryBudgetTestMixin
+from .search import FTS_TABLE, get_search_backend
+from .seeding import WORDS, SeedConfig, seed_polls
+from .templatetags.polls_urls import url_template
+from .views import IndexView
+from .vote_buffer import VoteBuffer, replay_orphaned_journals
+from .voting import asubmit_vote, compact_votes, record_vote
+
+# The test client sends every request from one address, which the rate
+# limits would soon refuse; RateLimitTests turns them back on.
+_unthrottled = override_settings(POLLS_RATE_LIMITS={})
+# Vote events are written as votes commit, not from a thread the test
+# transaction can't see.
+_history_inline = override_settings(POLLS_VOTE_HISTORY={"FLUSH_INTERVAL_MS": 0})
+# Most tests vote many times from one client; VoteDedupTests turns it on.
+_no_dedup = override_settings(POLLS_VOTE_DEDUP={"ENABLED": False})
+
+
+def setUpModule():
+    _unthrottled.enable()
+    _history_inline.enable()
+    _no_dedup.enable()
+
+
+def tearDownModule():
+    _no_dedup.disable()
+    _history_inline.disable()
+    _unthrottled.disable()
 
 
 class QuestionModelTests(TestCase):
@@ -48,6 +122,9 @@ def create_question(question_text, days):
 
 
 class QuestionIndexViewTests(TestCase):
+    def setUp(self):
+        index_cache.get_cache().clear()
+
     def test_no_questions(self):
         """
         If no questions exist, an appropriate message is displayed.
@@ -125,3 +202,2063 @@ class QuestionDetailViewTests(TestCase):
         url = reverse("polls:detail", args=(past_question.id,))
         response = self.client.get(url)
         self.assertContains(response, past_question.question_text)
+
+
+class VoteCountingTests(TestCase):
+    def setUp(self):
+        self.question = create_question(question_text="Vote question.", days=-1)
+        self.choice = Choice.objects.create(question=self.question, choice_text="A")
+
+    def test_vote_view_increments_votes(self):
+        """
+        Voting through the view increments the selected choice's votes.
+        """
+        url = reverse("polls:vote", args=(self.question.id,))
+        self.client.post(url, {"choice": self.choice.id})
+        self.client.post(url, {"choice": self.choice.id})
+        self.choice.refresh_from_db()
+        self.assertEqual(self.choice.votes, 2)
+
+    @override_settings(POLLS_VOTE_SHARDS=4)
+    def test_sharded_votes_are_summed_on_read(self):
+        """
+        With sharding enabled, votes land in shard rows and total_votes()
+        includes them before compaction.
+        """
+        for _ in range(10):
+            record_vote(self.choice.id)
+        self.choice.refresh_from_db()
+        self.assertEqual(self.choice.votes, 0)
+        self.assertEqual(self.choice.total_votes(), 10)
+        self.assertLessEqual(ChoiceVoteShard.objects.count(), 4)
+
+    @override_settings(POLLS_VOTE_SHARDS=4)
+    def test_compaction_folds_shards_into_votes(self):
+        """
+        compact_votes() moves shard counts into Choice.votes without
+        changing the total.
+        """
+        for _ in range(7):
+            record_vote(self.choice.id)
+        self.assertEqual(compact_votes(), 7)
+        self.choice.refresh_from_db()
+        self.assertEqual(self.choice.votes, 7)
+        self.assertEqual(self.choice.total_votes(), 7)
+        self.assertEqual(compact_votes(), 0)
+
+
+class VoteBufferTests(TestCase):
+    def setUp(self):
+        self.question = create_question(question_text="Buffered question.", days=-1)
+        self.choice_a = Choice.objects.create(question=self.question, choice_text="A")
+        self.choice_b = Choice.objects.create(question=self.question, choice_text="B")
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.journal = Path(self.tmpdir.name) / "votes.journal"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_flush_applies_merged_counts(self):
+        """
+        Buffered votes aren't written until flush(), which applies them all
+        and clears the journal.
+        """
+        buffer = VoteBuffer(journal=self.journal)
+        for choice in [self.choice_a, self.choice_b, self.choice_a]:
+            buffer.add(choice.id)
+        self.choice_a.refresh_from_db()
+        self.assertEqual(self.choice_a.votes, 0)
+
+        self.assertEqual(buffer.flush(), 3)
+        self.choice_a.refresh_from_db()
+        self.choice_b.refresh_from_db()
+        self.assertEqual((self.choice_a.votes, self.choice_b.votes), (2, 1))
+        self.assertEqual(buffer.journal_path.read_text(), "")
+        buffer.stop()
+
+    def test_unflushed_votes_are_replayed_from_journal(self):
+        """
+        Votes that were journaled but never flushed are applied when a new
+        buffer starts on the same journal.
+        """
+        buffer = VoteBuffer(journal=self.journal)
+        buffer.add(self.choice_a.id)
+        buffer.add(self.choice_b.id)
+        # The process dies, releasing its lock.
+        buffer._journal.close()
+        buffer._journal_lock.close()
+
+        VoteBuffer(journal=self.journal).stop()
+        self.choice_a.refresh_from_db()
+        self.choice_b.refresh_from_db()
+        self.assertEqual((self.choice_a.votes, self.choice_b.votes), (1, 1))
+        self.assertEqual(replay_orphaned_journals(self.journal), 0)
+
+    def test_journals_of_running_processes_are_left_alone(self):
+        """
+        Replay skips journals another process still holds the lock on, and
+        files that aren't journals.
+        """
+        other = vote_buffer.process_journal(self.journal, pid=99999)
+        other.write_text(f"{self.choice_a.id}\n")
+        other.with_name(f"{other.name}.3").write_text(f"{self.choice_a.id}\n")
+        unrelated = self.journal.with_name("votes.journal.bak")
+        unrelated.write_text(f"{self.choice_b.id}\n")
+        lock = vote_buffer.lock_journal(other)
+
+        VoteBuffer(journal=self.journal).stop()
+        self.choice_a.refresh_from_db()
+        self.assertEqual(self.choice_a.votes, 0)
+
+        lock.close()
+        self.assertEqual(replay_orphaned_journals(self.journal), 2)
+        self.choice_a.refresh_from_db()
+        self.choice_b.refresh_from_db()
+        self.assertEqual((self.choice_a.votes, self.choice_b.votes), (2, 0))
+        self.assertTrue(unrelated.exists())
+
+    def test_failed_flush_is_not_replayed_twice(self):
+        """
+        A batch put back after a failed flush has its journal removed once
+        a later flush applies it, so a restart doesn't count it again.
+        """
+        buffer = VoteBuffer(journal=self.journal)
+        buffer.add(self.choice_a.id)
+        with mock.patch(
+            "polls.vote_buffer.apply_vote_counts", side_effect=OperationalError
+        ):
+            with self.assertRaises(OperationalError):
+                buffer.flush()
+        self.assertEqual(buffer.flush(), 1)
+        buffer.stop()
+
+        VoteBuffer(journal=self.journal).stop()
+        self.choice_a.refresh_from_db()
+        self.assertEqual(self.choice_a.votes, 1)
+        self.assertEqual(vote_buffer.rotations(buffer.journal_path), [])
+
+    @override_settings(POLLS_VOTE_MODE="buffered")
+    def test_vote_view_uses_buffer(self):
+        """
+        In buffered mode the vote view doesn't touch Choice.votes.
+        """
+        with self.settings(POLLS_VOTE_BUFFER={"JOURNAL": self.journal}):
+            url = reverse("polls:vote", args=(self.question.id,))
+            try:
+                response = self.client.post(url, {"choice": self.choice_a.id})
+                self.assertEqual(response.status_code, 302)
+                vote_buffer.get_buffer().stop()
+            finally:
+                vote_buffer._buffer = None
+        self.choice_a.refresh_from_db()
+        self.assertEqual(self.choice_a.votes, 1)
+
+    @override_settings(POLLS_VOTE_MODE="buffered")
+    async def test_async_vote_starts_buffer_off_the_event_loop(self):
+        """
+        The first async vote starts the buffer, replaying leftover journals,
+        without using the ORM from the event loop.
+        """
+        self.journal.write_text(f"{self.choice_b.id}\n")
+        with self.settings(POLLS_VOTE_BUFFER={"JOURNAL": self.journal}):
+            try:
+                await asubmit_vote(self.choice_a)
+                await sync_to_async(vote_buffer._buffer.stop)()
+            finally:
+                vote_buffer._buffer = None
+        await self.choice_a.arefresh_from_db()
+        await self.choice_b.arefresh_from_db()
+        self.assertEqual((self.choice_a.votes, self.choice_b.votes), (1, 1))
+
+
+class QuestionSearchTests(TestCase):
+    def test_migrate_restores_dropped_fts_triggers(self):
+        """
+        While a table rebuild has dropped the FTS triggers, auto-detection
+        falls back to LIKE; migrate recreates them and reindexes.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TRIGGER {FTS_TABLE}_insert")
+        question = create_question(question_text="Rebuilt table?", days=-1)
+        self.addCleanup(search._detected.update, dict(search._detected))
+        search._detected.clear()
+        with self.assertLogs("polls.search", "WARNING"):
+            self.assertEqual(search.detect_backend_name(), "like")
+
+        emit_post_migrate_signal(0, False, "default")
+        self.assertEqual(search.detect_backend_name(), "fts")
+        self.assertEqual(
+            [q.id for q in get_search_backend("fts").search("rebuilt").results],
+            [question.id],
+        )
+
+    def test_fts_index_follows_question_changes(self):
+        """
+        The FTS index is kept in sync with question_text on insert, update
+        and delete.
+        """
+        backend = get_search_backend("fts")
+        question = create_question(question_text="Favourite colour?", days=-1)
+        self.assertEqual(
+            [q.id for q in backend.search("colour").results], [question.id]
+        )
+
+        question.question_text = "Favourite season?"
+        question.save()
+        self.assertEqual(backend.search("colour").results, [])
+        self.assertEqual(len(backend.search("season").results), 1)
+
+        question.delete()
+        self.assertEqual(backend.search("season").results, [])
+
+    def test_prefix_matching_and_pagination(self):
+        """
+        Terms match as prefixes and results are paged without a COUNT.
+        """
+        for i in range(3):
+            create_question(question_text=f"Programming language {i}?", days=-1)
+        for name in ["fts", "like"]:
+            backend = get_search_backend(name)
+            first = backend.search("progr", per_page=2)
+            self.assertEqual(len(first.results), 2)
+            self.assertTrue(first.has_next)
+            second = backend.search("progr", page=2, per_page=2)
+            self.assertEqual(len(second.results), 1)
+            self.assertFalse(second.has_next)
+
+    def test_search_view_treats_query_as_text(self):
+        """
+        Quotes and SQL in the query are searched for, not executed.
+        """
+        create_question(question_text="Public question", days=-1)
+        response = self.client.get(reverse("polls:search"), {"q": "' OR '1'='1"})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "No questions found")
+
+    def test_keyset_pages_walk_every_match_once(self):
+        """
+        Following next_cursor visits each match exactly once, newest first,
+        for every backend.
+        """
+        questions = [
+            create_question(question_text=f"Weekend plans {i}?", days=-i)
+            for i in range(1, 6)
+        ]
+        for name in ["fts", "like"]:
+            backend = get_search_backend(name)
+            seen, cursor = [], None
+            while True:
+                page = backend.search_after("weekend", cursor=cursor, per_page=2)
+                seen.extend(q.id for q in page.results)
+                if not page.has_next:
+                    break
+                cursor = page.next_cursor
+            self.assertEqual(seen, [q.id for q in questions])
+            # Every chunk comes from the one query.
+            with self.assertNumQueries(1):
+                matches = list(backend.iter_matches("weekend", chunk_size=2))
+            self.assertEqual([q.id for q in matches], seen)
+
+    def test_tampered_cursor_restarts_from_first_page(self):
+        """
+        A cursor that fails signature checks is ignored.
+        """
+        question = create_question(question_text="Cursor question", days=-1)
+        page = get_search_backend().search_after("cursor", cursor="forged:token")
+        self.assertEqual([q.id for q in page.results], [question.id])
+
+    @override_settings(POLLS_SEARCH_STREAMING=True)
+    def test_streaming_search_renders_all_rows(self):
+        """
+        With streaming enabled, ?stream=1 returns every match incrementally.
+        """
+        for i in range(3):
+            create_question(question_text=f"Streamed question {i}", days=-1)
+        response = self.client.get(
+            reverse("polls:search"), {"q": "streamed", "stream": "1"}
+        )
+        self.assertTrue(response.streaming)
+        content = b"".join(response.streaming_content).decode()
+        self.assertEqual(content.count("Streamed question"), 3)
+
+    async def test_aiter_matches_reads_in_chunks(self):
+        questions = [
+            await sync_to_async(create_question)(
+                question_text=f"Chunked question {i}", days=-i
+            )
+            for i in range(1, 6)
+        ]
+        for name in ["fts", "like"]:
+            backend = get_search_backend(name)
+            matches = [
+                q.id async for q in backend.aiter_matches("chunked", chunk_size=2)
+            ]
+            self.assertEqual(matches, [q.id for q in questions])
+
+
+class ResultsCacheTests(TestCase):
+    def setUp(self):
+        results_cache.get_cache().clear()
+        self.question = create_question(question_text="Cached question.", days=-1)
+        self.choice_a = Choice.objects.create(question=self.question, choice_text="A")
+        self.choice_b = Choice.objects.create(question=self.question, choice_text="B")
+        self.vote_url = reverse("polls:vote", args=(self.question.id,))
+        self.results_url = reverse("polls:results", args=(self.question.id,))
+
+    def test_votes_update_cached_tally_in_place(self):
+        """
+        Once cached, results are served without recomputing and each vote
+        updates the totals, percentages and ordering.
+        """
+        self.client.get(self.results_url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.vote_url, {"choice": self.choice_b.id})
+            self.client.post(self.vote_url, {"choice": self.choice_b.id})
+            self.client.post(self.vote_url, {"choice": self.choice_a.id})
+
+        hits = results_cache.stats.hits
+        with self.assertNumQueries(1):
+            response = self.client.get(self.results_url)
+        self.assertEqual(results_cache.stats.hits, hits + 1)
+        results = response.context["results"]
+        self.assertEqual(results["total"], 3)
+        self.assertEqual(
+            [(c["choice_text"], c["votes"], c["percent"]) for c in results["choices"]],
+            [("B", 2, 66.7), ("A", 1, 33.3)],
+        )
+
+    def test_editing_choices_invalidates_tally(self):
+        """
+        Adding a choice drops the cached tally so the next read includes it.
+        """
+        self.client.get(self.results_url)
+        with self.captureOnCommitCallbacks() as callbacks:
+            Choice.objects.create(question=self.question, choice_text="C")
+        # Kept until the change commits, so a read in between can't cache
+        # the old tally again.
+        key = results_cache.cache_key(self.question.id)
+        self.assertIsNotNone(results_cache.get_cache().get(key))
+        for callback in callbacks:
+            callback()
+        response = self.client.get(self.results_url)
+        self.assertEqual(len(response.context["results"]["choices"]), 3)
+
+    def test_shared_cache_drops_tally_on_vote(self):
+        """
+        On a cache shared between processes, where patches could overwrite
+        each other, a committed vote drops the tally rather than patching
+        it.
+        """
+        with tempfile.TemporaryDirectory() as location, self.settings(
+            CACHES={
+                "shared": {
+                    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                    "LOCATION": location,
+                }
+            },
+            POLLS_RESULTS_CACHE="shared",
+        ):
+            self.client.get(self.results_url)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(self.vote_url, {"choice": self.choice_a.id})
+            key = results_cache.cache_key(self.question.id)
+            self.assertIsNone(results_cache.get_cache().get(key))
+            response = self.client.get(self.results_url)
+        self.assertEqual(response.context["results"]["total"], 1)
+
+
+@override_settings(POLLS_QUERY_BUDGET_STRICT=True)
+class QueryBudgetTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        index_cache.get_cache().clear()
+        results_cache.get_cache().clear()
+        self.user = User.objects.create_user("owner", password="pw")
+        self.questions = []
+        for i in range(5):
+            question = create_question(question_text=f"Question {i}", days=-i - 1)
+            question.owner = self.user
+            question.save()
+            for text in ["A", "B", "C"]:
+                Choice.objects.create(question=question, choice_text=text)
+            self.questions.append(question)
+        self.question = self.questions[0]
+
+    def test_index_does_not_query_per_owner(self):
+        """
+        The index page's query count doesn't grow with the number of rows,
+        whether or not the visitor is logged in.
+        """
+        self.assertWithinQueryBudget(reverse("polls:index"))
+        self.client.force_login(self.user)
+        response = self.assertWithinQueryBudget(reverse("polls:index"))
+        self.assertContains(response, "Owner: owner", count=5)
+
+    def test_detail_and_results_do_not_query_per_choice(self):
+        self.assertWithinQueryBudget(reverse("polls:detail", args=(self.question.id,)))
+        self.assertWithinQueryBudget(reverse("polls:results", args=(self.question.id,)))
+
+    def test_vote_and_search_within_budget(self):
+        choice = self.question.choice_set.first()
+        self.assertWithinQueryBudget(
+            reverse("polls:vote", args=(self.question.id,)),
+            method="post",
+            data={"choice": choice.id},
+        )
+        self.assertWithinQueryBudget(reverse("polls:search") + "?q=question")
+
+    def test_strict_mode_raises_over_budget(self):
+        """
+        Going over budget raises in strict mode so a regression fails tests.
+        """
+        with mock.patch.object(IndexView, "query_budget", 0):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(reverse("polls:index"))
+
+    def test_strict_mode_only_logs_writes_over_budget(self):
+        """
+        A POST over budget has already committed, so strict mode logs it
+        rather than answering 500.
+        """
+        url = reverse("polls:vote", args=(self.question.id,))
+        choice = self.question.choice_set.first()
+        with mock.patch.object(resolve(url).func, "query_budget", 0):
+            with self.assertLogs("polls.query_budget", "WARNING"):
+                response = self.client.post(url, {"choice": choice.id})
+        self.assertEqual(response.status_code, 302)
+        choice.refresh_from_db()
+        self.assertEqual(choice.votes, 1)
+
+
+class IndexCacheTests(TestCase):
+    def setUp(self):
+        index_cache.get_cache().clear()
+
+    def test_question_list_is_cached_until_questions_change(self):
+        """
+        Repeat visits reuse the rendered list; saving a question refreshes it.
+        """
+        create_question(question_text="First question.", days=-1)
+        self.client.get(reverse("polls:index"))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("polls:index"))
+        self.assertContains(response, "First question.")
+
+        # Not invalidated until the save commits, or a request in between
+        # could cache the old list under the new version.
+        with self.captureOnCommitCallbacks() as callbacks:
+            create_question(question_text="Second question.", days=-1)
+        response = self.client.get(reverse("polls:index"))
+        self.assertNotContains(response, "Second question.")
+        for callback in callbacks:
+            callback()
+        response = self.client.get(reverse("polls:index"))
+        self.assertContains(response, "Second question.")
+
+    def test_anonymous_and_logged_in_lists_are_separate(self):
+        create_question(question_text="Shared question.", days=-1)
+        user = User.objects.create_user("viewer", password="pw")
+        self.client.get(reverse("polls:index"))
+        self.client.force_login(user)
+        response = self.client.get(reverse("polls:index"))
+        self.assertContains(response, f"?user_id={user.id}")
+
+    def test_timeout_stops_at_next_scheduled_question(self):
+        """
+        A fragment expires no later than the next future pub_date.
+        """
+        now = timezone.now()
+        self.assertEqual(index_cache.get_timeout(now), 300)
+        Question.objects.create(
+            question_text="Soon.", pub_date=now + datetime.timedelta(seconds=42)
+        )
+        self.assertEqual(index_cache.get_timeout(now), 42)
+
+
+class ExplainPollsCommandTests(TestCase):
+    def test_view_queries_use_indexes(self):
+        """
+        The index page and scheduling queries are served by the pub_date
+        indexes rather than a table scan.
+        """
+        create_question(question_text="Indexed question.", days=-1)
+        out = StringIO()
+        call_command("explain_polls", stdout=out)
+        output = out.getvalue()
+        self.assertIn("index: latest questions: ok", output)
+        self.assertIn("index: next scheduled question: ok", output)
+
+
+class SeedPollsTests(TestCase):
+    def test_seed_generates_configured_volumes(self):
+        """
+        seed_polls() creates the requested questions with choices, owners,
+        access codes and future pub_dates in the configured proportions.
+        """
+        config = SeedConfig(
+            questions=250,
+            choices_min=2,
+            choices_max=4,
+            owners=5,
+            access_code_ratio=0.5,
+            future_ratio=0.2,
+            batch_size=100,
+        )
+        created = seed_polls(config)
+        self.assertEqual(created["questions"], 250)
+        self.assertEqual(Question.objects.count(), 250)
+        self.assertEqual(Choice.objects.count(), created["choices"])
+        self.assertTrue(500 <= created["choices"] <= 1000)
+        self.assertEqual(
+            Question.objects.values("owner").distinct().count(), config.owners
+        )
+        with_code = Question.objects.exclude(access_code=None).count()
+        self.assertTrue(75 < with_code < 175)
+        future = Question.objects.filter(pub_date__gt=timezone.now()).count()
+        self.assertTrue(20 < future < 80)
+
+    def test_command_rejects_more_choices_than_words(self):
+        with self.assertRaisesMessage(CommandError, "--choices-max can't be more"):
+            call_command(
+                "seed_polls",
+                questions=1,
+                choices_max=len(WORDS) + 1,
+                stdout=StringIO(),
+            )
+
+    def test_votes_are_skewed_towards_first_choice(self):
+        seed_polls(SeedConfig(questions=20, choices_min=3, choices_max=3, vote_skew=2))
+        for question in Question.objects.prefetch_related("choice_set"):
+            votes = [c.votes for c in question.choice_set.order_by("id")]
+            self.assertEqual(votes, sorted(votes, reverse=True))
+
+    def test_history_days_writes_vote_events(self):
+        created = seed_polls(SeedConfig(questions=20, days=3, history_days=1))
+        events = VoteEvent.objects.aggregate(total=Sum("count"), first=Min("at"))
+        self.assertEqual(events["total"], created["votes"])
+        self.assertGreaterEqual(events["first"], time.time() - 86400 - 60)
+        self.assertEqual(VoteEvent.objects.count(), created["vote_events"])
+
+
+class BenchHTTPTests(TestCase):
+    def test_percentile_nearest_rank(self):
+        samples = list(range(1, 101))
+        self.assertEqual(bench.percentile(samples, 50), 50)
+        self.assertEqual(bench.percentile(samples, 99), 99)
+        self.assertEqual(bench.percentile([], 95), 0.0)
+
+    def test_compare_flags_regressions(self):
+        """
+        Latency may grow within the threshold, but any extra query per
+        request is a regression.
+        """
+        baseline = {"results": {"index": {"p95_ms": 10.0, "queries_per_request": 2}}}
+        current = {"results": {"index": {"p95_ms": 10.5, "queries_per_request": 2}}}
+        self.assertEqual(bench.compare(baseline, current, threshold=0.1), [])
+        current["results"]["index"].update(p95_ms=12.0, queries_per_request=3)
+        regressions = bench.compare(baseline, current, threshold=0.1)
+        self.assertEqual(len(regressions), 2)
+
+    def test_client_transport_runs_every_endpoint(self):
+        out = StringIO()
+        call_command(
+            "bench_http",
+            iterations=2,
+            warmup=1,
+            questions=10,
+            alloc_samples=1,
+            stdout=out,
+        )
+        for endpoint in ["index", "detail", "results", "vote", "search", "delete"]:
+            self.assertIn(endpoint, out.getvalue())
+        self.assertFalse(Question.objects.exists())
+
+
+@override_settings(ROOT_URLCONF="mysite.async_urls")
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        index_cache.get_cache().clear()
+        results_cache.get_cache().clear()
+        self.user = User.objects.create_user("owner", password="pw")
+        self.question = create_question(question_text="Async question.", days=-1)
+        self.question.owner = self.user
+        self.question.save()
+        self.choice = Choice.objects.create(question=self.question, choice_text="A")
+        create_question(question_text="Future question.", days=30)
+
+    async def test_index_lists_published_questions_for_viewer(self):
+        response = await self.async_client.get(reverse("polls:index"))
+        self.assertContains(response, "Async question.")
+        self.assertNotContains(response, "Future question.")
+        self.assertContains(response, "Login")
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse("polls:index"))
+        self.assertContains(response, "Logged in as: owner")
+        self.assertContains(response, f"?user_id={self.user.pk}")
+
+    async def test_vote_updates_results(self):
+        url = reverse("polls:vote", args=(self.question.id,))
+        response = await self.async_client.post(url, {"choice": self.choice.id})
+        self.assertRedirects(
+            response,
+            reverse("polls:results", args=(self.question.id,)),
+            fetch_redirect_response=False,
+        )
+        self.assertIn(db_tuning.PRIMARY_COOKIE, response.cookies)
+        await self.choice.arefresh_from_db()
+        self.assertEqual(self.choice.votes, 1)
+        response = await self.async_client.get(
+            reverse("polls:results", args=(self.question.id,))
+        )
+        self.assertContains(response, "A -- 1 vote (100.0%)")
+
+    async def test_detail_requires_unlocked_access_code(self):
+        self.question.access_code = "1234"
+        await self.question.asave()
+        url = reverse("polls:detail", args=(self.question.id,))
+        response = await self.async_client.get(url)
+        self.assertRedirects(
+            response,
+            reverse("polls:access", args=(self.question.id,)),
+            fetch_redirect_response=False,
+        )
+        await self.async_client.post(
+            reverse("polls:access", args=(self.question.id,)),
+            {"access_code": "1234"},
+        )
+        response = await self.async_client.get(url)
+        self.assertContains(response, 'value="%s"' % self.choice.id)
+
+    async def test_search_and_query_budget(self):
+        """
+        The query budget middleware counts queries made by async views.
+        """
+        response = await self.async_client.get(reverse("polls:search"), {"q": "async"})
+        self.assertContains(response, "Async question.")
+        used, budget = response.query_budget
+        self.assertTrue(0 < used <= budget)
+
+
+class LiveResultsTests(TestCase):
+    async def next_event(self, subscriber):
+        return await subscriber.get(timeout=2)
+
+    async def test_hub_coalesces_bursts(self):
+        """
+        Votes arriving faster than MAX_UPDATES_PER_SEC reach subscribers as
+        one merged delta.
+        """
+        hub = live.Hub(max_updates_per_sec=10)
+        first = hub.subscribe(1)
+        second = hub.subscribe(1)
+        other = hub.subscribe(2)
+        for pk in [5, 5, 6]:
+            hub.publish(1, {pk: 1})
+        event = await self.next_event(first)
+        self.assertEqual(event, live.sse_event("delta", {"votes": {5: 2, 6: 1}}))
+        self.assertEqual(await self.next_event(second), event)
+        hub.publish(1, {5: 1})
+        hub.publish(1, {5: 1})
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        event = await self.next_event(first)
+        self.assertGreaterEqual(loop.time() - start, 0.05)
+        self.assertEqual(event, live.sse_event("delta", {"votes": {5: 2}}))
+        self.assertTrue(other.queue.empty())
+
+    def test_slow_subscriber_is_resynced(self):
+        subscriber = live.Subscriber(1, queue_size=2)
+        for n in range(3):
+            subscriber.offer(f"event {n}")
+        self.assertEqual(subscriber.queue.qsize(), 1)
+        self.assertIs(subscriber.queue.get_nowait(), live.RESYNC)
+        self.assertEqual(subscriber.resyncs, 1)
+
+    def test_broker_sends_do_not_block_publishers(self):
+        """
+        Votes for the broker are sent from a background thread, merged per
+        question while a send is under way.
+        """
+        hub = live.Hub(broker="unused")
+        sent = []
+        release = threading.Event()
+
+        def send(data):
+            release.wait(2)
+            sent.append(data)
+
+        with mock.patch.object(hub.sender, "send", side_effect=send):
+            start = time.monotonic()
+            for _ in range(100):
+                hub.publish(1, {5: 1})
+            hub.announce(1, "published", {"question": 1})
+            self.assertLess(time.monotonic() - start, 0.5)
+            release.set()
+            hub.sender.stop()
+        lines = b"".join(sent).splitlines()
+        self.assertLess(len(lines), 10)
+        votes = [json.loads(line) for line in lines if b'"v"' in line]
+        self.assertEqual(sum(message["v"]["5"] for message in votes), 100)
+        self.assertIn(live.encode_event(1, "published", {"question": 1}), sent[-1])
+
+    def test_unsent_broker_updates_are_delivered_locally(self):
+        hub = live.Hub(broker="/nonexistent/live.sock")
+        with mock.patch.object(hub, "deliver") as deliver:
+            with self.assertLogs("polls.live", "WARNING"):
+                hub.publish(1, {5: 1})
+                hub.sender.stop()
+        deliver.assert_called_once_with(1, {5: 1})
+        # Until the broker is retried, votes skip it.
+        hub.publish(1, {6: 1})
+        self.assertEqual(hub.sender.votes, {})
+
+    async def test_broker_relays_between_hubs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "live.sock"
+            ready = asyncio.Event()
+            broker = asyncio.create_task(live.serve_broker(path, ready))
+            await ready.wait()
+            publisher = live.Hub(broker=path)
+            receiver = live.Hub(broker=path)
+            subscriber = receiver.subscribe(7)
+            try:
+                # The receiver's broker connection is made in the background.
+                for _ in range(50):
+                    publisher.publish(7, {3: 1})
+                    try:
+                        event = await subscriber.get(timeout=0.1)
+                        break
+                    except asyncio.TimeoutError:
+                        continue
+                self.assertIn('"votes":{"3":', event)
+            finally:
+                receiver.listener.cancel()
+                publisher.sender.stop()
+                await asyncio.sleep(0.05)
+                broker.cancel()
+
+    async def test_stream_sends_tally_then_deltas(self):
+        results_cache.get_cache().clear()
+        question = await Question.objects.acreate(
+            question_text="Live?", pub_date=timezone.now()
+        )
+        choice = await Choice.objects.acreate(question=question, choice_text="Yes")
+        response = await self.async_client.get(
+            reverse("polls:live", args=(question.id,))
+        )
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        chunks = aiter(response.streaming_content)
+        self.assertIn(b"event: tally", await anext(chunks))
+        live.publish(question.id, {choice.id: 1})
+        chunk = await asyncio.wait_for(anext(chunks), 2)
+        self.assertEqual(
+            chunk.decode(), live.sse_event("delta", {"votes": {choice.id: 1}})
+        )
+        await chunks.aclose()
+
+    def test_wsgi_gets_tally_and_retry(self):
+        question = create_question(question_text="Live?", days=-1)
+        response = self.client.get(reverse("polls:live", args=(question.id,)))
+        self.assertContains(response, "retry: ")
+        self.assertContains(response, "event: tally")
+
+
+class DatabaseTuningTests(TestCase):
+    def test_connections_get_configured_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            cursor.execute("PRAGMA cache_size")
+            self.assertEqual(cursor.fetchone()[0], -65536)
+
+    def test_read_only_connections_skip_journal_mode(self):
+        """
+        A connection opened with mode=ro can't change the journal mode, and
+        is made query_only.
+        """
+        read_only = mock.Mock(settings_dict={"NAME": "file:db.sqlite3?mode=ro"})
+        with override_settings(POLLS_SQLITE_PRAGMAS={"journal_mode": "WAL"}):
+            self.assertEqual(db_tuning.get_pragmas(read_only), {"query_only": "ON"})
+
+    def tearDown(self):
+        db_tuning.health.reset()
+
+    def test_reads_are_routed_only_inside_read_views(self):
+        self.assertEqual(Question.objects.all().db, "default")
+        with db_tuning.use_read_database("read"):
+            self.assertEqual(Question.objects.all().db, "read")
+            self.assertEqual(router.db_for_write(Question), "default")
+
+        @db_tuning.read_database_view
+        def view(request):
+            return Question.objects.all().db
+
+        request = RequestFactory().get("/")
+        with override_settings(POLLS_READ_REPLICAS={"read": 1}):
+            self.assertEqual(view(request), "read")
+        self.assertEqual(view(request), "default")
+        self.assertEqual(Question.objects.all().db, "default")
+
+    def test_replicas_are_chosen_by_weight(self):
+        rng = random.Random(0)
+        replicas = {"replica1": 3, "replica2": 1, "replica3": 0}
+        picks = Counter(db_tuning.health.choose(replicas, rng) for _ in range(1000))
+        self.assertNotIn("replica3", picks)
+        self.assertTrue(700 < picks["replica1"] < 800)
+
+    @override_settings(POLLS_READ_REPLICAS={"read": 1})
+    def test_failed_replica_falls_back_to_default(self):
+        """
+        A view whose replica fails is run again against default, and the
+        replica is skipped until POLLS_REPLICA_RETRY_SECONDS have passed.
+        """
+
+        @db_tuning.read_database_view
+        def view(request):
+            if Question.objects.all().db == "read":
+                raise OperationalError("unable to open database file")
+            return "default"
+
+        request = RequestFactory().get("/")
+        with self.assertLogs("polls.db", "WARNING"):
+            self.assertEqual(view(request), "default")
+        self.assertIsNone(db_tuning.choose_replica(request))
+        with mock.patch("polls.db_tuning.time.monotonic", return_value=1e12):
+            self.assertEqual(db_tuning.choose_replica(request), "read")
+
+    @override_settings(POLLS_READ_REPLICAS={"read": 1})
+    def test_voting_pins_reads_to_default(self):
+        question = create_question(question_text="Sticky question.", days=-1)
+        choice = question.choice_set.create(choice_text="Yes")
+        response = self.client.post(
+            reverse("polls:vote", args=(question.id,)), {"choice": choice.id}
+        )
+        self.assertIn(db_tuning.PRIMARY_COOKIE, response.cookies)
+        request = RequestFactory().get("/")
+        self.assertEqual(db_tuning.choose_replica(request), "read")
+        request.COOKIES = {
+            db_tuning.PRIMARY_COOKIE: response.cookies[db_tuning.PRIMARY_COOKIE].value
+        }
+        self.assertIsNone(db_tuning.choose_replica(request))
+
+    def test_failed_vote_does_not_pin_reads(self):
+        question = create_question(question_text="Unpinned question.", days=-1)
+        response = self.client.post(reverse("polls:vote", args=(question.id,)))
+        self.assertNotIn(db_tuning.PRIMARY_COOKIE, response.cookies)
+
+
+class UnlockTests(TestCase):
+    def setUp(self):
+        unlocks._verifier = None
+        self.question = create_question(question_text="Private.", days=-1)
+        self.question.access_code = "1234"
+        self.question.save()
+        self.detail_url = reverse("polls:detail", args=(self.question.id,))
+        self.access_url = reverse("polls:access", args=(self.question.id,))
+
+    def tearDown(self):
+        unlocks._verifier = None
+
+    def test_ids_round_trip_compactly(self):
+        ids = {1, 2, 3, 130, 510935}
+        token = unlocks.encode_ids(ids)
+        self.assertEqual(unlocks.decode_ids(token), ids)
+        self.assertLessEqual(len(token), 12)
+        self.assertEqual(unlocks.decode_ids("not base64!"), frozenset())
+
+    def test_cookie_unlock_needs_no_session(self):
+        response = self.client.post(self.access_url, {"access_code": "1234"})
+        self.assertRedirects(response, self.detail_url)
+        self.assertIn("polls_unlocked", response.cookies)
+        self.assertNotIn("sessionid", response.cookies)
+        with self.assertNumQueries(2):
+            response = self.client.get(self.detail_url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies["polls_unlocked"] = unlocks.encode_ids([self.question.id])
+        response = self.client.get(self.detail_url)
+        self.assertRedirects(response, self.access_url)
+
+    @override_settings(POLLS_ACCESS={"STORE": "session"})
+    def test_session_store_keeps_one_key(self):
+        other = create_question(question_text="Also private.", days=-1)
+        other.access_code = "5678"
+        other.save()
+        self.client.post(self.access_url, {"access_code": "1234"})
+        self.client.post(
+            reverse("polls:access", args=(other.id,)), {"access_code": "5678"}
+        )
+        session = self.client.session
+        self.assertEqual(list(session.keys()), [unlocks.SESSION_KEY])
+        self.assertEqual(
+            unlocks.decode_ids(session[unlocks.SESSION_KEY]),
+            {self.question.id, other.id},
+        )
+        self.assertEqual(self.client.get(self.detail_url).status_code, 200)
+
+    def test_hashed_code_checks_are_cached(self):
+        self.question.access_code = make_password("1234")
+        self.question.save()
+        verifier = unlocks.get_verifier()
+        for _ in range(3):
+            self.client.cookies.clear()
+            response = self.client.post(self.access_url, {"access_code": "1234"})
+            self.assertRedirects(response, self.detail_url)
+        self.assertEqual(verifier.checks, 1)
+
+    def test_repeated_failures_are_throttled(self):
+        """
+        After MAX_FAILURES wrong codes within the window, even the right
+        code is refused without being checked.
+        """
+        verifier = unlocks.get_verifier()
+        for guess in range(10):
+            response = self.client.post(self.access_url, {"access_code": str(guess)})
+            self.assertContains(response, "Invalid access code")
+        checks = verifier.checks
+        response = self.client.post(self.access_url, {"access_code": "1234"})
+        self.assertContains(response, "Too many attempts", status_code=429)
+        self.assertEqual(verifier.checks, checks)
+        later = time.monotonic() + 61
+        with mock.patch("polls.unlocks.time.monotonic", return_value=later):
+            response = self.client.post(self.access_url, {"access_code": "1234"})
+        self.assertRedirects(response, self.detail_url)
+
+    def test_cache_is_bounded(self):
+        verifier = unlocks.VerificationCache(size=3)
+        for guess in range(10):
+            verifier.verify("1234", str(guess))
+        self.assertEqual(len(verifier.results), 3)
+
+
+class SecurityLogTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / "security.log"
+        self.logger = logging.getLogger("polls.tests.security")
+        self.logger.propagate = False
+
+    def attach(self, handler):
+        self.logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def read_records(self):
+        with open(self.path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_records_are_json_with_request_fields(self):
+        handler = self.attach(security_log.SecurityQueueHandler(self.path))
+        user = User.objects.create_user("mallory")
+        request = RequestFactory().get("/", REMOTE_ADDR="10.0.0.7")
+        request._cached_user = user
+        request.resolver_match = resolve(reverse("polls:delete", args=(42,)))
+        self.logger.warning("Unauthorized delete", extra={"request": request})
+        handler.close()
+        [record] = self.read_records()
+        self.assertEqual(record["message"], "Unauthorized delete")
+        self.assertEqual(record["level"], "WARNING")
+        self.assertEqual(record["ip"], "10.0.0.7")
+        self.assertEqual(record["user"], "mallory")
+        self.assertEqual(record["question_id"], 42)
+
+    def test_repeated_events_are_counted_once_per_batch(self):
+        handler = self.attach(security_log.SecurityQueueHandler(self.path))
+        for _ in range(50):
+            self.logger.warning("Injection attempt", extra={"ip": "10.0.0.1"})
+        self.logger.warning("Injection attempt", extra={"ip": "10.0.0.2"})
+        handler.close()
+        records = self.read_records()
+        self.assertEqual([r["ip"] for r in records], ["10.0.0.1", "10.0.0.2"])
+        self.assertEqual(records[0]["count"], 50)
+        self.assertNotIn("count", records[1])
+
+    def test_full_queue_drops_and_reports(self):
+        handler = security_log.SecurityQueueHandler(self.path, queue_size=2)
+        # Stop the listener so the queue fills up.
+        handler.listener.stop()
+        handler.listener = None
+        for i in range(5):
+            handler.handle(self.logger.makeRecord(*self.record_args(f"event {i}")))
+        self.assertEqual(handler.dropped, 3)
+        handler.queue.get_nowait()
+        handler.queue.get_nowait()
+        handler.handle(self.logger.makeRecord(*self.record_args("event 5")))
+        notice = handler.queue.get_nowait()
+        self.assertEqual(notice.getMessage(), "3 security log records dropped")
+        handler.close()
+
+    def record_args(self, message):
+        return (self.logger.name, logging.WARNING, __file__, 0, message, None, None)
+
+    def test_file_is_rotated_by_size(self):
+        handler = security_log.BatchFileHandler(
+            self.path, max_bytes=200, backup_count=2, batch_size=1
+        )
+        handler.setFormatter(security_log.JSONFormatter())
+        self.attach(handler)
+        for i in range(10):
+            self.logger.warning("event %d", i)
+        handler.close()
+        self.assertTrue(self.path.exists())
+        self.assertTrue(Path(f"{self.path}.2").exists())
+        self.assertFalse(Path(f"{self.path}.3").exists())
+        self.assertLessEqual(self.path.stat().st_size, 200)
+
+
+class MetricsTests(TestCase):
+    def test_histograms_render_cumulative_buckets(self):
+        registry = []
+        histogram = metrics.Histogram("t_seconds", "Test.", (0.1, 1), registry)
+        counter = metrics.Counter("t_total", "Test.", registry)
+        labels = (("view", 'say "hi"'),)
+        for value in (0.05, 0.5, 5):
+            histogram.observe(labels, value)
+        counter.inc(labels, 2)
+        text = metrics.render(metrics.merge([metrics.snapshot(registry)]))
+        self.assertIn('t_seconds_bucket{view="say \\"hi\\"",le="0.1"} 1', text)
+        self.assertIn('t_seconds_bucket{view="say \\"hi\\"",le="1"} 2', text)
+        self.assertIn('t_seconds_bucket{view="say \\"hi\\"",le="+Inf"} 3', text)
+        self.assertIn('t_seconds_count{view="say \\"hi\\""} 3', text)
+        self.assertIn('t_total{view="say \\"hi\\""} 2', text)
+
+    def test_requests_are_recorded_per_view(self):
+        question = create_question(question_text="Measured.", days=-1)
+        labels = (("view", "polls:results"),)
+        before = metrics.DB_QUERIES.series().get(labels)
+        self.client.get(reverse("polls:results", args=(question.id,)))
+        self.client.get(reverse("polls:results", args=(question.id,)))
+        after = metrics.DB_QUERIES.series()[labels]
+        self.assertEqual(sum(after[:-1]) - sum((before or [0, 0])[:-1]), 2)
+        events = metrics.VIEW_CACHE_EVENTS.series()
+        self.assertIn(labels + (("cache", "results"), ("event", "hits")), events)
+        response = self.client.get(reverse("metrics"))
+        self.assertContains(
+            response, 'polls_template_render_seconds_count{view="polls:results"}'
+        )
+        self.assertContains(
+            response, 'polls_cache_events_total{cache="results",event="misses"}'
+        )
+
+    def test_metrics_are_limited_to_allowed_ips(self):
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 403)
+
+    def test_snapshots_of_other_processes_are_added(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        registry = []
+        other = metrics.Counter("polls_requests_total", "Requests.", registry)
+        other.inc((("view", "polls:other"), ("status", "200")), 7)
+        snap = metrics.MmapSnapshot(Path(tmp.name) / "polls-metrics-1.mmap", size=64)
+        # Larger than the file, so it has to grow.
+        snap.write(json.dumps(metrics.snapshot(registry)).encode())
+        snap.close()
+        with override_settings(POLLS_METRICS={"MULTIPROCESS_DIR": tmp.name}):
+            response = self.client.get(reverse("metrics"))
+        self.assertContains(
+            response, 'polls_requests_total{view="polls:other",status="200"} 7'
+        )
+        self.assertEqual(len(list(Path(tmp.name).iterdir())), 2)
+
+    def test_slow_requests_are_sampled(self):
+        sampler = metrics.SlowRequestSampler(threshold=0, interval=60)
+        request_metrics = metrics.RequestMetrics()
+        sampler.active[id(request_metrics)] = request_metrics
+        sampler.sample()
+        request = RequestFactory().get("/slow/")
+        request.resolver_match = None
+        sampler.finish_request(request_metrics, request)
+        [profile] = sampler.profiles
+        self.assertEqual(profile["path"], "/slow/")
+        [stack] = profile["samples"]
+        self.assertIn("tests.py:test_slow_requests_are_sampled;", stack)
+
+
+@override_settings(
+    POLLS_RATE_LIMITS={
+        "vote": [("ip", "60/m", 2), ("question", "60/m", 4)],
+        "search": [("ip", "1/s", 1)],
+    },
+    POLLS_RATE_LIMIT_STORE={"BACKEND": "local"},
+    POLLS_MAX_IN_FLIGHT=4,
+)
+class RateLimitTests(TestCase):
+    def setUp(self):
+        ratelimit.reset()
+        self.addCleanup(ratelimit.reset)
+        self.question = create_question(question_text="Limited.", days=-1)
+        self.choice = self.question.choice_set.create(choice_text="Yes")
+        self.vote_url = reverse("polls:vote", args=(self.question.id,))
+
+    def vote(self, ip="10.0.0.1"):
+        return self.client.post(
+            self.vote_url, {"choice": self.choice.id}, REMOTE_ADDR=ip
+        )
+
+    def test_burst_then_429_with_retry_after(self):
+        self.assertEqual(self.vote().status_code, 302)
+        self.assertEqual(self.vote().status_code, 302)
+        response = self.vote()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        # Another client has its own bucket.
+        self.assertEqual(self.vote(ip="10.0.0.2").status_code, 302)
+
+    def test_question_limit_is_shared_by_clients(self):
+        for i in range(4):
+            self.assertEqual(self.vote(ip=f"10.0.1.{i}").status_code, 302)
+        self.assertEqual(self.vote(ip="10.0.1.9").status_code, 429)
+        other = create_question(question_text="Other.", days=-1)
+        choice = other.choice_set.create(choice_text="Yes")
+        response = self.client.post(
+            reverse("polls:vote", args=(other.id,)),
+            {"choice": choice.id},
+            REMOTE_ADDR="10.0.1.9",
+        )
+        self.assertEqual(response.status_code, 302)
+
+    def test_refused_client_does_not_drain_question_limit(self):
+        """
+        Requests an IP's own limit refuses don't take from the question's
+        bucket, so other clients can still vote.
+        """
+        for _ in range(10):
+            self.vote()
+        self.assertEqual(self.vote(ip="10.0.0.2").status_code, 302)
+        self.assertEqual(self.vote(ip="10.0.0.3").status_code, 302)
+
+    def test_refused_requests_run_no_queries(self):
+        self.vote()
+        self.vote()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.vote().status_code, 429)
+
+    def test_sheds_load_when_too_many_in_flight(self):
+        for _ in range(4):
+            ratelimit.in_flight.enter(None)
+            self.addCleanup(ratelimit.in_flight.leave)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("polls:search"), {"q": "x"})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+
+    @override_settings(ROOT_URLCONF="mysite.async_urls")
+    def test_async_views_are_limited(self):
+        url = reverse("polls:search")
+        self.assertEqual(self.client.get(url, {"q": "x"}).status_code, 200)
+        self.assertEqual(self.client.get(url, {"q": "x"}).status_code, 429)
+        self.assertEqual(ratelimit.in_flight.count, 0)
+
+    def test_buckets_refill(self):
+        rate = ratelimit.parse_rate("30/m")
+        self.assertEqual(rate, 0.5)
+        self.assertEqual(ratelimit.refill(0, 100, rate, 10, 104), 2)
+        self.assertEqual(ratelimit.refill(0, 100, rate, 10, 1000), 10)
+        self.assertEqual(ratelimit.take_token(0.5, rate), (False, 0.5, 1.0))
+
+    def test_local_store_evicts_idle_keys(self):
+        store = ratelimit.LocalMemoryStore(max_keys=2)
+        for key in ("a", "b", "c"):
+            store.take(key, 1, 1)
+        self.assertEqual(list(store.buckets), ["b", "c"])
+        # "a" was forgotten, so it starts with a full bucket again.
+        self.assertEqual(store.take("a", 1, 1)[0], True)
+
+    def test_file_store_is_shared(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name) / "buckets"
+        first = ratelimit.FileStore(path, slots=16)
+        second = ratelimit.FileStore(path, slots=16)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        self.assertTrue(first.take("ip:1", 0.001, 2)[0])
+        self.assertTrue(second.take("ip:1", 0.001, 2)[0])
+        allowed, retry_after = first.take("ip:1", 0.001, 2)
+        self.assertFalse(allowed)
+        self.assertGreater(retry_after, 900)
+        self.assertEqual(path.stat().st_size, 16 * ratelimit.FileStore.SLOT.size)
+
+    def test_cache_store(self):
+        store = ratelimit.CacheStore()
+        self.addCleanup(caches["default"].delete, "polls:ratelimit:ip:cache-test")
+        self.assertTrue(store.take("ip:cache-test", 0.001, 1)[0])
+        self.assertFalse(store.take("ip:cache-test", 0.001, 1)[0])
+
+
+class HttpCacheTests(TestCase):
+    def setUp(self):
+        results_cache.get_cache().clear()
+        self.question = create_question(question_text="Cacheable.", days=-1)
+        self.choice = self.question.choice_set.create(choice_text="Yes")
+        self.detail_url = reverse("polls:detail", args=(self.question.id,))
+        self.results_url = reverse("polls:results", args=(self.question.id,))
+        self.vote_url = reverse("polls:vote", args=(self.question.id,))
+
+    def test_results_revalidate_without_queries(self):
+        response = self.client.get(self.results_url)
+        self.assertEqual(response["Cache-Control"], "public, max-age=0, s-maxage=300")
+        self.assertEqual(
+            response["Surrogate-Key"], f"polls polls-question-{self.question.id}"
+        )
+        etag = response["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(self.results_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        last_modified = self.client.get(self.results_url)["Last-Modified"]
+        response = self.client.get(
+            self.results_url, HTTP_IF_MODIFIED_SINCE=last_modified
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_vote_changes_the_etag(self):
+        etag = self.client.get(self.results_url)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.vote_url, {"choice": self.choice.id})
+        response = self.client.get(self.results_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "1 vote in total")
+
+    def test_logged_in_results_are_private(self):
+        User.objects.create_user("voter", password="pw")
+        self.client.login(username="voter", password="pw")
+        response = self.client.get(self.results_url)
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+        self.assertIn("Cookie", response["Vary"])
+        self.assertNotIn("Surrogate-Key", response)
+
+    def test_detail_etag_follows_csrf_cookie_and_edits(self):
+        response = self.client.get(self.detail_url)
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+        self.assertIn("Cookie", response["Vary"])
+        etag = response["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.client.cookies["csrftoken"] = "x" * 32
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.choice.choice_text = "Yes!"
+            self.choice.save()
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, "Yes!")
+
+    def test_private_poll_is_revalidated_only_while_unlocked(self):
+        self.question.access_code = "1234"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.question.save()
+        access_url = reverse("polls:access", args=(self.question.id,))
+        self.client.post(access_url, {"access_code": "1234"})
+        etag = self.client.get(self.detail_url)["ETag"]
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        del self.client.cookies["polls_unlocked"]
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertRedirects(response, access_url)
+
+    @override_settings(ROOT_URLCONF="mysite.async_urls")
+    def test_async_views_answer_304(self):
+        etag = self.client.get(self.results_url)["ETag"]
+        response = self.client.get(self.results_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        etag = self.client.get(self.detail_url)["ETag"]
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_proxy_caches_until_purged(self):
+        calls = []
+
+        def app(environ, start_response):
+            calls.append(environ["PATH_INFO"])
+            cache_control = (
+                "private"
+                if environ["PATH_INFO"] == "/private/"
+                else "public, s-maxage=60"
+            )
+            start_response(
+                "200 OK",
+                [
+                    ("Cache-Control", cache_control),
+                    ("Surrogate-Key", "polls-question-1"),
+                ],
+            )
+            return [b"page"]
+
+        proxy = http_cache.ProxyCache(app)
+
+        def get(path):
+            headers = {}
+            environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path}
+            body = b"".join(proxy(environ, lambda s, h: headers.update(h)))
+            return headers, body
+
+        headers, body = get("/results/")
+        self.assertEqual((headers["X-Cache"], body), ("MISS", b"page"))
+        headers, body = get("/results/")
+        self.assertEqual((headers["X-Cache"], body), ("HIT", b"page"))
+        self.assertNotIn("Surrogate-Key", headers)
+        get("/private/")
+        get("/private/")
+        self.assertEqual(calls, ["/results/", "/private/", "/private/"])
+        http_cache.bump(1)
+        self.assertEqual(get("/results/")[0]["X-Cache"], "MISS")
+        http_cache.bump(2)
+        self.assertEqual(get("/results/")[0]["X-Cache"], "HIT")
+
+
+class TemplateRenderingTests(TestCase):
+    def test_url_template_matches_reverse(self):
+        detail_url = url_template("polls:detail")
+        self.assertEqual(detail_url.for_id(42), reverse("polls:detail", args=(42,)))
+        self.assertEqual(
+            url_template("polls:delete").for_id(7),
+            reverse("polls:delete", args=(7,)),
+        )
+
+    @override_settings(USE_THOUSAND_SEPARATOR=True)
+    def test_loops_render_ids_unlocalized(self):
+        index_cache.get_cache().clear()
+        question = Question.objects.create(
+            pk=12345, question_text="Big IDs.", pub_date=timezone.now()
+        )
+        Choice.objects.create(pk=67890, question=question, choice_text="Yes")
+        response = self.client.get(reverse("polls:detail", args=(question.pk,)))
+        self.assertContains(response, 'value="67890"')
+        response = self.client.get(reverse("polls:index"))
+        self.assertContains(response, "[ID: 12345]")
+        self.assertContains(response, 'href="/polls/12345/"')
+        self.assertContains(response, 'href="/polls/12345/delete/?user_id=')
+
+    def test_bench_templates_renders_every_template(self):
+        out = StringIO()
+        call_command(
+            "bench_templates",
+            engines=["django", "django-uncached"],
+            sizes=[5],
+            iterations=1,
+            warmup=0,
+            alloc_samples=0,
+            stdout=out,
+        )
+        self.assertIn("django:index_questions.html:5", out.getvalue())
+        self.assertIn("django-uncached:results.html:5", out.getvalue())
+
+
+class TransferTests(TestCase):
+    def setUp(self):
+        results_cache.get_cache().clear()
+        self.owner = User.objects.create_user("alice")
+        self.question = create_question(question_text="Tabs or spaces?", days=-1)
+        self.question.owner = self.owner
+        self.question.access_code = "1234"
+        self.question.save()
+        self.tabs = Choice.objects.create(
+            question=self.question, choice_text="Tabs", votes=3
+        )
+        self.spaces = Choice.objects.create(
+            question=self.question, choice_text='Spaces, "obviously"', votes=1
+        )
+        ChoiceVoteShard.objects.create(choice=self.tabs, shard=0, count=2)
+        self.empty = create_question(question_text="No choices yet.", days=-2)
+
+    def export(self, format):
+        out = StringIO()
+        call_command("export_polls", format=format, chunk_size=1, stdout=out)
+        return out.getvalue()
+
+    def import_file(self, content, suffix, **options):
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=suffix, encoding="utf-8", delete=False
+        ) as f:
+            f.write(content)
+        self.addCleanup(Path(f.name).unlink)
+        out = StringIO()
+        call_command("import_polls", f.name, stdout=out, **options)
+        return out.getvalue()
+
+    def snapshot(self):
+        return [
+            (
+                q.pk,
+                q.question_text,
+                q.pub_date,
+                q.owner_id,
+                q.access_code,
+                [(c.pk, c.choice_text, c.total_votes()) for c in q.choice_set.all()],
+            )
+            for q in Question.objects.order_by("pk")
+        ]
+
+    def test_export_includes_pending_votes(self):
+        records = [json.loads(line) for line in self.export("ndjson").splitlines()]
+        self.assertEqual([r["id"] for r in records], [self.question.pk, self.empty.pk])
+        self.assertEqual(records[0]["owner"], "alice")
+        self.assertEqual(records[0]["access_code"], "1234")
+        self.assertEqual(
+            [(c["choice_text"], c["votes"]) for c in records[0]["choices"]],
+            [("Tabs", 5), ('Spaces, "obviously"', 1)],
+        )
+        self.assertEqual(records[1]["choices"], [])
+
+    def test_round_trip(self):
+        for format in ["ndjson", "csv"]:
+            with self.subTest(format=format):
+                exported = self.export(format)
+                before = self.snapshot()
+                Question.objects.all().delete()
+                out = self.import_file(exported, f".{format}")
+                self.assertIn("Imported 2 questions and 2 choices", out)
+                self.assertEqual(self.snapshot(), before)
+                self.assertFalse(ChoiceVoteShard.objects.exists())
+
+    def test_reimport_is_idempotent(self):
+        exported = self.export("csv")
+        self.import_file(exported, ".csv")
+        before = self.snapshot()
+        self.import_file(exported, ".csv")
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual(Question.objects.count(), 2)
+        self.tabs.refresh_from_db()
+        self.assertEqual(self.tabs.votes, 5)
+
+    def test_import_new_records_and_unknown_owners(self):
+        lines = [
+            {
+                "question_text": "New question?",
+                "pub_date": "2024-05-01T12:00:00",
+                "owner": "alice",
+                "choices": [{"choice_text": "Yes"}],
+            },
+            {
+                "question_text": "Orphan?",
+                "pub_date": "2024-05-01T12:00:00+02:00",
+                "owner": "nobody",
+            },
+        ]
+        out = self.import_file(
+            "\n".join(json.dumps(line) for line in lines) + "\n\n", ".ndjson"
+        )
+        self.assertIn("1 owner(s) didn't match", out)
+        new = Question.objects.get(question_text="New question?")
+        self.assertEqual(new.owner, self.owner)
+        self.assertEqual(
+            new.pub_date, datetime.datetime(2024, 5, 1, 12, tzinfo=datetime.UTC)
+        )
+        self.assertEqual(
+            list(new.choice_set.values_list("choice_text", "votes")), [("Yes", 0)]
+        )
+        self.assertIsNone(Question.objects.get(question_text="Orphan?").owner)
+        # Later inserts don't collide with the imported IDs.
+        create_question(question_text="After the import.", days=0)
+
+    def test_invalid_record_stops_import(self):
+        content = "\n".join(
+            [
+                json.dumps({"question_text": "Fine.", "pub_date": "2024-05-01"}),
+                json.dumps({"question_text": "", "pub_date": "yesterday"}),
+            ]
+        )
+        with self.assertRaisesMessage(
+            CommandError, "Line 2: pub_date must be an ISO 8601 datetime."
+        ):
+            self.import_file(content.replace('""', '"Also fine."'), ".ndjson")
+        self.assertFalse(Question.objects.filter(question_text="Fine.").exists())
+        with self.assertRaisesMessage(
+            CommandError, "Line 2: question_text is required."
+        ):
+            self.import_file(content, ".ndjson", batch_size=1)
+        # Earlier batches stay imported.
+        self.assertTrue(Question.objects.filter(question_text="Fine.").exists())
+        with self.assertRaisesMessage(CommandError, "Line 1: missing columns"):
+            self.import_file("question_id,question_text\n1,Hi\n", ".csv")
+
+    def test_repeated_ids_stop_import(self):
+        question = {"question_text": "Again?", "pub_date": "2024-05-01"}
+        content = "\n".join(
+            [json.dumps({**question, "id": 50}), json.dumps({**question, "id": 50})]
+        )
+        with self.assertRaisesMessage(
+            CommandError, "Line 2: id 50 is repeated from line 1."
+        ):
+            self.import_file(content, ".ndjson")
+        choices = [{"id": 60, "choice_text": "Yes"}, {"id": 60, "choice_text": "No"}]
+        with self.assertRaisesMessage(
+            CommandError, "Line 1: choice id 60 is repeated from line 1."
+        ):
+            self.import_file(json.dumps({**question, "choices": choices}), ".ndjson")
+        self.assertFalse(Question.objects.filter(question_text="Again?").exists())
+
+    def test_csv_rows_without_ids_group_by_question(self):
+        content = (
+            "question_id,question_text,pub_date,owner,access_code,"
+            "choice_id,choice_text,votes"
+            + "\n,Cats or dogs?,2024-05-01,,,,Cats,1\n"
+            + ",Cats or dogs?,2024-05-01,,,,Dogs,2\n"
+            + ",Tea or coffee?,2024-05-01,,,,Tea,0\n"
+        )
+        self.import_file(content, ".csv")
+        question = Question.objects.get(question_text="Cats or dogs?")
+        self.assertEqual(
+            list(question.choice_set.values_list("choice_text", "votes")),
+            [("Cats", 1), ("Dogs", 2)],
+        )
+        self.assertEqual(
+            Question.objects.get(question_text="Tea or coffee?").choice_set.count(), 1
+        )
+
+    def test_import_invalidates_cached_results(self):
+        url = reverse("polls:results", args=(self.question.pk,))
+        self.assertContains(self.client.get(url), "Tabs -- 5 votes")
+        exported = self.export("ndjson").replace('"votes": 5', '"votes": 7')
+        self.import_file(exported, ".ndjson")
+        self.assertContains(self.client.get(url), "Tabs -- 7 votes")
+
+    def test_export_view_is_staff_only(self):
+        url = reverse("polls:export")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.owner.is_staff = True
+        self.owner.save()
+        self.client.force_login(self.owner)
+        response = self.client.get(url, {"format": "csv"})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+        self.assertIn('filename="polls.csv"', response["Content-Disposition"])
+        body = b"".join(response.streaming_content).decode()
+        self.assertEqual(body, self.export("csv"))
+        response = self.client.get(url, {"format": "xml"})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(ROOT_URLCONF="mysite.async_urls")
+    async def test_async_export_view(self):
+        self.owner.is_staff = True
+        await self.owner.asave()
+        await self.async_client.aforce_login(self.owner)
+        response = await self.async_client.get(reverse("polls:export"))
+        self.assertEqual(
+            response["Content-Type"], "application/x-ndjson; charset=utf-8"
+        )
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        lines = body.decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])["id"], self.question.pk)
+
+
+class QuestionAdminTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", password="pw")
+        self.client.force_login(self.admin)
+        self.recent = create_question(question_text="Tabs or spaces?", days=0)
+        choice = Choice.objects.create(
+            question=self.recent, choice_text="Tabs", votes=3
+        )
+        Choice.objects.create(question=self.recent, choice_text="Spaces", votes=4)
+        ChoiceVoteShard.objects.create(choice=choice, shard=1, count=2)
+        self.old = create_question(question_text="Vim or Emacs?", days=-400)
+        self.scheduled = create_question(question_text="Light or dark?", days=5)
+        self.url = reverse("admin:polls_question_changelist")
+
+    def results(self, response):
+        return list(response.context["cl"].result_list)
+
+    def test_changelist_annotates_totals_and_recency(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        rows = {q.pk: q for q in self.results(response)}
+        self.assertEqual(rows[self.recent.pk].vote_total, 9)
+        self.assertEqual(rows[self.old.pk].vote_total, 0)
+        self.assertIs(rows[self.recent.pk].published_recently, True)
+        self.assertIs(rows[self.scheduled.pk].published_recently, False)
+        self.assertContains(response, '<td class="field-vote_total">9</td>')
+        counts = [q["sql"] for q in queries if "COUNT" in q["sql"]]
+        # One count, capped, of IDs alone.
+        self.assertEqual(len(counts), 1)
+        self.assertIn("LIMIT", counts[0])
+        self.assertNotIn("vote_total", counts[0])
+
+    def test_search_uses_search_backend(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {"q": "tab"})
+        self.assertEqual(self.results(response), [self.recent])
+        backend = get_search_backend()
+        if backend.name == "fts":
+            self.assertTrue(any(FTS_TABLE in q["sql"] for q in queries))
+        response = self.client.get(self.url, {"q": "emacs vim"})
+        self.assertEqual(self.results(response), [self.old])
+        response = self.client.get(self.url, {"q": "?!"})
+        self.assertEqual(len(self.results(response)), 3)
+
+    def test_date_buckets(self):
+        for bucket, expected in [
+            ("today", [self.recent]),
+            ("year", [self.recent]),
+            ("older", [self.old]),
+            ("scheduled", [self.scheduled]),
+        ]:
+            with self.subTest(bucket=bucket):
+                response = self.client.get(self.url, {"published": bucket})
+                self.assertEqual(self.results(response), expected)
+
+    @override_settings(POLLS_ADMIN_COUNT_LIMIT=2)
+    def test_count_is_estimated_past_limit(self):
+        queryset = Question.objects.order_by("-pk")
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        self.assertEqual(estimates.estimate_rows(Question), 3)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(estimates.EstimatedCountPaginator(queryset, 1).count, 3)
+        self.assertNotIn("COUNT", queries[-1]["sql"])
+        # Filtered lists are counted up to the limit.
+        filtered = queryset.filter(question_text__contains="o")
+        self.assertEqual(estimates.EstimatedCountPaginator(filtered, 1).count, 2)
+        response = self.client.get(self.url)
+        self.assertEqual(response.context["cl"].result_count, 3)
+
+
+class VoteHistoryTests(TestCase):
+    # 2026-01-01 12:34:56 UTC.
+    now = 1767270896
+
+    def setUp(self):
+        self.question = create_question(question_text="Trending?", days=-1)
+        self.yes = Choice.objects.create(question=self.question, choice_text="Yes")
+        self.no = Choice.objects.create(question=self.question, choice_text="No")
+
+    def rollups(self, resolution):
+        return list(
+            VoteRollup.objects.filter(resolution=resolution)
+            .order_by("bucket", "choice_id")
+            .values_list("bucket", "choice_id", "count")
+        )
+
+    def test_recorder_merges_votes_per_second(self):
+        recorder = vote_history.EventRecorder()
+        q = self.question.pk
+        recorder.add(self.now, q, {self.yes.pk: 1})
+        recorder.add(self.now, q, {self.yes.pk: 2, self.no.pk: 1})
+        recorder.add(self.now + 1, q, {self.yes.pk: 1})
+        self.assertFalse(VoteEvent.objects.exists())
+        self.assertEqual(recorder.flush(), 3)
+        self.assertEqual(recorder.flush(), 0)
+        self.assertEqual(
+            sorted(VoteEvent.objects.values_list("at", "choice_id", "count")),
+            [
+                (self.now, self.yes.pk, 3),
+                (self.now, self.no.pk, 1),
+                (self.now + 1, self.yes.pk, 1),
+            ],
+        )
+
+    def test_committed_votes_are_recorded(self):
+        url = reverse("polls:vote", args=(self.question.pk,))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {"choice": self.yes.pk})
+        event = VoteEvent.objects.get()
+        self.assertEqual(
+            (event.question_id, event.choice_id, event.count),
+            (self.question.pk, self.yes.pk, 1),
+        )
+        with self.settings(POLLS_VOTE_HISTORY={"ENABLED": False}):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(url, {"choice": self.yes.pk})
+        self.assertEqual(VoteEvent.objects.count(), 1)
+
+    def test_roll_up_counts_each_event_once(self):
+        q = self.question.pk
+        vote_history.record(q, {self.yes.pk: 2}, at=self.now)
+        vote_history.record(q, {self.no.pk: 1}, at=self.now + 2)
+        vote_history.record(q, {self.yes.pk: 1}, at=self.now + 60)
+        self.assertEqual(vote_history.roll_up(batch_size=2), 3)
+        self.assertEqual(vote_history.roll_up(), 0)
+        minute = self.now - self.now % 60
+        self.assertEqual(
+            self.rollups(vote_history.MINUTE),
+            [
+                (minute, self.yes.pk, 2),
+                (minute, self.no.pk, 1),
+                (minute + 60, self.yes.pk, 1),
+            ],
+        )
+        vote_history.record(q, {self.yes.pk: 4}, at=self.now + 3600)
+        vote_history.roll_up()
+        day = self.now - self.now % 86400
+        self.assertEqual(
+            self.rollups(vote_history.DAY),
+            [(day, self.yes.pk, 7), (day, self.no.pk, 1)],
+        )
+        self.assertEqual(len(self.rollups(vote_history.HOUR)), 3)
+
+    @override_settings(
+        POLLS_VOTE_HISTORY={
+            "FLUSH_INTERVAL_MS": 0,
+            "RAW_DAYS": 1,
+            "MINUTE_DAYS": 2,
+            "HOUR_DAYS": 3,
+        }
+    )
+    def test_retention_downsamples_old_history(self):
+        q = self.question.pk
+        day = vote_history.DAY
+        for days_ago in [5, 2.5, 1.5, 0]:
+            vote_history.record(q, {self.yes.pk: 1}, at=self.now - days_ago * day)
+        # Events not rolled up yet are kept.
+        self.assertEqual(vote_history.apply_retention(self.now), 0)
+        vote_history.roll_up()
+        vote_history.apply_retention(self.now)
+        self.assertEqual(VoteEvent.objects.count(), 1)
+        self.assertEqual(len(self.rollups(vote_history.MINUTE)), 2)
+        self.assertEqual(len(self.rollups(vote_history.HOUR)), 3)
+        self.assertEqual(sum(n for _, _, n in self.rollups(vote_history.DAY)), 4)
+        # More events are rolled up after the cursor, not recounted.
+        vote_history.record(q, {self.yes.pk: 1}, at=self.now)
+        self.assertEqual(vote_history.roll_up(), 1)
+        self.assertEqual(
+            VoteRollupCursor.objects.get().last_event_id,
+            VoteEvent.objects.latest("pk").pk,
+        )
+
+    def test_trend_endpoint_reads_rollups(self):
+        now = int(time.time())
+        q = self.question.pk
+        vote_history.record(q, {self.yes.pk: 2, self.no.pk: 1}, at=now - 120)
+        vote_history.record(q, {self.yes.pk: 1}, at=now)
+        url = reverse("polls:trend", args=(q,))
+        self.assertEqual(self.client.get(url).json()["buckets"], [])
+        vote_history.roll_up()
+        with self.assertNumQueries(1):
+            trend = self.client.get(url).json()
+        self.assertEqual(trend["resolution"], "minute")
+        self.assertEqual(trend["until"] - trend["since"], 3600)
+        self.assertEqual(
+            [(b["total"], b["votes"]) for b in trend["buckets"]],
+            [
+                (3, {str(self.yes.pk): 2, str(self.no.pk): 1}),
+                (1, {str(self.yes.pk): 1}),
+            ],
+        )
+        trend = self.client.get(url, {"resolution": "day"}).json()
+        self.assertEqual(trend["buckets"][-1]["total"], 4)
+        since = datetime.datetime.fromtimestamp(now - 60, datetime.timezone.utc)
+        trend = self.client.get(url, {"since": since.isoformat()}).json()
+        self.assertEqual([b["total"] for b in trend["buckets"]], [1])
+        response = self.client.get(url, {"resolution": "week"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {"since": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+        for value in ["inf", "-inf", "nan", "1e300", "0001-01-01T00:00:00"]:
+            with self.subTest(value=value):
+                response = self.client.get(url, {"until": value})
+                self.assertEqual(response.status_code, 400)
+
+    @override_settings(ROOT_URLCONF="mysite.async_urls")
+    async def test_async_trend_endpoint(self):
+        await sync_to_async(vote_history.record)(self.question.pk, {self.yes.pk: 5})
+        await sync_to_async(vote_history.roll_up)()
+        response = await self.async_client.get(
+            reverse("polls:trend", args=(self.question.pk,)),
+            {"resolution": "hour"},
+        )
+        self.assertEqual(response.json()["buckets"][0]["total"], 5)
+
+
+@override_settings(POLLS_VOTE_DEDUP={"FLUSH_INTERVAL_MS": 0, "IDENTITY": "user_or_ip"})
+class VoteDedupTests(TestCase):
+    def setUp(self):
+        vote_dedup.reset()
+        self.addCleanup(vote_dedup.reset)
+        self.question = create_question(question_text="Once only?", days=-1)
+        self.yes = Choice.objects.create(question=self.question, choice_text="Yes")
+
+    def test_bloom_filter_stays_within_its_error_rate(self):
+        f = vote_dedup.BloomFilter(1000, 0.01)
+        self.assertTrue(all(f.add(vote_dedup.filter_hashes(v)) for v in range(1000)))
+        self.assertTrue(f.full)
+        self.assertTrue(all(vote_dedup.filter_hashes(v) in f for v in range(1000)))
+        false_positives = sum(
+            vote_dedup.filter_hashes(v) in f for v in range(1000, 21000)
+        )
+        self.assertLess(false_positives / 20000, 0.02)
+        self.assertLess(f.false_positive_rate(), 0.02)
+
+    def test_scalable_filter_grows_within_its_budget(self):
+        f = vote_dedup.ScalableBloomFilter(100, 0.01)
+        for v in range(1000):
+            f.add(vote_dedup.filter_hashes(v))
+        self.assertEqual(len(f.slices), 4)
+        self.assertEqual([s.capacity for s in f.slices], [100, 200, 400, 800])
+        self.assertGreater(f.count, 980)
+        self.assertLess(f.false_positive_rate(), 0.01)
+        self.assertFalse(f.add(vote_dedup.filter_hashes(5)))
+
+    def test_repeat_voter_is_rejected(self):
+        deduplicator = vote_dedup.get_deduplicator()
+        q = self.question.pk
+        self.assertTrue(deduplicator.admit(q, 1))
+        self.assertTrue(deduplicator.admit(q, 2))
+        self.assertTrue(deduplicator.admit(q + 1, 1))
+        with self.assertNumQueries(1):
+            self.assertFalse(deduplicator.admit(q, 1))
+        self.assertEqual(
+            sorted(VoteReceipt.objects.values_list("question_id", "voter")),
+            [(q, 1), (q, 2), (q + 1, 1)],
+        )
+
+    def test_new_voter_costs_no_lookup(self):
+        deduplicator = vote_dedup.build_deduplicator(flush_interval_ms=500)
+        deduplicator.loaded.set()
+        with self.assertNumQueries(0):
+            self.assertTrue(deduplicator.admit(self.question.pk, 1))
+            self.assertFalse(deduplicator.admit(self.question.pk, 1))
+        self.assertEqual(deduplicator.flush(), 1)
+        with self.assertNumQueries(1):
+            self.assertFalse(deduplicator.admit(self.question.pk, 1))
+
+    def test_false_positives_fall_back_to_receipts(self):
+        deduplicator = vote_dedup.get_deduplicator()
+        q = self.question.pk
+        hashes = vote_dedup.filter_hashes(7)
+        with mock.patch.object(vote_dedup, "filter_hashes", return_value=hashes):
+            self.assertTrue(deduplicator.admit(q, 7))
+            with self.assertNumQueries(2):
+                self.assertTrue(deduplicator.admit(q, 8))
+            self.assertFalse(deduplicator.admit(q, 8))
+
+    def test_unloaded_filters_check_receipts(self):
+        VoteReceipt.objects.create(question_id=self.question.pk, voter=3)
+        deduplicator = vote_dedup.build_deduplicator(flush_interval_ms=500)
+        self.assertFalse(deduplicator.admit(self.question.pk, 3))
+        self.assertTrue(deduplicator.admit(self.question.pk, 4))
+        self.assertFalse(deduplicator.admit(self.question.pk, 4))
+
+    def test_sync_reads_other_processes_receipts(self):
+        deduplicator = vote_dedup.get_deduplicator()
+        VoteReceipt.objects.create(question_id=self.question.pk, voter=9)
+        self.assertEqual(deduplicator.sync(), 1)
+        self.assertEqual(deduplicator.sync(), 0)
+        self.assertIn(
+            vote_dedup.filter_hashes(9), deduplicator.filters[self.question.pk]
+        )
+
+    def test_snapshot_round_trip(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = {"FLUSH_INTERVAL_MS": 0, "SNAPSHOT_DIR": directory.name}
+        with self.settings(POLLS_VOTE_DEDUP=config):
+            deduplicator = vote_dedup.get_deduplicator()
+            for voter in range(2500):
+                deduplicator.admit(self.question.pk, voter)
+            vote_dedup.reset()
+            path = Path(directory.name) / "vote-dedup.bloom"
+            filters, synced_id = vote_dedup.read_snapshot(path)
+            self.assertEqual(synced_id, VoteReceipt.objects.latest("pk").pk)
+            restored = filters[self.question.pk]
+            original = deduplicator.filters[self.question.pk]
+            self.assertEqual(restored.count, original.count)
+            self.assertEqual(len(restored.slices), 2)
+            self.assertEqual(
+                [bytes(s.bits) for s in restored.slices],
+                [bytes(s.bits) for s in original.slices],
+            )
+            with self.assertNumQueries(1):
+                restarted = vote_dedup.get_deduplicator()
+            self.assertEqual(restarted.filters[self.question.pk].count, original.count)
+            vote_dedup.reset()
+        path.write_bytes(b"garbage")
+        self.assertEqual(vote_dedup.read_snapshot(path), ({}, 0))
+
+    def test_vote_view_rejects_second_vote(self):
+        url = reverse("polls:vote", args=(self.question.pk,))
+        self.assertEqual(
+            self.client.post(url, {"choice": self.yes.pk}).status_code, 302
+        )
+        response = self.client.post(url, {"choice": self.yes.pk})
+        self.assertContains(
+            response, "You have already voted in this poll.", status_code=409
+        )
+        other = self.client.post(
+            url, {"choice": self.yes.pk}, REMOTE_ADDR="198.51.100.7"
+        )
+        self.assertEqual(other.status_code, 302)
+        self.assertEqual(Choice.objects.get().total_votes(), 2)
+        with self.settings(POLLS_VOTE_DEDUP={"ENABLED": False}):
+            response = self.client.post(url, {"choice": self.yes.pk})
+        self.assertEqual(response.status_code, 302)
+
+    def test_logged_in_voters_are_keyed_by_user(self):
+        user = User.objects.create_user("voter", password="pw")
+        url = reverse("polls:vote", args=(self.question.pk,))
+        self.client.force_login(user)
+        self.assertEqual(
+            self.client.post(url, {"choice": self.yes.pk}).status_code, 302
+        )
+        response = self.client.post(
+            url, {"choice": self.yes.pk}, REMOTE_ADDR="198.51.100.7"
+        )
+        self.assertEqual(response.status_code, 409)
+        self.client.logout()
+        self.assertEqual(
+            self.client.post(url, {"choice": self.yes.pk}).status_code, 302
+        )
+
+    def test_failed_vote_does_not_lock_voter_out(self):
+        url = reverse("polls:vote", args=(self.question.pk,))
+        with mock.patch("polls.views.submit_vote", side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                self.client.post(url, {"choice": self.yes.pk})
+        self.assertFalse(VoteReceipt.objects.exists())
+        response = self.client.post(url, {"choice": self.yes.pk})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.post(url, {"choice": self.yes.pk})
+        self.assertEqual(response.status_code, 409)
+
+    @override_settings(ROOT_URLCONF="mysite.async_urls")
+    async def test_failed_async_vote_does_not_lock_voter_out(self):
+        url = reverse("polls:vote", args=(self.question.pk,))
+        with mock.patch("polls.async_views.asubmit_vote", side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                await self.async_client.post(url, {"choice": self.yes.pk})
+        response = await self.async_client.post(url, {"choice": self.yes.pk})
+        self.assertEqual(response.status_code, 302)
+
+    def test_anonymous_votes_are_not_checked_by_default(self):
+        url = reverse("polls:vote", args=(self.question.pk,))
+        with self.settings(POLLS_VOTE_DEDUP={"FLUSH_INTERVAL_MS": 0}):
+            for _ in range(2):
+                response = self.client.post(url, {"choice": self.yes.pk})
+                self.assertEqual(response.status_code, 302)
+        self.assertFalse(VoteReceipt.objects.exists())
+
+    @override_settings(ROOT_URLCONF="mysite.async_urls")
+    async def test_async_vote_view_rejects_second_vote(self):
+        url = reverse("polls:vote", args=(self.question.pk,))
+        response = await self.async_client.post(url, {"choice": self.yes.pk})
+        self.assertEqual(response.status_code, 302)
+        response = await self.async_client.post(url, {"choice": self.yes.pk})
+        self.assertEqual(response.status_code, 409)
+
+    def test_stats_command(self):
+        deduplicator = vote_dedup.get_deduplicator()
+        for voter in range(3):
+            deduplicator.admit(self.question.pk, voter)
+        out = StringIO()
+        call_command("vote_dedup_stats", stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1].split()[:3], [str(self.question.pk), "3", "1"])
+        self.assertEqual(lines[-1], "1 poll(s), 3 voter(s), 1978 bytes of filters.")
+
+
+class PublishingTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+
+    def schedule(self, text, seconds):
+        return Question.objects.create(
+            question_text=text,
+            pub_date=self.now + datetime.timedelta(seconds=seconds),
+        )
+
+    def published(self):
+        return set(
+            Question.objects.filter(is_published=True).values_list("pk", flat=True)
+        )
+
+    def test_save_sets_is_published(self):
+        past = create_question(question_text="Past.", days=-1)
+        future = create_question(question_text="Future.", days=1)
+        self.assertEqual(self.published(), {past.pk})
+        past.pub_date = self.now + datetime.timedelta(days=1)
+        past.save(update_fields=["pub_date"])
+        future.pub_date = self.now - datetime.timedelta(days=1)
+        future.save()
+        self.assertEqual(self.published(), {future.pk})
+
+    def test_scheduler_publishes_in_pub_date_order(self):
+        third = self.schedule("Third.", 30)
+        first = self.schedule("First.", 10)
+        second = self.schedule("Second.", 20)
+        self.schedule("Tomorrow.", 86400)
+        scheduler = publishing.Scheduler(lookahead=60, reload_interval=60)
+        self.assertEqual(scheduler.reload(self.now), 3)
+        self.assertEqual(scheduler.next_wakeup(self.now), 10)
+        later = self.now + datetime.timedelta(seconds=15)
+        self.assertEqual(scheduler.publish_due(self.now), [])
+        self.assertEqual(scheduler.publish_due(later), [first.pk])
+        self.assertEqual(scheduler.next_wakeup(later), 5)
+        later += datetime.timedelta(seconds=20)
+        self.assertEqual(scheduler.publish_due(later), [second.pk, third.pk])
+        self.assertEqual(self.published(), {first.pk, second.pk, third.pk})
+        self.assertEqual(scheduler.next_wakeup(later), 25)
+
+    def test_rescheduled_questions_are_left_alone(self):
+        moved = self.schedule("Moved.", 10)
+        scheduler = publishing.Scheduler(lookahead=60)
+        scheduler.reload(self.now)
+        Question.objects.filter(pk=moved.pk).update(
+            pub_date=self.now + datetime.timedelta(days=1)
+        )
+        later = self.now + datetime.timedelta(seconds=15)
+        self.assertEqual(scheduler.publish_due(later), [])
+        self.assertEqual(self.published(), set())
+
+    def test_reload_takes_down_questions_moved_into_the_future(self):
+        question = create_question(question_text="Early.", days=-1)
+        Question.objects.filter(pk=question.pk).update(
+            pub_date=self.now + datetime.timedelta(days=1)
+        )
+        publishing.Scheduler().reload()
+        self.assertEqual(self.published(), set())
+
+    def test_publication_invalidates_caches_and_notifies(self):
+        question = self.schedule("Live soon.", 10)
+        cache = index_cache.get_cache()
+        index_version = index_cache.get_version(cache)
+        http_version = http_cache.get_version(question.pk)
+        later = self.now + datetime.timedelta(seconds=10)
+        with mock.patch.object(live, "announce") as announce:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(
+                    publishing.publish([question.pk], later), [question.pk]
+                )
+        announce.assert_called_once_with(
+            question.pk, "published", {"question": question.pk}
+        )
+        self.assertNotEqual(index_cache.get_version(cache), index_version)
+        self.assertNotEqual(http_cache.get_version(question.pk), http_version)
+
+    async def test_hub_sends_announcements_at_once(self):
+        hub = live.Hub(max_updates_per_sec=1)
+        subscriber = hub.subscribe(3)
+        hub.announce(3, "published", {"question": 3})
+        self.assertEqual(
+            await subscriber.get(timeout=2),
+            live.sse_event("published", {"question": 3}),
+        )
+
+    def test_index_and_detail_follow_the_flag(self):
+        index_cache.get_cache().clear()
+        question = create_question(question_text="Scheduled.", days=1)
+        Question.objects.filter(pk=question.pk).update(
+            pub_date=self.now - datetime.timedelta(seconds=1)
+        )
+        self.assertNotContains(self.client.get(reverse("polls:index")), "Scheduled.")
+        detail = reverse("polls:detail", args=(question.pk,))
+        self.assertEqual(self.client.get(detail).status_code, 404)
+        choice = question.choice_set.create(choice_text="Yes")
+        vote = reverse("polls:vote", args=(question.pk,))
+        self.assertEqual(self.client.post(vote, {"choice": choice.pk}).status_code, 404)
+        # Due but not yet published: the publishing worker invalidates the
+        # fragment, so its timeout isn't cut short.
+        self.assertEqual(index_cache.get_timeout(), 300)
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("publish_questions", "--once", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Published 1 question(s).")
+        self.assertContains(self.client.get(reverse("polls:index")), "Scheduled.")
+        self.assertContains(self.client.get(detail), "Scheduled.")
+        self.assertEqual(self.client.post(vote, {"choice": choice.pk}).status_code, 302)
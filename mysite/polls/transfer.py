@@ -0,0 +1,376 @@
+"""
+Bulk export and import of questions with their choices and vote counts.
+
+Two formats are supported:
+
+* ``ndjson``: one JSON object per question, with its choices nested::
+
+    {"id": 1, "question_text": "...", "pub_date": "2024-05-01T12:00:00+00:00",
+     "owner": "alice", "access_code": null,
+     "choices": [{"id": 3, "choice_text": "...", "votes": 12}]}
+
+* ``csv``: one row per choice, with the question's columns repeated and the
+  rows of a question kept together. A question without choices is one row
+  with empty choice columns. Consecutive rows without a ``question_id``
+  are one question when the rest of its columns match.
+
+``export_lines()`` reads questions in primary key order with
+``iterator(chunk_size=...)``, prefetching each chunk's choices, so memory
+use doesn't depend on the size of the table. Votes are exported as totals,
+including any not yet compacted from vote shards.
+
+``import_records()`` works through its input ``batch_size`` questions at a
+time, one transaction per batch:
+
+* Owners are looked up by username once per batch; unknown names leave the
+  question unowned.
+* Rows with an ``id`` are upserted on it, so importing the same file twice
+  leaves the same data; rows without one are inserted. Choices missing from
+  the file are left alone. An ID may only appear once per batch.
+* Imported choices get the exported total as ``votes``, and their pending
+  vote shards are dropped, so vote counts aren't doubled by a re-import.
+
+bulk_create() doesn't call save() or send signals, so imported questions
+get is_published from their pub_date here, and each batch's questions have
+their caches invalidated directly.
+"""
+
+import csv
+import datetime
+import itertools
+import json
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Prefetch, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import http_cache, index_cache, results_cache
+from .models import Choice, ChoiceVoteShard, Question
+
+FORMATS = ["ndjson", "csv"]
+CSV_FIELDS = [
+    "question_id",
+    "question_text",
+    "pub_date",
+    "owner",
+    "access_code",
+    "choice_id",
+    "choice_text",
+    "votes",
+]
+DEFAULT_CHUNK_SIZE = 2000
+
+
+class InvalidRecord(ValueError):
+    """
+    A record that can't be imported; the message names its line.
+    """
+
+
+def export_queryset(chunk_size=DEFAULT_CHUNK_SIZE):
+    choices = Choice.objects.annotate(
+        pending=Coalesce(Sum("vote_shards__count"), 0)
+    ).order_by("pk")
+    return (
+        Question.objects.order_by("pk")
+        .select_related("owner")
+        .prefetch_related(Prefetch("choice_set", queryset=choices))
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def question_record(question):
+    return {
+        "id": question.pk,
+        "question_text": question.question_text,
+        "pub_date": question.pub_date.isoformat(),
+        "owner": question.owner.username if question.owner else None,
+        "access_code": question.access_code,
+        "choices": [
+            {
+                "id": choice.pk,
+                "choice_text": choice.choice_text,
+                "votes": choice.votes + choice.pending,
+            }
+            for choice in question.choice_set.all()
+        ],
+    }
+
+
+class Echo:
+    """
+    A file-like object csv.writer can write a row to and hand it straight
+    back.
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_lines(format="ndjson", chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield every question as lines of format, headers first for CSV.
+    """
+    records = map(question_record, export_queryset(chunk_size))
+    if format == "ndjson":
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+        return
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_FIELDS)
+    for record in records:
+        question = [
+            record["id"],
+            record["question_text"],
+            record["pub_date"],
+            record["owner"] or "",
+            record["access_code"] or "",
+        ]
+        for choice in record["choices"] or [None]:
+            if choice is None:
+                yield writer.writerow(question + ["", "", ""])
+            else:
+                yield writer.writerow(
+                    question + [choice["id"], choice["choice_text"], choice["votes"]]
+                )
+
+
+async def aexport_lines(format="ndjson", chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    export_lines() for async views: the export runs in the sync thread a
+    chunk at a time, rather than being collected in full as Django does
+    with sync iterators under ASGI.
+    """
+    lines = export_lines(format, chunk_size)
+    take = sync_to_async(lambda: list(itertools.islice(lines, chunk_size)))
+    try:
+        while batch := await take():
+            for line in batch:
+                yield line
+    finally:
+        await sync_to_async(lines.close)()
+
+
+def read_ndjson(lines):
+    """
+    Yield (line number, record) for each non-blank line.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as e:
+            raise InvalidRecord(f"Line {number}: invalid JSON ({e}).")
+
+
+def question_key(row):
+    if row["question_id"]:
+        return row["question_id"]
+    return tuple(row[field] for field in CSV_FIELDS[1:5])
+
+
+def read_csv(lines):
+    """
+    Yield (line number, record) per question, gathering its rows.
+    """
+    rows = csv.DictReader(lines)
+    missing = set(CSV_FIELDS) - set(rows.fieldnames or ())
+    if missing:
+        raise InvalidRecord(f"Line 1: missing columns {', '.join(sorted(missing))}.")
+    numbered = ((rows.line_num, row) for row in rows)
+    # Rows without a question_id belong to the same question as long as its
+    # columns repeat.
+    for _, group in itertools.groupby(numbered, lambda item: question_key(item[1])):
+        group = list(group)
+        number, first = group[0]
+        yield number, {
+            "id": first["question_id"] or None,
+            "question_text": first["question_text"],
+            "pub_date": first["pub_date"],
+            "owner": first["owner"] or None,
+            "access_code": first["access_code"] or None,
+            "choices": [
+                {
+                    "id": row["choice_id"] or None,
+                    "choice_text": row["choice_text"],
+                    "votes": row["votes"] or 0,
+                }
+                for _, row in group
+                if row["choice_id"] or row["choice_text"]
+            ],
+        }
+
+
+READERS = {"ndjson": read_ndjson, "csv": read_csv}
+
+
+def optional_int(value, number, field):
+    if value in (None, ""):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise InvalidRecord(f"Line {number}: {field} must be an integer.")
+    if value < 0:
+        raise InvalidRecord(f"Line {number}: {field} can't be negative.")
+    return value
+
+
+def parse_pub_date(value, number):
+    try:
+        pub_date = parse_datetime(value or "")
+    except (TypeError, ValueError):
+        pub_date = None
+    if pub_date is None:
+        raise InvalidRecord(f"Line {number}: pub_date must be an ISO 8601 datetime.")
+    if timezone.is_naive(pub_date):
+        pub_date = timezone.make_aware(pub_date, datetime.timezone.utc)
+    return pub_date
+
+
+def text(value, number, field):
+    if not isinstance(value, str) or not value:
+        raise InvalidRecord(f"Line {number}: {field} is required.")
+    if len(value) > 200:
+        raise InvalidRecord(f"Line {number}: {field} is over 200 characters.")
+    return value
+
+
+def check_unique(pk, number, field, seen):
+    """
+    Reject an ID already used on an earlier line of the batch, which a
+    single upsert can't apply twice.
+    """
+    if pk is None:
+        return
+    if pk in seen:
+        raise InvalidRecord(
+            f"Line {number}: {field} {pk} is repeated from line {seen[pk]}."
+        )
+    seen[pk] = number
+
+
+def build_batch(batch, owners):
+    """
+    Return (questions, choices by question index) from (line number,
+    record) pairs.
+    """
+    now = timezone.now()
+    questions = []
+    choices = []
+    question_lines = {}
+    choice_lines = {}
+    for number, record in batch:
+        if not isinstance(record, dict):
+            raise InvalidRecord(f"Line {number}: expected an object.")
+        question = Question(
+            pk=optional_int(record.get("id"), number, "id"),
+            question_text=text(record.get("question_text"), number, "question_text"),
+            pub_date=parse_pub_date(record.get("pub_date"), number),
+            owner_id=owners.get(record.get("owner")),
+            access_code=record.get("access_code") or None,
+        )
+        question.is_published = question.pub_date <= now
+        check_unique(question.pk, number, "id", question_lines)
+        questions.append(question)
+        rows = []
+        for choice in record.get("choices") or ():
+            if not isinstance(choice, dict):
+                raise InvalidRecord(f"Line {number}: expected choices to be objects.")
+            rows.append(
+                Choice(
+                    pk=optional_int(choice.get("id"), number, "choice id"),
+                    choice_text=text(choice.get("choice_text"), number, "choice_text"),
+                    votes=optional_int(choice.get("votes"), number, "votes") or 0,
+                )
+            )
+            check_unique(rows[-1].pk, number, "choice id", choice_lines)
+        choices.append(rows)
+    return questions, choices
+
+
+def upsert(model, objects, update_fields, batch_size):
+    """
+    Upsert objects that have a primary key and insert the others.
+    """
+    keyed = [obj for obj in objects if obj.pk is not None]
+    new = [obj for obj in objects if obj.pk is None]
+    if keyed:
+        model.objects.bulk_create(
+            keyed,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=["id"],
+            update_fields=update_fields,
+        )
+    if new:
+        model.objects.bulk_create(new, batch_size=batch_size)
+
+
+def import_batch(batch, batch_size):
+    usernames = {record.get("owner") for _, record in batch if isinstance(record, dict)}
+    usernames.discard(None)
+    owners = dict(
+        User.objects.filter(username__in=usernames).values_list("username", "id")
+    )
+    questions, choices = build_batch(batch, owners)
+    with transaction.atomic():
+        upsert(
+            Question,
+            questions,
+            ["question_text", "pub_date", "is_published", "owner", "access_code"],
+            batch_size,
+        )
+        rows = []
+        for question, question_choices in zip(questions, choices):
+            for choice in question_choices:
+                choice.question_id = question.pk
+                rows.append(choice)
+        upsert(Choice, rows, ["question", "choice_text", "votes"], batch_size)
+        ChoiceVoteShard.objects.filter(
+            choice_id__in=[choice.pk for choice in rows]
+        ).delete()
+    for question in questions:
+        results_cache.invalidate(question.pk)
+        http_cache.bump(question.pk)
+    return {
+        "questions": len(questions),
+        "choices": len(rows),
+        "unknown_owners": len(usernames - owners.keys()),
+    }
+
+
+def reset_sequences():
+    """
+    Move ID sequences past imported IDs, on databases that have them.
+    """
+    statements = connection.ops.sequence_reset_sql(no_style(), [Question, Choice])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+
+def import_records(records, batch_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Import (line number, record) pairs, as yielded by READERS, and return
+    counts of what was imported.
+    """
+    totals = {"questions": 0, "choices": 0, "unknown_owners": 0}
+    try:
+        while batch := list(itertools.islice(records, batch_size)):
+            for name, count in import_batch(batch, batch_size).items():
+                totals[name] += count
+            if progress is not None:
+                progress(totals)
+    finally:
+        if totals["questions"]:
+            reset_sequences()
+            index_cache.invalidate()
+    return totals
@@ -0,0 +1,218 @@
+"""
+Unlocked private polls, and access code checks.
+
+The polls a browser has unlocked are kept as one compact token: the
+sorted question IDs as delta-encoded varints, so neighbouring IDs take a
+byte each. With ``STORE = "cookie"`` (the default) the token is a signed
+cookie and checking an unlock never touches the database. With
+``STORE = "session"`` it is a single session key, which is cheap with a
+cache or signed-cookie session engine.
+
+Access code checks go through a VerificationCache, so a hashed code only
+costs a key derivation the first time each guess is seen:
+
+* Results are kept for ``CACHE_TTL`` seconds, keyed by an HMAC of the
+  stored and entered codes, in an LRU of at most ``CACHE_SIZE`` entries.
+* A client that enters ``MAX_FAILURES`` wrong codes for a poll within
+  ``FAILURE_WINDOW`` seconds is refused without any check until the window
+  ends, so brute force can't turn into a CPU hotspot.
+
+Both live in the process, so each worker keeps its own limits.
+"""
+
+import base64
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, identify_hasher
+from django.utils.crypto import salted_hmac
+
+DEFAULTS = {
+    "STORE": "cookie",
+    "COOKIE_NAME": "polls_unlocked",
+    "COOKIE_AGE": 60 * 60 * 24 * 14,
+    "MAX_UNLOCKS": 500,
+    "CACHE_SIZE": 10000,
+    "CACHE_TTL": 300,
+    "MAX_FAILURES": 10,
+    "FAILURE_WINDOW": 60,
+}
+
+SALT = "polls.unlocks"
+SESSION_KEY = "polls_unlocked"
+
+
+def get_access_settings():
+    return {**DEFAULTS, **getattr(settings, "POLLS_ACCESS", {})}
+
+
+def encode_ids(ids):
+    out = bytearray()
+    previous = 0
+    for pk in sorted(set(ids)):
+        delta = pk - previous
+        previous = pk
+        while delta >= 0x80:
+            out.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return base64.urlsafe_b64encode(bytes(out)).rstrip(b"=").decode()
+
+
+def decode_ids(token):
+    """
+    Return the IDs in token, or an empty set if it can't be decoded.
+    """
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (ValueError, TypeError):
+        return frozenset()
+    ids = []
+    pk = delta = shift = 0
+    for byte in data:
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        pk += delta
+        ids.append(pk)
+        delta = shift = 0
+    return frozenset(ids)
+
+
+def read_cookie(request, config):
+    token = request.get_signed_cookie(
+        config["COOKIE_NAME"], default="", salt=SALT, max_age=config["COOKIE_AGE"]
+    )
+    return decode_ids(token)
+
+
+def get_unlocked(request):
+    config = get_access_settings()
+    if config["STORE"] == "session":
+        return decode_ids(request.session.get(SESSION_KEY, ""))
+    return read_cookie(request, config)
+
+
+async def aget_unlocked(request):
+    config = get_access_settings()
+    if config["STORE"] == "session":
+        return decode_ids(await request.session.aget(SESSION_KEY, ""))
+    return read_cookie(request, config)
+
+
+def unlock(request, response, question_id):
+    """
+    Add question_id to the polls request has unlocked, on response.
+    """
+    config = get_access_settings()
+    ids = set(get_unlocked(request))
+    ids.add(question_id)
+    # Forget the oldest polls rather than let the token grow without bound.
+    ids = sorted(ids)[-config["MAX_UNLOCKS"] :]
+    if config["STORE"] == "session":
+        request.session[SESSION_KEY] = encode_ids(ids)
+    else:
+        response.set_signed_cookie(
+            config["COOKIE_NAME"],
+            encode_ids(ids),
+            salt=SALT,
+            max_age=config["COOKIE_AGE"],
+            httponly=True,
+            samesite="Lax",
+        )
+    return response
+
+
+def code_matches(stored, entered):
+    try:
+        identify_hasher(stored)
+    except ValueError:
+        # Flaw 4: Direct plaintext comparison for codes that aren't hashed
+        return entered == stored
+    return check_password(entered, stored)
+
+
+class VerificationCache:
+    def __init__(self, size=10000, ttl=300, max_failures=10, failure_window=60):
+        self.size = size
+        self.ttl = ttl
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+        self.results = OrderedDict()
+        self.failures = OrderedDict()
+        self.lock = threading.Lock()
+        self.checks = 0
+
+    def is_throttled(self, client, question_id):
+        with self.lock:
+            entry = self.failures.get((client, question_id))
+            if entry is None:
+                return False
+            started, count = entry
+            if time.monotonic() - started >= self.failure_window:
+                del self.failures[(client, question_id)]
+                return False
+            return count >= self.max_failures
+
+    def record_failure(self, client, question_id):
+        key = (client, question_id)
+        now = time.monotonic()
+        with self.lock:
+            started, count = self.failures.pop(key, (now, 0))
+            if now - started >= self.failure_window:
+                started, count = now, 0
+            self.failures[key] = (started, count + 1)
+            while len(self.failures) > self.size:
+                self.failures.popitem(last=False)
+
+    def verify(self, stored, entered):
+        key = salted_hmac(SALT, f"{stored}\0{entered}").hexdigest()
+        now = time.monotonic()
+        with self.lock:
+            cached = self.results.get(key)
+            if cached is not None and cached[1] > now:
+                self.results.move_to_end(key)
+                return cached[0]
+        self.checks += 1
+        matched = code_matches(stored, entered)
+        with self.lock:
+            self.results[key] = (matched, now + self.ttl)
+            self.results.move_to_end(key)
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+        return matched
+
+    def check(self, request, question, entered):
+        """
+        Return "ok", "invalid" or "throttled" for a code entered for
+        question by request's client.
+        """
+        client = request.META.get("REMOTE_ADDR", "")
+        if self.is_throttled(client, question.pk):
+            return "throttled"
+        if entered and self.verify(question.access_code, entered):
+            return "ok"
+        self.record_failure(client, question.pk)
+        return "invalid"
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_verifier():
+    global _verifier
+    if _verifier is None:
+        with _verifier_lock:
+            if _verifier is None:
+                config = get_access_settings()
+                _verifier = VerificationCache(
+                    size=config["CACHE_SIZE"],
+                    ttl=config["CACHE_TTL"],
+                    max_failures=config["MAX_FAILURES"],
+                    failure_window=config["FAILURE_WINDOW"],
+                )
+    return _verifier
@@ -1,17 +1,53 @@
 from django.urls import path
 
-from . import views
+from . import async_views, views
+from .db_tuning import read_database_view, read_your_writes
 
 app_name = "polls"
-urlpatterns = [
-    path("", views.IndexView.as_view(), name="index"),
-    path("<int:pk>/", views.DetailView.as_view(), name="detail"),
-    path("<int:pk>/results/", views.ResultsView.as_view(), name="results"),
-    path("<int:question_id>/vote/", views.vote, name="vote"),
-    # Flaw 1: SQL Injection vulnerable endpoint
-    path("search/", views.search_questions, name="search"),
-    # Flaw 2: Insecure direct object reference
-    path("<int:question_id>/delete/", views.delete_question, name="delete"),
-    # Flaw 4: Plaintext access code
-    path("<int:question_id>/access/", views.access_code_poll, name="access"),
-]
+
+
+def build_urlpatterns(views_module):
+    return [
+        path("", read_database_view(views_module.IndexView.as_view()), name="index"),
+        path(
+            "<int:pk>/",
+            read_database_view(views_module.DetailView.as_view()),
+            name="detail",
+        ),
+        path(
+            "<int:pk>/results/",
+            read_database_view(views_module.ResultsView.as_view()),
+            name="results",
+        ),
+        path(
+            "<int:question_id>/vote/",
+            read_your_writes(views_module.vote),
+            name="vote",
+        ),
+        path(
+            "search/", read_database_view(views_module.search_questions), name="search"
+        ),
+        path(
+            "<int:question_id>/trend/",
+            read_database_view(views_module.question_trend),
+            name="trend",
+        ),
+        path("export/", views_module.export_polls, name="export"),
+        # Async in both URLconfs; see live.py.
+        path("<int:question_id>/live/", async_views.live_results, name="live"),
+        # Flaw 2: Insecure direct object reference
+        path(
+            "<int:question_id>/delete/",
+            read_your_writes(views_module.delete_question),
+            name="delete",
+        ),
+        # Flaw 4: Plaintext access code
+        path(
+            "<int:question_id>/access/",
+            read_your_writes(views_module.access_code_poll),
+            name="access",
+        ),
+    ]
+
+
+urlpatterns = build_urlpatterns(views)
@@ -1,14 +1,32 @@
+from django.conf import settings
 from django.shortcuts import get_object_or_404, render
-from django.http import HttpResponseRedirect
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import (
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.template.loader import get_template, render_to_string
+from django.utils.html import escape
 
 # ,  HttpResponseForbidden
 from django.urls import reverse
 from django.views import generic
-from django.utils import timezone
-from django.db import connection
+from django.db.models import Prefetch
 
 # from django.contrib.auth.hashers import check_password
+from . import http_cache, vote_dedup, vote_history
+from .index_cache import get_fragment
 from .models import Choice, Question
+from .query_budget import query_budget
+from .ratelimit import rate_limit
+from .results_cache import get_results
+from .search import get_search_backend
+from .templatetags.polls_urls import url_template
+from .transfer import export_lines
+from .unlocks import get_unlocked, get_verifier, unlock
+from .voting import submit_vote
 
 # import logging
 
@@ -16,41 +34,106 @@ from .models import Choice, Question
 class IndexView(generic.ListView):
     template_name = "polls/index.html"
     context_object_name = "latest_question_list"
+    # Questions with their owners and the next scheduled pub_date when the
+    # list isn't cached, plus the session and user for the header.
+    query_budget = 4
 
     def get_queryset(self):
         """
         Return the last five published questions (not including those set to be
         published in the future).
         """
-        return Question.objects.filter(pub_date__lte=timezone.now()).order_by(
-            "-pub_date"
-        )[:5]
+        return (
+            Question.objects.filter(is_published=True)
+            .select_related("owner")
+            .only("question_text", "pub_date", "owner__username")
+            .order_by("-pub_date")[:5]
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["question_list_html"] = get_fragment(
+            self.request.user,
+            lambda: render_to_string(
+                "polls/index_questions.html", context, self.request
+            ),
+        )
+        return context
 
 
 class DetailView(generic.DetailView):
     model = Question
     template_name = "polls/detail.html"
+    # The question, its choices and, with POLLS_ACCESS["STORE"] = "session",
+    # the session holding unlocked polls.
+    query_budget = 3
 
     def get_queryset(self):
         """
         Excludes any questions that aren't published yet.
         """
-        return Question.objects.filter(pub_date__lte=timezone.now())
+        return (
+            Question.objects.filter(is_published=True)
+            .only("question_text", "access_code")
+            .prefetch_related(
+                Prefetch(
+                    "choice_set",
+                    queryset=Choice.objects.only("question_id", "choice_text"),
+                )
+            )
+        )
 
     def get(self, request, *args, **kwargs):
-        question = self.get_object()
-        if question.access_code and not request.session.get(f"access_{question.pk}"):
+        # Read the version before the question, so a change in between
+        # can't be served under the new ETag.
+        version = http_cache.get_version(kwargs["pk"])
+        unlocked = get_unlocked(request)
+        response = http_cache.detail_not_modified(request, version, unlocked)
+        if response is not None:
+            return response
+        self.object = question = self.get_object()
+        if question.access_code and question.pk not in unlocked:
             return HttpResponseRedirect(reverse("polls:access", args=(question.pk,)))
-        return super().get(request, *args, **kwargs)
+        context = self.get_context_data(object=question)
+        response = self.render_to_response(context)
+        # The ETag covers the CSRF cookie, which rendering may set.
+        response.add_post_render_callback(
+            lambda response: http_cache.patch_detail(
+                request, response, version, unlocked
+            )
+        )
+        return response
 
 
 class ResultsView(generic.DetailView):
     model = Question
     template_name = "polls/results.html"
+    # The question, plus its tally when it isn't cached yet.
+    query_budget = 2
 
+    def get_queryset(self):
+        return Question.objects.only("question_text")
 
+    def get(self, request, *args, **kwargs):
+        version = http_cache.get_version(kwargs["pk"])
+        response = http_cache.results_not_modified(request, kwargs["pk"], version)
+        if response is not None:
+            return response
+        response = super().get(request, *args, **kwargs)
+        return http_cache.patch_results(request, response, kwargs["pk"], version)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["results"] = get_results(self.object.pk)
+        return context
+
+
+# Two more than the view needs: one for the session the per-user limit
+# reads, one for a duplicate check the filters can't settle.
+@query_budget(6)
+@rate_limit("vote")
 def vote(request, question_id):
-    question = get_object_or_404(Question, pk=question_id)
+    question = get_object_or_404(Question, pk=question_id, is_published=True)
     # Flaw 3: CSRF, Accepts GET for voting
     try:
         choice_id = request.GET.get("choice") or request.POST.get("choice")
@@ -69,32 +152,43 @@ def vote(request, question_id):
             },
         )
     else:
-        selected_choice.votes += 1
-        selected_choice.save()
+        if not vote_dedup.admit(request, question.pk):
+            return render(
+                request,
+                "polls/detail.html",
+                {
+                    "question": question,
+                    "error_message": "You have already voted in this poll.",
+                },
+                status=409,
+            )
+        try:
+            submit_vote(selected_choice)
+        except Exception:
+            # The vote wasn't counted, so it mustn't lock the voter out.
+            vote_dedup.release(request, question.pk)
+            raise
         return HttpResponseRedirect(reverse("polls:results", args=(question.id,)))
 
 
-# Flaw 1: Injection A03
+@query_budget(2)
+@rate_limit("search")
 def search_questions(request):
 
     search_query = request.GET.get("q", "")
 
     # Flaw 5: No logging
 
-    with connection.cursor() as cursor:
-        query = (
-            "SELECT id, question_text, pub_date FROM polls_question WHERE question_text LIKE '%"
-            + search_query
-            + "%'"
+    # Fix 1: The search backend only ever passes the query as a parameter.
+    backend = get_search_backend()
+    if request.GET.get("stream") == "1" and getattr(
+        settings, "POLLS_SEARCH_STREAMING", False
+    ):
+        return StreamingHttpResponse(
+            stream_search_results(request, backend, search_query)
         )
-        cursor.execute(query)
-        results = cursor.fetchall()
 
-    # Fix 1:
-    # with connection.cursor() as cursor:
-    #     query = "SELECT id, question_text, pub_date FROM polls_question WHERE question_text LIKE %s"
-    #     cursor.execute(query, [f"%{search_query}%"])
-    #     results = cursor.fetchall()
+    page = backend.search_after(search_query, cursor=request.GET.get("cursor"))
 
     # Fix 5: Add logging to search_questions
     # import logging
@@ -102,19 +196,46 @@ def search_questions(request):
     # if any(char in search_query for char in ["OR", "'", "+"]):
     #     security_logger.warning(f"Potential SQL injection attempt: {search_query}")
 
-    questions = []
-    for row in results:
-        questions.append({"id": row[0], "question_text": row[1], "pub_date": row[2]})
-
     return render(
         request,
         "polls/search_results.html",
-        {"questions": questions, "search_query": search_query},
+        {"questions": page.results, "page": page, "search_query": search_query},
     )
 
+
+def stream_search_results(request, backend, search_query):
+    """
+    Render every match for search_query one row at a time, so memory use
+    doesn't depend on how many questions match.
+    """
+    context = {"search_query": search_query}
+    yield render_to_string("polls/search_form.html", context, request)
+    if not search_query:
+        return
+    yield f"<h2>Search Results for: &quot;{escape(search_query)}&quot;</h2>\n<ul>\n"
+    row = get_template("polls/search_row.html")
+    detail_url = url_template("polls:detail")
+    for question in backend.iter_matches(search_query):
+        yield row.render({"question": question, "detail_url": detail_url})
+    yield "</ul>\n"
+
+
+@query_budget(1)
+def question_trend(request, question_id):
+    """
+    Votes per choice per minute, hour or day, as JSON; see
+    polls/vote_history.py.
+    """
+    try:
+        args = vote_history.trend_args(request.GET)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return JsonResponse(vote_history.trend(question_id, *args))
+
     # Flaw 2: Broken Access Control A01
 
 
+@query_budget(10)
 def delete_question(request, question_id):
     question = get_object_or_404(Question, pk=question_id)
     user_id = request.GET.get("user_id") or request.POST.get("user_id")
@@ -175,6 +296,8 @@ def delete_question(request, question_id):
     # Flaw 5: No logging
 
 
+@query_budget(3)
+@rate_limit("access")
 def access_code_poll(request, question_id):
     question = get_object_or_404(Question, pk=question_id)
 
@@ -183,10 +306,21 @@ def access_code_poll(request, question_id):
 
     if request.method == "POST":
         entered_code = request.POST.get("access_code", "")
-        # Flaw 4: Direvt plaintext comparison
-        if entered_code == question.access_code:
-            request.session[f"access_{question_id}"] = True
-            return HttpResponseRedirect(reverse("polls:detail", args=(question_id,)))
+        # Flaw 4: Direvt plaintext comparison (see unlocks.code_matches)
+        outcome = get_verifier().check(request, question, entered_code)
+        if outcome == "ok":
+            return unlock(
+                request,
+                HttpResponseRedirect(reverse("polls:detail", args=(question_id,))),
+                question.pk,
+            )
+        elif outcome == "throttled":
+            return render(
+                request,
+                "polls/access.html",
+                {"question": question, "error": "Too many attempts, try again later"},
+                status=429,
+            )
         else:
             return render(
                 request,
@@ -197,6 +331,29 @@ def access_code_poll(request, question_id):
     return render(request, "polls/access.html", {"question": question})
 
 
+EXPORT_CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def export_response(lines, format):
+    response = StreamingHttpResponse(
+        lines, content_type=f"{EXPORT_CONTENT_TYPES[format]}; charset=utf-8"
+    )
+    response["Content-Disposition"] = f'attachment; filename="polls.{format}"'
+    return response
+
+
+# Staff only: the export includes access codes.
+@staff_member_required
+def export_polls(request):
+    """
+    Stream every question with its choices and votes; see polls/transfer.py.
+    """
+    format = request.GET.get("format", "ndjson")
+    if format not in EXPORT_CONTENT_TYPES:
+        return HttpResponseBadRequest("format must be ndjson or csv.")
+    return export_response(export_lines(format), format)
+
+
 # Fix 4:
 # from django.contrib.auth.hashers import check_password
 
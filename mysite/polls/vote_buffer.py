@@ -0,0 +1,336 @@
+"""
+Write-behind vote buffer.
+
+In buffered mode (``POLLS_VOTE_MODE = "buffered"``) the vote view hands votes
+to a process-wide VoteBuffer and returns immediately. A background thread
+merges the buffered increments per Choice and applies them in one bulk
+UPDATE every ``FLUSH_INTERVAL_MS`` or as soon as ``FLUSH_SIZE`` votes are
+waiting, whichever comes first.
+
+Every accepted vote is appended to a local journal first. When a batch is
+taken for flushing the journal is rotated aside and only deleted once the
+batch has been committed, so a crash loses nothing: leftover journals are
+replayed when a buffer starts up again or by ``manage.py drain_votes``.
+Replay is at-least-once; a crash between commit and journal removal
+recounts that batch.
+
+Each process writes its own journal, ``JOURNAL`` suffixed with its pid,
+and holds an exclusive lock on it (``<journal>.lock``) for as long as it
+runs. Replay only touches journals whose lock it can take, so a starting
+worker picks up what dead processes left behind and never the journals of
+workers still running.
+"""
+
+import atexit
+import fcntl
+import os
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, Value, When
+
+from .models import Choice
+from .signals import votes_committed
+
+DEFAULTS = {
+    "FLUSH_INTERVAL_MS": 50,
+    "FLUSH_SIZE": 500,
+    "JOURNAL": None,
+    "JOURNAL_FSYNC": False,
+}
+
+
+def get_buffer_settings():
+    return {**DEFAULTS, **getattr(settings, "POLLS_VOTE_BUFFER", {})}
+
+
+def apply_vote_counts(counts, question_ids=None):
+    """
+    Add the given {choice_id: votes} increments in a single UPDATE and update
+    the cached results of the affected questions once it commits.
+    question_ids maps choice ids to question ids; choices missing from it
+    are looked up.
+    """
+    if not counts:
+        return 0
+    question_ids = dict(question_ids or {})
+    missing = [pk for pk in counts if question_ids.get(pk) is None]
+    if missing:
+        question_ids.update(
+            Choice.objects.filter(pk__in=missing).values_list("pk", "question_id")
+        )
+
+    by_question = {}
+    for pk, n in counts.items():
+        if pk in question_ids:
+            by_question.setdefault(question_ids[pk], {})[pk] = n
+
+    def update_cached_results():
+        for question_id, question_counts in by_question.items():
+            votes_committed.send(
+                sender=Choice, question_id=question_id, counts=question_counts
+            )
+
+    increment = Case(
+        *[When(pk=pk, then=Value(n)) for pk, n in counts.items()],
+        default=Value(0),
+    )
+    with transaction.atomic():
+        Choice.objects.filter(pk__in=counts).update(votes=F("votes") + increment)
+        transaction.on_commit(update_cached_results)
+    return sum(counts.values())
+
+
+def read_journal(path):
+    counts = Counter()
+    with open(path) as journal:
+        for line in journal:
+            line = line.strip()
+            if line.isdigit():
+                counts[int(line)] += 1
+    return counts
+
+
+def process_journal(journal, pid=None):
+    journal = Path(journal)
+    return journal.with_name(f"{journal.name}-{os.getpid() if pid is None else pid}")
+
+
+def rotations(journal_path):
+    """
+    Return the rotated batches of a journal, <name>.<n>, oldest first.
+    """
+    pattern = re.compile(re.escape(journal_path.name) + r"\.(\d+)")
+    found = []
+    for path in journal_path.parent.glob(journal_path.name + ".*"):
+        match = pattern.fullmatch(path.name)
+        if match:
+            found.append((int(match[1]), path))
+    return [path for _, path in sorted(found)]
+
+
+def lock_journal(journal_path):
+    """
+    Take the exclusive lock on a journal and return the open lock file, or
+    None if another process holds it.
+    """
+    lock = open(f"{journal_path}.lock", "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def replay_journals(journal_path):
+    """
+    Apply every vote left in the journal (and any rotated batch that never
+    finished flushing) to the database and remove the files. The caller
+    must hold the journal's lock.
+    """
+    journal_path = Path(journal_path)
+    leftovers = rotations(journal_path)
+    if journal_path.exists():
+        leftovers.append(journal_path)
+
+    replayed = 0
+    for path in leftovers:
+        replayed += apply_vote_counts(read_journal(path))
+        path.unlink()
+    return replayed
+
+
+def replay_orphaned_journals(journal):
+    """
+    Replay the journals of every process writing to journal that is no
+    longer running, and return the number of votes applied.
+    """
+    journal = Path(journal)
+    pattern = re.compile(re.escape(journal.name) + r"(-\d+)?(\.\d+|\.lock)?")
+    names = set()
+    for path in journal.parent.glob(journal.name + "*"):
+        match = pattern.fullmatch(path.name)
+        if match:
+            names.add(journal.name + (match[1] or ""))
+
+    replayed = 0
+    for name in sorted(names):
+        path = journal.with_name(name)
+        lock = lock_journal(path)
+        if lock is None:
+            continue
+        try:
+            replayed += replay_journals(path)
+            # Only once the journals are gone, so whoever takes a new lock
+            # finds nothing left to replay.
+            Path(lock.name).unlink()
+        finally:
+            lock.close()
+    return replayed
+
+
+class VoteBuffer:
+    def __init__(
+        self,
+        journal=None,
+        flush_interval_ms=50,
+        flush_size=500,
+        journal_fsync=False,
+    ):
+        self.journal_path = Path(journal) if journal else None
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_size = flush_size
+        self.journal_fsync = journal_fsync
+        self.pending = Counter()
+        self.question_ids = {}
+        self.pending_votes = 0
+        self.batches = 0
+        # Rotated journals of batches that failed to flush and were put
+        # back; removed along with the batch that finally applies them.
+        self.requeued_journals = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._journal = None
+        self._journal_lock = None
+        if self.journal_path:
+            replay_orphaned_journals(self.journal_path)
+            self.journal_path = process_journal(self.journal_path)
+            self._journal_lock = lock_journal(self.journal_path)
+            if self._journal_lock is None:
+                raise RuntimeError(f"{self.journal_path} is already in use.")
+            self._journal = open(self.journal_path, "a")
+
+    def add(self, choice_id, question_id=None):
+        with self._lock:
+            if self._journal:
+                self._journal.write(f"{choice_id}\n")
+                self._journal.flush()
+                if self.journal_fsync:
+                    os.fsync(self._journal.fileno())
+            self.pending[choice_id] += 1
+            if question_id is not None:
+                self.question_ids[choice_id] = question_id
+            self.pending_votes += 1
+            full = self.pending_votes >= self.flush_size
+        if full:
+            self._wakeup.set()
+
+    def _take_batch(self):
+        with self._lock:
+            batch, self.pending = self.pending, Counter()
+            question_ids, self.question_ids = self.question_ids, {}
+            self.pending_votes = 0
+            rotated, self.requeued_journals = self.requeued_journals, []
+            if batch and self._journal:
+                self._journal.close()
+                path = self.journal_path.with_name(
+                    f"{self.journal_path.name}.{self.batches}"
+                )
+                os.replace(self.journal_path, path)
+                rotated.append(path)
+                self._journal = open(self.journal_path, "a")
+            self.batches += 1
+        return batch, question_ids, rotated
+
+    def flush(self):
+        """
+        Apply everything buffered so far and return the number of votes.
+        """
+        with self._flush_lock:
+            batch, question_ids, rotated = self._take_batch()
+            if not batch:
+                return 0
+            try:
+                flushed = apply_vote_counts(batch, question_ids)
+            except Exception:
+                # Put the batch back; its journals stay on disk for replay
+                # until a later flush applies it.
+                with self._lock:
+                    self.pending.update(batch)
+                    self.question_ids.update(question_ids)
+                    self.pending_votes += sum(batch.values())
+                    self.requeued_journals[:0] = rotated
+                raise
+            for path in rotated:
+                path.unlink()
+            return flushed
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="vote-buffer-flusher", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.flush()
+        finally:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+            if self._journal_lock:
+                # Whatever is left is replayed by the next buffer to start.
+                self._journal_lock.close()
+                self._journal_lock = None
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set():
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    # The batch was re-queued; try again on the next tick.
+                    pass
+        finally:
+            connection.close()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """
+    Return the process-wide buffer, replaying old journals and starting the
+    flusher thread the first time it is used.
+    """
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                config = get_buffer_settings()
+                buffer = VoteBuffer(
+                    journal=config["JOURNAL"],
+                    flush_interval_ms=config["FLUSH_INTERVAL_MS"],
+                    flush_size=config["FLUSH_SIZE"],
+                    journal_fsync=config["JOURNAL_FSYNC"],
+                )
+                buffer.start()
+                _buffer = buffer
+    return _buffer
+
+
+async def aget_buffer():
+    """
+    get_buffer() for async views: starting the buffer can replay journals
+    with the sync ORM, so that happens in a thread.
+    """
+    return _buffer or await sync_to_async(get_buffer)()
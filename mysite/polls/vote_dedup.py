@@ -0,0 +1,629 @@
+"""
+Duplicate vote detection.
+
+A voter is identified according to ``IDENTITY`` and hashed with a key
+derived from SECRET_KEY:
+
+* "user" (the default): the logged-in user. Anonymous votes aren't checked.
+* "user_or_ip": the logged-in user or, for anonymous visitors, their
+  address.
+* "ip": the address, for everyone.
+
+Addresses come from REMOTE_ADDR, so everyone behind one NAT gateway counts
+as one voter, and behind a reverse proxy every anonymous visitor has the
+proxy's address; only use the address modes where REMOTE_ADDR is the
+client's own. Each question has a Bloom filter of the voters seen so far,
+held in memory:
+
+* A voter the filter has never seen is certainly new. The vote is admitted
+  without touching the database, and a VoteReceipt for it is queued and
+  written with the next bulk insert, every ``FLUSH_INTERVAL_MS``.
+* A voter the filter may have seen is checked exactly: against the
+  receipts still queued, then with one lookup on the VoteReceipt unique
+  index. Only repeats, and the false positives the filter lets through,
+  pay for that query.
+
+Filters are scalable Bloom filters. Each starts with room for
+``INITIAL_CAPACITY`` voters, and when a slice fills up the next is twice as
+large with half the false positive rate, so a question's combined rate
+stays under ``FALSE_POSITIVE_RATE`` however many voters it gets, and memory
+grows with its voters rather than being sized up front.
+
+Every process keeps its own filters. Each ``SYNC_INTERVAL`` seconds it adds
+the receipts other processes have written, so a repeat sent to a different
+process than the first vote is caught once both have synced; within that
+window it can get through. With ``SNAPSHOT_DIR`` set the filters are
+written there through mmap every ``SNAPSHOT_INTERVAL`` seconds, together
+with the last receipt they include, so a new process loads the snapshot and
+syncs the rest instead of reading every receipt. Until a process has
+loaded its filters, in the background, every check is exact.
+
+A vote that fails after being admitted is released: its queued or written
+receipt is dropped, so the voter's next attempt is checked against the
+receipts and let through.
+
+``report()`` lists each question's voters, filter memory and estimated
+false positive rate; ``manage.py vote_dedup_stats`` prints it.
+"""
+
+import atexit
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.db import connection
+
+from .metrics import Counter
+from .models import VoteReceipt
+
+DEFAULTS = {
+    "ENABLED": True,
+    "IDENTITY": "user",
+    "FALSE_POSITIVE_RATE": 0.001,
+    "INITIAL_CAPACITY": 1000,
+    "FLUSH_INTERVAL_MS": 500,
+    "SYNC_INTERVAL": 5,
+    "SNAPSHOT_DIR": None,
+    "SNAPSHOT_INTERVAL": 60,
+}
+
+# Each slice holds GROWTH times the voters of the one before, at TIGHTENING
+# times its false positive rate.
+GROWTH = 2
+TIGHTENING = 0.5
+SYNC_BATCH = 10000
+
+CHECKS = Counter(
+    "polls_vote_dedup_checks_total",
+    "Duplicate vote checks by outcome: new, repeat or false_positive.",
+)
+
+
+def get_dedup_settings():
+    return {**DEFAULTS, **getattr(settings, "POLLS_VOTE_DEDUP", {})}
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate, bits=None, count=0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8) if bits is None else bits
+        self.count = count
+
+    def positions(self, h1, h2):
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, hashes):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self.positions(*hashes))
+
+    def add(self, hashes):
+        """
+        Set the bits of hashes and return whether any was unset.
+        """
+        bits = self.bits
+        new = False
+        for p in self.positions(*hashes):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def false_positive_rate(self):
+        """
+        Estimate the current rate from the share of bits set.
+        """
+        ones = sum(bin(byte).count("1") for byte in self.bits)
+        return (ones / self.num_bits) ** self.num_hashes
+
+
+class ScalableBloomFilter:
+    def __init__(self, initial_capacity, error_rate, slices=None):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.slices = slices or []
+
+    def __contains__(self, hashes):
+        return any(hashes in s for s in self.slices)
+
+    def add(self, hashes):
+        """
+        Add hashes unless the filter may hold them already, and return
+        whether they were certainly new.
+        """
+        if hashes in self:
+            return False
+        if not self.slices or self.slices[-1].full:
+            n = len(self.slices)
+            self.slices.append(
+                BloomFilter(
+                    self.initial_capacity * GROWTH**n,
+                    # The rates sum to at most error_rate.
+                    self.error_rate * (1 - TIGHTENING) * TIGHTENING**n,
+                )
+            )
+        self.slices[-1].add(hashes)
+        return True
+
+    @property
+    def count(self):
+        return sum(s.count for s in self.slices)
+
+    @property
+    def nbytes(self):
+        return sum(len(s.bits) for s in self.slices)
+
+    def false_positive_rate(self):
+        miss = 1.0
+        for s in self.slices:
+            miss *= 1 - s.false_positive_rate()
+        return 1 - miss
+
+
+def hash_key():
+    return hashlib.blake2b(
+        settings.SECRET_KEY.encode(), digest_size=32, person=b"polls.dedup"
+    ).digest()
+
+
+def voter_hash(identity):
+    """
+    Return the signed 64-bit hash VoteReceipt stores for identity.
+    """
+    digest = hashlib.blake2b(identity.encode(), key=hash_key(), digest_size=8)
+    return int.from_bytes(digest.digest(), "little", signed=True)
+
+
+def filter_hashes(voter):
+    """
+    Return the two hashes a voter's Bloom filter positions are built from;
+    the second is odd so the positions don't repeat.
+    """
+    digest = hashlib.blake2b(voter.to_bytes(8, "little", signed=True), digest_size=16)
+    digest = digest.digest()
+    return (
+        int.from_bytes(digest[:8], "little"),
+        int.from_bytes(digest[8:], "little") | 1,
+    )
+
+
+def uses_session():
+    return get_dedup_settings()["IDENTITY"] in ("user", "user_or_ip")
+
+
+def voter_identity(request, user_id):
+    """
+    Return the string identifying the voter behind request, given the
+    session's user ID, or None if the configured IDENTITY doesn't cover
+    them.
+    """
+    identity = get_dedup_settings()["IDENTITY"]
+    if identity in ("user", "user_or_ip") and user_id is not None:
+        return f"user:{user_id}"
+    if identity in ("ip", "user_or_ip"):
+        return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+    return None
+
+
+# Snapshot layout: a header, then per question a record header followed by
+# each slice's header and bits.
+SNAPSHOT_MAGIC = b"PLBF0001"
+SNAPSHOT_HEADER = struct.Struct("<8sqI")
+QUESTION_HEADER = struct.Struct("<qqdI")
+SLICE_HEADER = struct.Struct("<qdqQ")
+
+
+def write_snapshot(path, filters, synced_id):
+    """
+    Write filters to path through mmap, replacing any older snapshot only
+    once the new one is complete.
+    """
+    size = SNAPSHOT_HEADER.size
+    for f in filters.values():
+        size += QUESTION_HEADER.size
+        size += sum(SLICE_HEADER.size + len(s.bits) for s in f.slices)
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name)
+    try:
+        os.ftruncate(fd, size)
+        with mmap.mmap(fd, size) as view:
+            SNAPSHOT_HEADER.pack_into(view, 0, SNAPSHOT_MAGIC, synced_id, len(filters))
+            offset = SNAPSHOT_HEADER.size
+            for question_id, f in filters.items():
+                QUESTION_HEADER.pack_into(
+                    view,
+                    offset,
+                    question_id,
+                    f.initial_capacity,
+                    f.error_rate,
+                    len(f.slices),
+                )
+                offset += QUESTION_HEADER.size
+                for s in f.slices:
+                    SLICE_HEADER.pack_into(
+                        view, offset, s.capacity, s.error_rate, s.count, len(s.bits)
+                    )
+                    offset += SLICE_HEADER.size
+                    view[offset : offset + len(s.bits)] = s.bits
+                    offset += len(s.bits)
+            view.flush()
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+
+def read_snapshot(path):
+    """
+    Return (filters, synced_id) from a snapshot, or ({}, 0) if there is
+    none or it can't be read.
+    """
+    try:
+        with open(path, "rb") as file:
+            view = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return {}, 0
+    filters = {}
+    with view:
+        try:
+            magic, synced_id, questions = SNAPSHOT_HEADER.unpack_from(view, 0)
+            if magic != SNAPSHOT_MAGIC:
+                return {}, 0
+            offset = SNAPSHOT_HEADER.size
+            for _ in range(questions):
+                question_id, initial, error_rate, count = QUESTION_HEADER.unpack_from(
+                    view, offset
+                )
+                offset += QUESTION_HEADER.size
+                slices = []
+                for _ in range(count):
+                    capacity, rate, voters, nbytes = SLICE_HEADER.unpack_from(
+                        view, offset
+                    )
+                    offset += SLICE_HEADER.size
+                    bits = bytearray(view[offset : offset + nbytes])
+                    offset += nbytes
+                    slices.append(BloomFilter(capacity, rate, bits, voters))
+                filters[question_id] = ScalableBloomFilter(initial, error_rate, slices)
+        except struct.error:
+            return {}, 0
+    return filters, synced_id
+
+
+class Deduplicator:
+    def __init__(
+        self,
+        initial_capacity=1000,
+        error_rate=0.001,
+        flush_interval_ms=500,
+        sync_interval=5,
+        snapshot_path=None,
+        snapshot_interval=60,
+    ):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.flush_interval = flush_interval_ms / 1000
+        self.sync_interval = sync_interval
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.filters = {}
+        self.synced_id = 0
+        self.pending = set()
+        # Until the filters have caught up with the receipts every check
+        # is exact.
+        self.loaded = threading.Event()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        if snapshot_path:
+            self.filters, self.synced_id = read_snapshot(snapshot_path)
+
+    def get_filter(self, question_id):
+        f = self.filters.get(question_id)
+        if f is None:
+            f = self.filters[question_id] = ScalableBloomFilter(
+                self.initial_capacity, self.error_rate
+            )
+        return f
+
+    def check(self, question_id, voter):
+        """
+        Return "new" or "repeat" if memory settles it, or None if the
+        receipts must be checked.
+        """
+        if not self.loaded.is_set():
+            return None
+        with self._lock:
+            if self.get_filter(question_id).add(filter_hashes(voter)):
+                self.pending.add((question_id, voter))
+                return "new"
+            if (question_id, voter) in self.pending:
+                return "repeat"
+        return None
+
+    def confirm(self, question_id, voter, has_receipt):
+        """
+        Return the outcome of a check the receipts had to settle.
+        """
+        if has_receipt:
+            return "repeat"
+        with self._lock:
+            if (question_id, voter) in self.pending:
+                return "repeat"
+            self.pending.add((question_id, voter))
+            new = self.get_filter(question_id).add(filter_hashes(voter))
+        return "new" if new else "false_positive"
+
+    def receipts(self, question_id, voter):
+        return VoteReceipt.objects.filter(question_id=question_id, voter=voter)
+
+    def admit(self, question_id, voter):
+        """
+        Return whether voter hasn't voted on question_id before, and if so
+        remember that they now have.
+        """
+        outcome = self.check(question_id, voter)
+        if outcome is None:
+            has_receipt = self.receipts(question_id, voter).exists()
+            outcome = self.confirm(question_id, voter, has_receipt)
+        CHECKS.inc((("outcome", outcome),))
+        if outcome != "repeat" and self.flush_interval <= 0:
+            self.flush()
+        return outcome != "repeat"
+
+    async def aadmit(self, question_id, voter):
+        outcome = self.check(question_id, voter)
+        if outcome is None:
+            has_receipt = await self.receipts(question_id, voter).aexists()
+            outcome = self.confirm(question_id, voter, has_receipt)
+        CHECKS.inc((("outcome", outcome),))
+        if outcome != "repeat" and self.flush_interval <= 0:
+            await sync_to_async(self.flush)()
+        return outcome != "repeat"
+
+    def release(self, question_id, voter):
+        """
+        Forget that voter has voted on question_id, after their vote failed.
+        The filter can't unset their bits, but with no receipt their next
+        vote is settled by the receipts and admitted.
+        """
+        with self._flush_lock:
+            with self._lock:
+                self.pending.discard((question_id, voter))
+            self.receipts(question_id, voter).delete()
+
+    def flush(self):
+        """
+        Write the queued receipts and return how many there were.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = list(self.pending)
+            if not pending:
+                return 0
+            VoteReceipt.objects.bulk_create(
+                [VoteReceipt(question_id=q, voter=v) for q, v in pending],
+                batch_size=1000,
+                ignore_conflicts=True,
+            )
+            with self._lock:
+                self.pending.difference_update(pending)
+            return len(pending)
+
+    def sync(self):
+        """
+        Add receipts written since the last sync, by any process, to the
+        filters, and return how many were read.
+        """
+        read = 0
+        while True:
+            rows = list(
+                VoteReceipt.objects.filter(pk__gt=self.synced_id)
+                .order_by("pk")
+                .values_list("pk", "question_id", "voter")[:SYNC_BATCH]
+            )
+            with self._lock:
+                for _, question_id, voter in rows:
+                    self.get_filter(question_id).add(filter_hashes(voter))
+            read += len(rows)
+            if len(rows) < SYNC_BATCH:
+                if rows:
+                    self.synced_id = rows[-1][0]
+                return read
+            self.synced_id = rows[-1][0]
+
+    def snapshot(self):
+        """
+        Sync, so the snapshot holds every receipt up to the one it names,
+        then write it.
+        """
+        self.sync()
+        with self._lock:
+            write_snapshot(self.snapshot_path, self.filters, self.synced_id)
+
+    def report(self):
+        """
+        Return a row of voters, filter slices, bytes and estimated false
+        positive rate per question, largest first.
+        """
+        with self._lock:
+            rows = [
+                {
+                    "question_id": question_id,
+                    "voters": f.count,
+                    "slices": len(f.slices),
+                    "bytes": f.nbytes,
+                    "false_positive_rate": f.false_positive_rate(),
+                }
+                for question_id, f in self.filters.items()
+            ]
+        return sorted(rows, key=lambda row: row["bytes"], reverse=True)
+
+    def start(self):
+        """
+        Load the filters, in a background thread that then flushes, syncs
+        and snapshots them, or right away with ``FLUSH_INTERVAL_MS = 0``.
+        """
+        if self.flush_interval <= 0:
+            self.sync()
+            self.loaded.set()
+        elif self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="vote-dedup", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self.snapshot_path:
+            self.snapshot()
+
+    def _run(self):
+        synced = snapshotted = time.monotonic()
+        try:
+            while not self.loaded.is_set() and not self._stopped.is_set():
+                try:
+                    self.sync()
+                    self.loaded.set()
+                except Exception:
+                    self._stopped.wait(self.flush_interval)
+            while not self._stopped.wait(self.flush_interval):
+                now = time.monotonic()
+                try:
+                    self.flush()
+                    if now - synced >= self.sync_interval:
+                        self.sync()
+                        synced = now
+                    if self.snapshot_path and now - snapshotted >= (
+                        self.snapshot_interval
+                    ):
+                        self.snapshot()
+                        snapshotted = now
+                except Exception:
+                    # Receipts stay queued; try again on the next tick.
+                    pass
+        finally:
+            connection.close()
+
+
+def build_deduplicator(**options):
+    """
+    Return a Deduplicator configured from the settings, with options
+    overriding them.
+    """
+    config = get_dedup_settings()
+    directory = config["SNAPSHOT_DIR"]
+    options = {
+        "initial_capacity": config["INITIAL_CAPACITY"],
+        "error_rate": config["FALSE_POSITIVE_RATE"],
+        "flush_interval_ms": config["FLUSH_INTERVAL_MS"],
+        "sync_interval": config["SYNC_INTERVAL"],
+        "snapshot_path": Path(directory) / "vote-dedup.bloom" if directory else None,
+        "snapshot_interval": config["SNAPSHOT_INTERVAL"],
+        **options,
+    }
+    return Deduplicator(**options)
+
+
+_deduplicator = None
+_deduplicator_lock = threading.Lock()
+
+
+def get_deduplicator():
+    """
+    Return the process-wide Deduplicator, starting it the first time it
+    is used.
+    """
+    global _deduplicator
+    if _deduplicator is None:
+        with _deduplicator_lock:
+            if _deduplicator is None:
+                deduplicator = build_deduplicator()
+                deduplicator.start()
+                _deduplicator = deduplicator
+    return _deduplicator
+
+
+def reset():
+    """
+    Drop the process-wide Deduplicator, so the next one reads the settings
+    again.
+    """
+    global _deduplicator
+    with _deduplicator_lock:
+        deduplicator, _deduplicator = _deduplicator, None
+        if deduplicator is not None:
+            deduplicator.stop()
+
+
+def admit(request, question_id):
+    """
+    Return whether request's voter may vote on question_id; see the module
+    docstring.
+    """
+    if not get_dedup_settings()["ENABLED"]:
+        return True
+    user_id = request.session.get(SESSION_KEY) if uses_session() else None
+    identity = voter_identity(request, user_id)
+    if identity is None:
+        return True
+    return get_deduplicator().admit(question_id, voter_hash(identity))
+
+
+async def aadmit(request, question_id):
+    if not get_dedup_settings()["ENABLED"]:
+        return True
+    user_id = await request.session.aget(SESSION_KEY) if uses_session() else None
+    identity = voter_identity(request, user_id)
+    if identity is None:
+        return True
+    # Starting it can read the receipts.
+    deduplicator = _deduplicator or await sync_to_async(get_deduplicator)()
+    return await deduplicator.aadmit(question_id, voter_hash(identity))
+
+
+def release(request, question_id):
+    """
+    Undo admit() for a vote that couldn't be recorded.
+    """
+    if not get_dedup_settings()["ENABLED"]:
+        return
+    user_id = request.session.get(SESSION_KEY) if uses_session() else None
+    identity = voter_identity(request, user_id)
+    if identity is not None:
+        get_deduplicator().release(question_id, voter_hash(identity))
+
+
+async def arelease(request, question_id):
+    if not get_dedup_settings()["ENABLED"]:
+        return
+    user_id = await request.session.aget(SESSION_KEY) if uses_session() else None
+    identity = voter_identity(request, user_id)
+    if identity is not None:
+        deduplicator = _deduplicator or await sync_to_async(get_deduplicator)()
+        await sync_to_async(deduplicator.release)(question_id, voter_hash(identity))
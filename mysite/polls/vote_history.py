@@ -0,0 +1,380 @@
+"""
+Vote history: per-minute, per-hour and per-day vote counts for each choice.
+
+Choice.votes only holds a running total. Alongside it, every committed vote
+is appended to VoteEvent:
+
+* The ``votes_committed`` receiver hands votes to a process-wide
+  EventRecorder, which merges them per (second, choice) and inserts them with
+  one bulk_create() every ``FLUSH_INTERVAL_MS`` or ``FLUSH_SIZE`` events.
+  ``FLUSH_INTERVAL_MS = 0`` inserts them as they arrive instead. History is
+  for trends, not counting: events still buffered when a process dies are
+  lost, while the votes themselves are not.
+* ``roll_up()``, run by ``manage.py rollup_votes --interval N``, takes new
+  events in primary key order and adds them to the VoteRollup buckets of
+  every resolution with one ``INSERT ... SELECT ... GROUP BY ... ON
+  CONFLICT DO UPDATE`` each, so events never leave the database.
+  ``rollup_votes`` then applies retention: raw events are deleted after
+  ``RAW_DAYS``, minute buckets after ``MINUTE_DAYS`` and hour buckets after
+  ``HOUR_DAYS``. Day buckets, which start at midnight UTC, are kept, so old
+  history is held at one row per choice per day however many votes it
+  counts.
+
+``trend()`` reads a question's buckets from VoteRollup only, so it costs the
+same at a thousand votes a minute as at one. Votes reach it once they have
+been flushed and rolled up.
+"""
+
+import atexit
+import math
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import VoteEvent, VoteRollup, VoteRollupCursor
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+RESOLUTIONS = {"minute": MINUTE, "hour": HOUR, "day": DAY}
+# The window trend() covers when it isn't given one, per resolution.
+DEFAULT_SPANS = {MINUTE: HOUR, HOUR: 2 * DAY, DAY: 30 * DAY}
+MAX_BUCKETS = 2000
+
+# Times outside what an IntegerField holds on every backend are refused.
+MIN_TIME, MAX_TIME = -(2**31), 2**31 - 1
+
+DEFAULTS = {
+    "ENABLED": True,
+    "FLUSH_INTERVAL_MS": 1000,
+    "FLUSH_SIZE": 1000,
+    "ROLLUP_BATCH_SIZE": 50000,
+    "RAW_DAYS": 2,
+    "MINUTE_DAYS": 14,
+    "HOUR_DAYS": 180,
+}
+
+
+def get_history_settings():
+    return {**DEFAULTS, **getattr(settings, "POLLS_VOTE_HISTORY", {})}
+
+
+def write_events(events):
+    """
+    Insert {(at, question_id, choice_id): votes} as VoteEvent rows.
+    """
+    VoteEvent.objects.bulk_create(
+        [
+            VoteEvent(at=at, question_id=question_id, choice_id=choice_id, count=n)
+            for (at, question_id, choice_id), n in events.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class EventRecorder:
+    def __init__(self, flush_interval_ms=1000, flush_size=1000):
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_size = flush_size
+        self.pending = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, at, question_id, counts):
+        with self._lock:
+            for choice_id, n in counts.items():
+                self.pending[(at, question_id, choice_id)] += n
+            full = len(self.pending) >= self.flush_size
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Insert everything recorded so far and return the number of rows.
+        """
+        with self._flush_lock:
+            with self._lock:
+                events, self.pending = self.pending, Counter()
+            if not events:
+                return 0
+            try:
+                write_events(events)
+            except Exception:
+                with self._lock:
+                    self.pending.update(events)
+                raise
+            return len(events)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="vote-history-flusher", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set():
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    # The events were put back; try again on the next tick.
+                    pass
+        finally:
+            connection.close()
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    """
+    Return the process-wide recorder, starting its flusher thread the first
+    time it is used.
+    """
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                config = get_history_settings()
+                recorder = EventRecorder(
+                    flush_interval_ms=config["FLUSH_INTERVAL_MS"],
+                    flush_size=config["FLUSH_SIZE"],
+                )
+                recorder.start()
+                _recorder = recorder
+    return _recorder
+
+
+def record(question_id, counts, at=None):
+    """
+    Append {choice_id: votes} for question_id to the history.
+    """
+    config = get_history_settings()
+    if not config["ENABLED"] or not counts:
+        return
+    at = int(time.time() if at is None else at)
+    if config["FLUSH_INTERVAL_MS"] <= 0:
+        write_events({(at, question_id, pk): n for pk, n in counts.items()})
+    else:
+        get_recorder().add(at, question_id, counts)
+
+
+def lock_events():
+    """
+    Wait for transactions inserting events to finish, and hold off new
+    ones, so no event commits under an ID the rollup has already passed.
+    SQLite needs nothing: it has one writer at a time.
+    """
+    if connection.vendor == "postgresql":
+        table = connection.ops.quote_name(VoteEvent._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {table} IN SHARE MODE")
+
+
+def roll_up(batch_size=None):
+    """
+    Add events not yet counted to the rollups, in batches of IDs, and return
+    the number of events counted.
+    """
+    batch_size = batch_size or get_history_settings()["ROLLUP_BATCH_SIZE"]
+    counted = 0
+    while True:
+        with transaction.atomic():
+            lock_events()
+            cursor = VoteRollupCursor.objects.select_for_update().first()
+            if cursor is None:
+                cursor = VoteRollupCursor.objects.create()
+            pending = VoteEvent.objects.filter(pk__gt=cursor.last_event_id)
+            last = pending.order_by("pk").values_list("pk", flat=True)[
+                batch_size - 1 : batch_size
+            ]
+            last = last[0] if last else pending.aggregate(last=Max("pk"))["last"]
+            if last is None:
+                return counted
+            size = pending.filter(pk__lte=last).count()
+            add_to_rollups(cursor.last_event_id, last)
+            cursor.last_event_id = last
+            cursor.save(update_fields=["last_event_id"])
+        counted += size
+        if size < batch_size:
+            return counted
+
+
+def add_to_rollups(after, last):
+    """
+    Add the events with IDs in (after, last] to every resolution's buckets,
+    summing them in the database.
+    """
+    quote = connection.ops.quote_name
+    events = quote(VoteEvent._meta.db_table)
+    rollups = quote(VoteRollup._meta.db_table)
+    with connection.cursor() as cursor:
+        for resolution in RESOLUTIONS.values():
+            # The WHERE clause also keeps SQLite from reading ON CONFLICT
+            # as part of the SELECT.
+            cursor.execute(
+                f"INSERT INTO {rollups} "
+                "(question_id, resolution, bucket, choice_id, count) "
+                "SELECT question_id, %s, at - at %% %s, choice_id, SUM(count) "
+                f"FROM {events} WHERE id > %s AND id <= %s "
+                "GROUP BY question_id, at - at %% %s, choice_id "
+                "ON CONFLICT (question_id, resolution, bucket, choice_id) "
+                f"DO UPDATE SET count = {rollups}.count + excluded.count",
+                [resolution, resolution, after, last, resolution],
+            )
+
+
+def apply_retention(now=None):
+    """
+    Delete raw events and minute and hour buckets past their retention, and
+    return the number of rows deleted. Only events already rolled up go.
+    """
+    config = get_history_settings()
+    now = int(time.time() if now is None else now)
+    cursor = VoteRollupCursor.objects.first()
+    if cursor is None:
+        return 0
+    # Events are appended in time order, give or take a flush interval, so
+    # the expired ones are at the start of the table; find where they end
+    # without reading the rest.
+    first_kept = (
+        VoteEvent.objects.filter(at__gte=now - config["RAW_DAYS"] * DAY)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+        .first()
+    )
+    last_expired = cursor.last_event_id
+    if first_kept is not None:
+        last_expired = min(last_expired, first_kept - 1)
+    deleted, _ = VoteEvent.objects.filter(pk__lte=last_expired).delete()
+    for resolution, days in [
+        (MINUTE, config["MINUTE_DAYS"]),
+        (HOUR, config["HOUR_DAYS"]),
+    ]:
+        count, _ = VoteRollup.objects.filter(
+            resolution=resolution, bucket__lt=now - days * DAY
+        ).delete()
+        deleted += count
+    return deleted
+
+
+def parse_time(value):
+    """
+    Return a Unix time from seconds or an ISO 8601 datetime, or None if
+    it can't be read or is out of range.
+    """
+    if value in (None, ""):
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            when = parse_datetime(value)
+        except ValueError:
+            return None
+        if when is None:
+            return None
+        if timezone.is_naive(when):
+            when = timezone.make_aware(when)
+        seconds = when.timestamp()
+    if not math.isfinite(seconds) or not MIN_TIME <= seconds <= MAX_TIME:
+        return None
+    return int(seconds)
+
+
+def trend_args(params):
+    """
+    Return (resolution, since, until) from a trend request's query string,
+    raising ValueError if it can't be read.
+    """
+    name = params.get("resolution", "minute")
+    if name not in RESOLUTIONS:
+        raise ValueError("resolution must be minute, hour or day.")
+    bounds = []
+    for field in ["since", "until"]:
+        value = parse_time(params.get(field))
+        if value is None and params.get(field):
+            raise ValueError(f"{field} must be a Unix time or ISO 8601 datetime.")
+        bounds.append(value)
+    return RESOLUTIONS[name], *bounds
+
+
+def trend_window(resolution, since=None, until=None, now=None):
+    """
+    Return the (first, last) bucket starts to report, at most MAX_BUCKETS
+    apart.
+    """
+    now = int(time.time() if now is None else now)
+    last = min(now if until is None else until, now)
+    last -= last % resolution
+    first = last - DEFAULT_SPANS[resolution] + resolution if since is None else since
+    first -= first % resolution
+    first = max(first, last - (MAX_BUCKETS - 1) * resolution)
+    return first, last
+
+
+def trend_queryset(question_id, resolution, first, last):
+    return (
+        VoteRollup.objects.filter(
+            question_id=question_id,
+            resolution=resolution,
+            bucket__gte=first,
+            bucket__lte=last,
+        )
+        .order_by("bucket", "choice_id")
+        .values_list("bucket", "choice_id", "count")
+    )
+
+
+def build_trend(question_id, resolution, first, last, rows):
+    """
+    Return the JSON-ready trend of question_id from (bucket, choice_id,
+    count) rows. Buckets without votes are left out.
+    """
+    buckets = {}
+    for bucket, choice_id, n in rows:
+        entry = buckets.setdefault(bucket, {"start": bucket, "total": 0, "votes": {}})
+        entry["votes"][str(choice_id)] = n
+        entry["total"] += n
+    name = {seconds: name for name, seconds in RESOLUTIONS.items()}[resolution]
+    return {
+        "question": question_id,
+        "resolution": name,
+        "since": first,
+        "until": last + resolution,
+        "buckets": list(buckets.values()),
+    }
+
+
+def trend(question_id, resolution=MINUTE, since=None, until=None):
+    first, last = trend_window(resolution, since, until)
+    rows = trend_queryset(question_id, resolution, first, last)
+    return build_trend(question_id, resolution, first, last, rows)
+
+
+async def atrend(question_id, resolution=MINUTE, since=None, until=None):
+    first, last = trend_window(resolution, since, until)
+    rows = [row async for row in trend_queryset(question_id, resolution, first, last)]
+    return build_trend(question_id, resolution, first, last, rows)
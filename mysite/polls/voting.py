@@ -0,0 +1,122 @@
+"""
+Vote ingestion for the polls app.
+
+Votes are applied as atomic ``UPDATE ... SET votes = votes + 1`` statements
+instead of a read-modify-write on the Choice instance, so concurrent votes
+can't overwrite each other. When ``POLLS_VOTE_SHARDS`` is greater than one,
+increments are spread over that many ChoiceVoteShard rows per Choice and
+``compact_votes()`` folds them back into ``Choice.votes``.
+
+``submit_vote()`` is what the vote view calls; with ``POLLS_VOTE_MODE`` set
+to ``"buffered"`` it defers to the write-behind buffer in ``vote_buffer``.
+Either way ``votes_committed`` is sent once the vote commits, which updates
+the cached results tally and live results streams.
+``asubmit_vote()`` does the same for the async vote view.
+"""
+
+import random
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import Choice, ChoiceVoteShard
+from .signals import votes_committed
+
+
+def get_shard_count():
+    return getattr(settings, "POLLS_VOTE_SHARDS", 0)
+
+
+def get_vote_mode():
+    return getattr(settings, "POLLS_VOTE_MODE", "sync")
+
+
+def submit_vote(choice):
+    """
+    Accept a vote from the vote view using the configured mode.
+    """
+    if get_vote_mode() == "buffered":
+        from .vote_buffer import get_buffer
+
+        get_buffer().add(choice.pk, choice.question_id)
+    else:
+        record_vote(choice.pk)
+        transaction.on_commit(
+            lambda: votes_committed.send(
+                sender=Choice, question_id=choice.question_id, counts={choice.pk: 1}
+            )
+        )
+
+
+async def asubmit_vote(choice):
+    if get_vote_mode() == "buffered":
+        from .vote_buffer import aget_buffer
+
+        (await aget_buffer()).add(choice.pk, choice.question_id)
+    else:
+        # The async ORM runs in autocommit, so the vote has committed once
+        # arecord_vote() returns.
+        await arecord_vote(choice.pk)
+        await votes_committed.asend(
+            sender=Choice, question_id=choice.question_id, counts={choice.pk: 1}
+        )
+
+
+def record_vote(choice_id):
+    """
+    Count one vote for the given choice without reading it first.
+    """
+    shards = get_shard_count()
+    if shards <= 1:
+        Choice.objects.filter(pk=choice_id).update(votes=F("votes") + 1)
+        return
+
+    shard = random.randrange(shards)
+    counter = ChoiceVoteShard.objects.filter(choice_id=choice_id, shard=shard)
+    if counter.update(count=F("count") + 1):
+        return
+    try:
+        with transaction.atomic():
+            ChoiceVoteShard.objects.create(choice_id=choice_id, shard=shard, count=1)
+    except IntegrityError:
+        # Another request created this shard first.
+        counter.update(count=F("count") + 1)
+
+
+async def arecord_vote(choice_id):
+    shards = get_shard_count()
+    if shards <= 1:
+        await Choice.objects.filter(pk=choice_id).aupdate(votes=F("votes") + 1)
+        return
+
+    shard = random.randrange(shards)
+    counter = ChoiceVoteShard.objects.filter(choice_id=choice_id, shard=shard)
+    if await counter.aupdate(count=F("count") + 1):
+        return
+    try:
+        await ChoiceVoteShard.objects.acreate(choice_id=choice_id, shard=shard, count=1)
+    except IntegrityError:
+        await counter.aupdate(count=F("count") + 1)
+
+
+def compact_votes(choice_ids=None):
+    """
+    Fold sharded counters into Choice.votes and return the number of votes
+    moved. Each shard is decremented by exactly the amount that was read,
+    so votes landing during compaction stay in the shard for the next run.
+    """
+    shards = ChoiceVoteShard.objects.filter(count__gt=0)
+    if choice_ids is not None:
+        shards = shards.filter(choice_id__in=choice_ids)
+
+    folded = 0
+    with transaction.atomic():
+        totals = {}
+        for pk, choice_id, count in shards.values_list("pk", "choice_id", "count"):
+            ChoiceVoteShard.objects.filter(pk=pk).update(count=F("count") - count)
+            totals[choice_id] = totals.get(choice_id, 0) + count
+        for choice_id, count in totals.items():
+            Choice.objects.filter(pk=choice_id).update(votes=F("votes") + count)
+            folded += count
+    return folded